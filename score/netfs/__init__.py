@@ -26,7 +26,7 @@
 
 from ._init import init, ConfiguredNetfsModule
 from ._exceptions import CommitFailed, UploadFailed, DownloadFailed
-from ._connection import NetfsConnection
+from ._connection import NetfsConnection, FileStat
 
 __all__ = ('init', 'ConfiguredNetfsModule', 'CommitFailed', 'UploadFailed',
-           'DownloadFailed', 'NetfsConnection')
+           'DownloadFailed', 'NetfsConnection', 'FileStat')
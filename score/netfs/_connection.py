@@ -1,10 +1,12 @@
+from collections import deque, namedtuple
 import fcntl
-import hashlib
-import socket
+import io
+import mmap
 import logging
 import os
 import shutil
 import struct
+from . import address, compression, hashing, rsync
 from ._exceptions import CommitFailed, UploadFailed, DownloadFailed
 from .constants import Constants
 from transaction.interfaces import IDataManager
@@ -13,18 +15,65 @@ from zope.interface import implementer
 log = logging.getLogger('score.netfs')
 
 
+FileStat = namedtuple('FileStat', ('size', 'mtime', 'digest'))
+FileStat.__doc__ = """
+Information about a file on the server: its *size* in bytes, its
+modification time *mtime* as a unix timestamp, and its *digest*, calculated
+with the connection's hash algorithm.
+"""
+
+
 class NetfsConnection:
 
     CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, conf):
         self.conf = conf
+        self.version = 0
+        self.hash_name = hashing.DEFAULT
+        # whether the server holds uploads, that were not committed yet
+        self._pending = False
         if self.conf.host:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.conf.host, self.conf.port))
-            self.socket.settimeout(None)
+            self._connect()
+            self._hello()
 
-    def put(self, path, file, ctx=None, *, move=True):
+    def _connect(self):
+        if self.conf.multiplex:
+            self.socket = self.conf._open_stream()
+            if self.socket is not None:
+                return
+        self.socket = address.connect(self.conf.host, self.conf.port)
+        self.socket.settimeout(None)
+
+    def _hello(self):
+        """
+        Announces the configured hash algorithms to the server and stores the
+        server's protocol version and the chosen algorithm.
+
+        Servers predating this request close the connection when they receive
+        it. In that case, the connection is re-established and the defaults
+        remain in place.
+        """
+        data = struct.pack('!bBB', Constants.REQ_HELLO,
+                           Constants.PROTOCOL_VERSION, len(self.conf.hashes))
+        for name in self.conf.hashes:
+            name = name.encode('ASCII')
+            data += struct.pack('!B', len(name)) + name
+        try:
+            self._send(data)
+            status, version, length = struct.unpack('!bBB', self._read(3))
+            name = str(self._read(length), 'ASCII')
+        except (RuntimeError, OSError):
+            log.debug('server does not support hello, using defaults')
+            self.socket.close()
+            self._connect()
+            return
+        if status != Constants.RESP_OK:
+            return
+        self.version = version
+        self.hash_name = name
+
+    def put(self, path, file, ctx=None, *, move=True, delta=False):
         """
         Uploads a file with given *path* to the server and moves it into the
         cache folder. The *file* is either a string (denoting a file system path
@@ -32,11 +81,11 @@ class NetfsConnection:
 
         In case the *file* parameter was a string, it is possible to keep that
         original file in place by specifying a falsy value for *move*.
+
+        If *delta* is `True`, the file is sent as a :meth:`delta upload
+        <.upload_delta>`.
         """
-        realpath = os.path.realpath(os.path.join(self.conf.cachedir, path))
-        path_prefix = os.path.commonprefix((self.conf.cachedir, realpath))
-        if path_prefix != self.conf.cachedir:
-            raise ValueError('Invalid path: ' + path)
+        realpath = self._cache_path(path)
         dirname = os.path.dirname(realpath)
         if dirname:
             os.makedirs(dirname, exist_ok=True)
@@ -48,31 +97,42 @@ class NetfsConnection:
             file = open(realpath, 'rb')
         else:
             shutil.copyfileobj(file, open(realpath, 'wb'))
-        if self.conf.host:
+        if self.conf.host and delta:
+            self.upload_delta(path, file, ctx)
+        elif self.conf.host:
             self.upload(path, file, ctx)
 
     def get(self, path):
         """
         Returns the local path to a file, downloading it from the server, if it
         does not already exist in the local cache folder.
+
+        If a previous attempt to download the file was interrupted, only the
+        missing part of the file is requested, provided the server supports
+        ranged downloads.
         """
-        realpath = os.path.realpath(os.path.join(self.conf.cachedir, path))
-        path_prefix = os.path.commonprefix((self.conf.cachedir, realpath))
-        if path_prefix != self.conf.cachedir:
-            raise ValueError('Invalid path: ' + path)
+        realpath = self._cache_path(path)
         if os.path.exists(realpath):
             return realpath
         tmpfile = realpath + '.tmp'
         dirname = os.path.dirname(realpath)
         if dirname:
             os.makedirs(dirname, exist_ok=True)
-        file = open(tmpfile, 'wb')
+        file = open(tmpfile, 'ab')
         try:
             fcntl.flock(file, fcntl.LOCK_EX)
             if os.path.exists(realpath):
                 # another process downloaded the file
                 return realpath
-            time = self.download(path, file)
+            time = None
+            offset = os.fstat(file.fileno()).st_size
+            if offset and self.version >= 2:
+                time = self._resume_download(path, file, tmpfile, offset)
+            if time is None:
+                file.truncate(0)
+                time = self.download(path, file)
+            # buffered data must be written before the mtime is set
+            file.flush()
             os.rename(tmpfile, realpath)
             os.utime(realpath, (time, time))
         finally:
@@ -80,7 +140,71 @@ class NetfsConnection:
             file.close()
         return realpath
 
-    def upload(self, path, file, ctx=None):
+    def get_many(self, paths, *, window=16):
+        """
+        Like :meth:`.get`, but for many files at once: All missing files are
+        downloaded using :meth:`.download_many`. Returns a dict mapping each
+        path to its local path, or to `None`, if the file does not exist on
+        the server.
+        """
+        result = {}
+        pending = []
+        locked = []
+        try:
+            for path in paths:
+                realpath = self._cache_path(path)
+                if os.path.exists(realpath):
+                    result[path] = realpath
+                    continue
+                dirname = os.path.dirname(realpath)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                file = open(realpath + '.tmp', 'ab')
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # another process is downloading this file, wait for it
+                    # once the other downloads are done
+                    file.close()
+                    locked.append(path)
+                    continue
+                if os.path.exists(realpath):
+                    fcntl.flock(file, fcntl.LOCK_UN)
+                    file.close()
+                    result[path] = realpath
+                    continue
+                file.truncate(0)
+                pending.append((path, realpath, file))
+            times = self.download_many(
+                ((path, file) for path, _, file in pending), window=window)
+            for path, realpath, file in pending:
+                time = times[path]
+                if time is None:
+                    result[path] = None
+                    continue
+                file.flush()
+                os.rename(realpath + '.tmp', realpath)
+                os.utime(realpath, (time, time))
+                result[path] = realpath
+        finally:
+            for _, _, file in pending:
+                fcntl.flock(file, fcntl.LOCK_UN)
+                file.close()
+        for path in locked:
+            try:
+                result[path] = self.get(path)
+            except DownloadFailed:
+                result[path] = None
+        return result
+
+    def _cache_path(self, path):
+        realpath = os.path.realpath(os.path.join(self.conf.cachedir, path))
+        path_prefix = os.path.commonprefix((self.conf.cachedir, realpath))
+        if path_prefix != self.conf.cachedir:
+            raise ValueError('Invalid path: ' + path)
+        return realpath
+
+    def upload(self, path, file, ctx=None, *, dedup=False):
         """
         Puts the contents of given :term:`file object` *file* with given *path*
         onto the server.
@@ -89,18 +213,74 @@ class NetfsConnection:
         using the ctx module, though, you should pass a :term:`context object`
         as *ctx*. This will automatically commit the upload if the transaction
         was successful.
+
+        If *dedup* is `True`, the file is hashed first and only transferred, if
+        the server does not already store a file with the same content. See
+        :meth:`.link` for details.
         """
         if self.conf.host is None:
             raise UploadFailed('No server configured')
         if not isinstance(path, bytes):
             path = path.encode('UTF-8')
-        data = struct.pack('b', Constants.REQ_UPLOAD)
+        if dedup and self._link_file(path, file, ctx):
+            return
+        self._send_upload(path, file)
+        if not self._read_upload_response(ctx):
+            raise UploadFailed()
+
+    def upload_many(self, files, ctx=None, *, window=16):
+        """
+        Uploads many files like :meth:`.upload`, but without waiting for the
+        server's response to an upload before sending the next one. At most
+        *window* responses are pending at any time. The *files* must be an
+        iterable of `(path, file)` tuples.
+
+        All files are sent, even if some of them fail. In that case an
+        :class:`.UploadFailed` listing the failed paths is raised in the end.
+        """
+        if self.conf.host is None:
+            raise UploadFailed('No server configured')
+        queue = deque()
+        failed = []
+
+        def read_response():
+            path = queue.popleft()
+            if not self._read_upload_response(ctx):
+                failed.append(path)
+
+        for path, file in files:
+            if len(queue) >= window:
+                read_response()
+            if not isinstance(path, bytes):
+                path = path.encode('UTF-8')
+            self._send_upload(path, file)
+            queue.append(path)
+        while queue:
+            read_response()
+        if failed:
+            raise UploadFailed(*failed)
+
+    def _send_upload(self, path, file):
+        codec = self._upload_codec(path, file)
+        if codec == compression.NONE:
+            data = struct.pack('b', Constants.REQ_UPLOAD)
+        else:
+            data = struct.pack('b', Constants.REQ_UPLOAD_COMPRESSED)
         data += struct.pack('!i', len(path))
         data += path
         file.seek(0, 2)
         data += struct.pack('!q', file.tell())
         file.seek(0, 0)
-        sha = hashlib.sha512()
+        sha = hashing.new(self.hash_name)
+        if codec != compression.NONE:
+            data += struct.pack('!B', codec)
+            self._send(data)
+            for chunk in iter(lambda: file.read(compression.BLOCK_SIZE), b''):
+                sha.update(chunk)
+                block = compression.compress(codec, chunk)
+                self._send(struct.pack('!I', len(block)) + block)
+            self._send(struct.pack('!I', 0) + sha.digest())
+            return
         self._send(data)
         chunk = file.read(self.CHUNK_SIZE)
         while chunk:
@@ -108,12 +288,215 @@ class NetfsConnection:
             sha.update(chunk)
             chunk = file.read(self.CHUNK_SIZE)
         self._send(sha.digest())
+
+    def upload_delta(self, path, file, ctx=None):
+        """
+        Uploads a new version of a file like :meth:`.upload`, but transfers
+        only the parts, that differ from the version currently stored on the
+        server. This requires the server to send a signature of its version
+        first, so it only pays off for large files with few changes.
+
+        The whole file is uploaded, if the server does not have a version of
+        the file yet, or if it was changed in the meantime.
+        """
+        if self.conf.host is None:
+            raise UploadFailed('No server configured')
+        if not isinstance(path, bytes):
+            path = path.encode('UTF-8')
+        if self.version < 9:
+            return self.upload(path, file, ctx)
+        signature = self._read_signature(path)
+        if signature is None:
+            return self.upload(path, file, ctx)
+        data = _map_file(file)
+        try:
+            instructions = signature.delta(data)
+            self._send_delta(path, data, signature, instructions)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
         response = struct.unpack('b', self._read(1))[0]
+        if response == Constants.RESP_NOTFOUND:
+            log.debug('delta upload of {} failed, retrying'.format(path))
+            return self.upload(path, file, ctx)
         if response != Constants.RESP_OK:
-            raise UploadFailed()
+            raise UploadFailed(path)
+        self._pending = True
         if ctx:
             _CtxDataManager.join(self, ctx.tx_manager)
 
+    def _read_signature(self, path):
+        """
+        Requests the signature of the server's version of the file with given
+        *path*. Returns a :class:`Signature <score.netfs.rsync.Signature>`,
+        or `None`, if there is no such file.
+        """
+        data = struct.pack('b', Constants.REQ_SIGNATURE)
+        data += struct.pack('!i', len(path))
+        data += path
+        self._send(data)
+        status = struct.unpack('b', self._read(1))[0]
+        if status == Constants.RESP_NOTFOUND:
+            return None
+        if status != Constants.RESP_OK:
+            raise UploadFailed(path)
+        size, block_size, length = struct.unpack('!qII', self._read(16))
+        return rsync.Signature(self._read(length), size, block_size)
+
+    def _send_delta(self, path, data, signature, instructions):
+        request = struct.pack('b', Constants.REQ_UPLOAD_DELTA)
+        request += struct.pack('!i', len(path))
+        request += path
+        request += struct.pack('!qI', len(data), signature.block_size)
+        self._send(request)
+        for instruction in instructions:
+            if instruction[0] == rsync.COPY:
+                self._send(struct.pack('!BII', *instruction))
+                continue
+            _, start, end = instruction
+            for offset in range(start, end, self.CHUNK_SIZE):
+                chunk = data[offset:min(end, offset + self.CHUNK_SIZE)]
+                self._send(struct.pack('!BI', rsync.LITERAL, len(chunk)))
+                self._send(chunk)
+        sha = hashing.new(self.hash_name)
+        for offset in range(0, len(data), self.CHUNK_SIZE):
+            sha.update(data[offset:offset + self.CHUNK_SIZE])
+        self._send(struct.pack('!B', rsync.END) + sha.digest())
+
+    def _upload_codec(self, path, file):
+        """
+        Returns the codec for uploading given *file*, or `compression.NONE`,
+        if it should be sent uncompressed.
+        """
+        if self.version < 8 or not self.conf.compression:
+            return compression.NONE
+        file.seek(0, 0)
+        sample = file.read(compression.SAMPLE_SIZE)
+        if not compression.compressible(path, sample):
+            return compression.NONE
+        return self.conf.compression[0]
+
+    def _read_upload_response(self, ctx):
+        response = struct.unpack('b', self._read(1))[0]
+        if response != Constants.RESP_OK:
+            return False
+        self._pending = True
+        if ctx:
+            _CtxDataManager.join(self, ctx.tx_manager)
+        return True
+
+    def link(self, path, size, digest, ctx=None):
+        """
+        Puts a file with given *path* onto the server, without transferring its
+        content: The server creates a copy of another file it already stores,
+        that has given *size* and *digest*. The *digest* must be calculated
+        with the hash algorithm stored in the connection's *hash_name*.
+
+        Returns `True` on success. Returns `False`, if the server has no such
+        file, or does not support this operation, in which case the file must
+        be uploaded with :meth:`.upload`. The upload is part of the transaction
+        like any other, see :meth:`.upload` for the meaning of *ctx*.
+        """
+        if self.conf.host is None:
+            raise UploadFailed('No server configured')
+        if self.version < 4:
+            return False
+        if not isinstance(path, bytes):
+            path = path.encode('UTF-8')
+        data = struct.pack('b', Constants.REQ_LINK)
+        data += struct.pack('!i', len(path))
+        data += path
+        data += struct.pack('!q', size)
+        data += digest
+        self._send(data)
+        response = struct.unpack('b', self._read(1))[0]
+        if response == Constants.RESP_NOTFOUND:
+            return False
+        if response != Constants.RESP_OK:
+            raise UploadFailed(path)
+        self._pending = True
+        if ctx:
+            _CtxDataManager.join(self, ctx.tx_manager)
+        return True
+
+    def _link_file(self, path, file, ctx):
+        if self.version < 4:
+            return False
+        file.seek(0, 0)
+        sha = hashing.new(self.hash_name)
+        for chunk in iter(lambda: file.read(self.CHUNK_SIZE), b''):
+            sha.update(chunk)
+        return self.link(path, file.tell(), sha.digest(), ctx)
+
+    def upload_resumable(self, path, file, ctx=None, *, retries=3,
+                         dedup=False):
+        """
+        Like :meth:`.upload`, but continues where it stopped, if the connection
+        to the server breaks during the upload. The connection is
+        re-established at most *retries* times. This only happens if this is
+        the first upload of the current transaction, though, since all other
+        uploads are discarded by the server once the connection is lost.
+
+        Falls back to a regular :meth:`.upload`, if the server does not
+        support resumable uploads. The *dedup* parameter has the same meaning
+        as for :meth:`.upload`.
+        """
+        if self.conf.host is None:
+            raise UploadFailed('No server configured')
+        if self.version < 3:
+            return self.upload(path, file, ctx, dedup=dedup)
+        if not isinstance(path, bytes):
+            path = path.encode('UTF-8')
+        if dedup and self._link_file(path, file, ctx):
+            return
+        token = os.urandom(16)
+        file.seek(0, 2)
+        length = file.tell()
+        while True:
+            try:
+                response = self._upload_resumable(path, file, length, token)
+                break
+            except (RuntimeError, OSError) as e:
+                if self._pending or retries <= 0:
+                    raise UploadFailed(path) from e
+                retries -= 1
+                log.debug('resuming upload of {}'.format(path))
+                self.socket.close()
+                self._connect()
+                self._hello()
+                if self.version < 3:
+                    raise UploadFailed(path) from e
+        if response != Constants.RESP_OK:
+            raise UploadFailed(path)
+        self._pending = True
+        if ctx:
+            _CtxDataManager.join(self, ctx.tx_manager)
+
+    def _upload_resumable(self, path, file, length, token):
+        data = struct.pack('b', Constants.REQ_UPLOAD_RESUMABLE)
+        data += struct.pack('!i', len(path))
+        data += path
+        data += struct.pack('!q', length)
+        data += token
+        self._send(data)
+        response, offset = struct.unpack('!bq', self._read(9))
+        if response != Constants.RESP_OK:
+            return response
+        file.seek(0, 0)
+        sha = hashing.new(self.hash_name)
+        while True:
+            chunk = file.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            self._send(chunk[offset:])
+            offset = 0
+        self._send(sha.digest())
+        return struct.unpack('b', self._read(1))[0]
+
     def prepare(self):
         """
         Prepares the current transaction. Raises *CommitFailed* if the server
@@ -134,6 +517,7 @@ class NetfsConnection:
         if self.conf.host is None:
             return
         self._send(struct.pack('b', Constants.REQ_COMMIT))
+        self._pending = False
         response = struct.unpack('b', self._read(1))[0]
         if response != Constants.RESP_OK:
             raise CommitFailed()
@@ -144,38 +528,325 @@ class NetfsConnection:
         """
         if self.conf.host is None:
             return
+        self._pending = False
         self._send(struct.pack('b', Constants.REQ_ROLLBACK))
 
     def download(self, path, file, retry=1):
         """
         Downloads the file with given *path* from the server and writes it into
         the :term:`file object` *file*.
+
+        If the file is currently being uploaded, the download fails, unless
+        the :confkey:`download_wait` configuration allows waiting for the
+        upload to finish.
         """
         if self.conf.host is None:
             raise DownloadFailed('No server configured')
         if not isinstance(path, bytes):
             path = path.encode('UTF-8')
-        data = struct.pack('b', Constants.REQ_DOWNLOAD)
+        self._send_download(path)
+        found, time = self._read_download(file)
+        if not found:
+            raise DownloadFailed(path)
+        if time is None:
+            if retry > 0:
+                return self.download(path, file, retry - 1)
+            raise DownloadFailed(path)
+        return time
+
+    def download_many(self, files, *, window=16):
+        """
+        Downloads many files like :meth:`.download`, but sends up to *window*
+        requests ahead of the responses, instead of waiting for each file
+        before requesting the next one. The *files* must be an iterable of
+        `(path, file)` tuples.
+
+        Returns a dict mapping each path to the modification time of its file,
+        or to `None`, if the file does not exist on the server.
+        """
+        if self.conf.host is None:
+            raise DownloadFailed('No server configured')
+        queue = deque()
+        result = {}
+        corrupt = []
+
+        def read_response():
+            path, file = queue.popleft()
+            found, time = self._read_download(file)
+            if not found:
+                result[path] = None
+            elif time is None:
+                corrupt.append((path, file))
+            else:
+                result[path] = time
+
+        for path, file in files:
+            if len(queue) >= window:
+                read_response()
+            encoded = path
+            if not isinstance(path, bytes):
+                encoded = path.encode('UTF-8')
+            self._send_download(encoded)
+            queue.append((path, file))
+        while queue:
+            read_response()
+        for path, file in corrupt:
+            file.seek(0)
+            file.truncate()
+            result[path] = self.download(path, file)
+        return result
+
+    def _send_download(self, path):
+        data = b''
+        if self._waiting_downloads():
+            # the download is only processed after the wait request
+            data += struct.pack('b', Constants.REQ_WAIT)
+            data += struct.pack('!i', len(path))
+            data += path
+            data += struct.pack('!I', int(self.conf.download_wait * 1000))
+        if self._compressed_downloads():
+            data += struct.pack('b', Constants.REQ_DOWNLOAD_COMPRESSED)
+        else:
+            data += struct.pack('b', Constants.REQ_DOWNLOAD)
         data += struct.pack('!i', len(path))
         data += path
+        if self._compressed_downloads():
+            data += struct.pack('!B', len(self.conf.compression))
+            data += bytes(self.conf.compression)
         self._send(data)
+
+    def _compressed_downloads(self):
+        return self.version >= 8 and bool(self.conf.compression)
+
+    def _waiting_downloads(self):
+        return self.version >= 11 and self.conf.download_wait > 0
+
+    def _read_download(self, file):
+        """
+        Reads the response to a download request and writes the file content
+        into *file*. Returns a tuple, whose first value tells whether the file
+        was found. The second value is the modification time of the file, or
+        `None`, if the content did not match its hash.
+        """
+        if self._waiting_downloads():
+            # the download itself tells whether the upload is still ongoing
+            self._read(1)
         response = struct.unpack('b', self._read(1))[0]
         if response != Constants.RESP_OK:
-            raise DownloadFailed(path)
+            return False, None
         length = struct.unpack('!q', self._read(8))[0]
-        sha = hashlib.sha512()
+        sha = hashing.new(self.hash_name)
+        codec = compression.NONE
+        if self._compressed_downloads():
+            codec = struct.unpack('!B', self._read(1))[0]
+        if codec != compression.NONE:
+            valid = self._read_blocks(file, codec, sha)
+        else:
+            valid = True
+            while length:
+                chunk_size = min(self.CHUNK_SIZE, length)
+                chunk = self._read(chunk_size)
+                sha.update(chunk)
+                file.write(chunk)
+                length -= chunk_size
+        hash = self._read(sha.digest_size)
+        time = struct.unpack('!i', self._read(4))[0]
+        if not valid or sha.digest() != hash:
+            return True, None
+        return True, time
+
+    def _read_blocks(self, file, codec, sha):
+        """
+        Reads the blocks of a compressed download and writes their content
+        into *file*. Returns `False`, if a block could not be decompressed.
+        The remaining blocks are read nonetheless, so that the connection can
+        be used further.
+        """
+        valid = True
+        while True:
+            length = struct.unpack('!I', self._read(4))[0]
+            if not length:
+                return valid
+            if length > compression.MAX_BLOCK_SIZE:
+                raise RuntimeError("oversized block")
+            block = self._read(length)
+            if not valid:
+                continue
+            try:
+                chunk = compression.decompress(codec, block)
+            except compression.CorruptBlock:
+                valid = False
+                continue
+            sha.update(chunk)
+            file.write(chunk)
+
+    def download_range(self, path, file, offset=0, length=None):
+        """
+        Downloads *length* bytes of the file with given *path*, starting at
+        *offset*, and writes them into the :term:`file object` *file*. The
+        whole remainder of the file is downloaded, if *length* is `None`.
+
+        Returns a :class:`.FileStat` describing the whole file. Its digest can
+        be used to verify the file, once all parts have been downloaded.
+        """
+        if self.conf.host is None:
+            raise DownloadFailed('No server configured')
+        if self.version < 2:
+            raise DownloadFailed('Server does not support ranged downloads')
+        if not isinstance(path, bytes):
+            path = path.encode('UTF-8')
+        if length is None:
+            length = -1
+        data = struct.pack('b', Constants.REQ_DOWNLOAD_RANGE)
+        data += struct.pack('!i', len(path))
+        data += path
+        data += struct.pack('!qq', offset, length)
+        self._send(data)
+        response = struct.unpack('b', self._read(1))[0]
+        if response != Constants.RESP_OK:
+            raise DownloadFailed(path)
+        size, length = struct.unpack('!qq', self._read(16))
+        sha = hashing.new(self.hash_name)
         while length:
             chunk_size = min(self.CHUNK_SIZE, length)
             chunk = self._read(chunk_size)
             sha.update(chunk)
             file.write(chunk)
             length -= chunk_size
-        hash = self._read(512 // 8)
+        hash = self._read(sha.digest_size)
+        digest = self._read(sha.digest_size)
+        mtime = struct.unpack('!i', self._read(4))[0]
         if sha.digest() != hash:
-            if retry > 0:
-                return self.download(path, file, retry - 1)
             raise DownloadFailed(path)
-        return struct.unpack('!i', self._read(4))[0]
+        return FileStat(size, mtime, digest)
+
+    def stat_many(self, paths):
+        """
+        Retrieves information about all files with given *paths* in a single
+        request. Returns a dict mapping each path to a :class:`.FileStat`, or
+        to `None`, if the file does not exist, or is currently being uploaded.
+        """
+        if self.conf.host is None:
+            raise DownloadFailed('No server configured')
+        if self.version < 5:
+            raise DownloadFailed('Server does not support stat requests')
+        paths = list(paths)
+        names = []
+        for path in paths:
+            if not isinstance(path, bytes):
+                path = path.encode('UTF-8')
+            names.append(struct.pack('!i', len(path)))
+            names.append(path)
+        names = b''.join(names)
+        data = struct.pack('b', Constants.REQ_STAT)
+        data += struct.pack('!ii', len(paths), len(names))
+        self._send(data + names)
+        response = struct.unpack('b', self._read(1))[0]
+        if response != Constants.RESP_OK:
+            raise DownloadFailed()
+        header = struct.Struct('!bqi')
+        record_size = header.size + hashing.digest_size(self.hash_name)
+        records = self._read(len(paths) * record_size)
+        result = {}
+        for i, path in enumerate(paths):
+            record = records[i * record_size:(i + 1) * record_size]
+            status, size, mtime = header.unpack(record[:header.size])
+            if status == Constants.RESP_OK:
+                result[path] = FileStat(size, mtime, record[header.size:])
+            else:
+                result[path] = None
+        return result
+
+    def list_files(self, prefix='', *, page_size=1000):
+        """
+        Generates `(path, size, mtime)` tuples of all files on the server,
+        whose path starts with given *prefix*, in sorted order. The files are
+        requested in pages of *page_size* entries, so other requests may be
+        sent while iterating.
+        """
+        if self.conf.host is None:
+            raise DownloadFailed('No server configured')
+        if self.version < 6:
+            raise DownloadFailed('Server does not support list requests')
+        if not isinstance(prefix, bytes):
+            prefix = prefix.encode('UTF-8')
+        cursor = b''
+        while True:
+            entries, more = self._list_page(prefix, cursor, page_size)
+            for path, size, mtime in entries:
+                yield str(path, 'UTF-8'), size, mtime
+            if not more or not entries:
+                return
+            cursor = entries[-1][0]
+
+    def _list_page(self, prefix, cursor, limit):
+        data = struct.pack('b', Constants.REQ_LIST)
+        data += struct.pack('!i', len(prefix))
+        data += prefix
+        data += struct.pack('!i', len(cursor))
+        data += cursor
+        data += struct.pack('!i', limit)
+        self._send(data)
+        response = struct.unpack('b', self._read(1))[0]
+        if response != Constants.RESP_OK:
+            raise DownloadFailed()
+        more, count, length = struct.unpack('!Bii', self._read(9))
+        records = self._read(length)
+        header = struct.Struct('!qii')
+        entries = []
+        offset = 0
+        for _ in range(count):
+            size, mtime, path_length = header.unpack_from(records, offset)
+            offset += header.size
+            entries.append((records[offset:offset + path_length], size, mtime))
+            offset += path_length
+        return entries, bool(more)
+
+    def stats(self):
+        """
+        Returns the :ref:`metrics <netfs_protocol_stats>` of the server as
+        text.
+        """
+        if self.conf.host is None:
+            raise DownloadFailed('No server configured')
+        if self.version < 10:
+            raise DownloadFailed('Server does not support stats requests')
+        self._send(struct.pack('b', Constants.REQ_STATS))
+        response, length = struct.unpack('!bI', self._read(5))
+        if response != Constants.RESP_OK:
+            raise DownloadFailed()
+        return str(self._read(length), 'UTF-8')
+
+    def ping(self):
+        """
+        Sends a :ref:`ping <netfs_protocol_ping>` request and waits for the
+        server's response.
+        """
+        if self.conf.host is None:
+            raise DownloadFailed('No server configured')
+        if self.version < 12:
+            raise DownloadFailed('Server does not support ping requests')
+        self._send(struct.pack('b', Constants.REQ_PING))
+        response = struct.unpack('b', self._read(1))[0]
+        if response != Constants.RESP_OK:
+            raise DownloadFailed()
+
+    def _resume_download(self, path, file, tmpfile, offset):
+        """
+        Appends the missing part of a file to the incomplete download in
+        *file* and returns the file's modification time. Returns `None`, if
+        the result does not match the file on the server.
+        """
+        stat = self.download_range(path, file, offset)
+        file.flush()
+        sha = hashing.new(self.hash_name)
+        with open(tmpfile, 'rb') as local:
+            for chunk in iter(lambda: local.read(self.CHUNK_SIZE), b''):
+                sha.update(chunk)
+        if sha.digest() != stat.digest:
+            log.debug('resumed download of {} is corrupt'.format(path))
+            return None
+        return stat.mtime
 
     def _send(self, data):
         log.debug('sending: {}'.format(data))
@@ -199,6 +870,19 @@ class NetfsConnection:
         return b''.join(chunks)
 
 
+def _map_file(file):
+    """
+    Returns the content of given :term:`file object` as a bytes-like object,
+    mapping it into memory if possible.
+    """
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        # not a regular file, or an empty one
+        file.seek(0, 0)
+        return file.read()
+
+
 @implementer(IDataManager)
 class _CtxDataManager:
     """
@@ -25,10 +25,15 @@
 # Licensee has his registered seat, an establishment or assets.
 
 import logging
+import os
 import shutil
+import threading
+from . import address, compression, hashing
 from ._connection import NetfsConnection
+from ._multiplex import Multiplexer, MultiplexUnsupported
 from score.init import (
-    init_cache_folder, ConfiguredModule, parse_host_port, parse_bool)
+    init_cache_folder, ConfiguredModule, ConfigurationError, parse_host_port,
+    parse_bool, parse_list)
 import tempfile
 
 
@@ -39,6 +44,10 @@ defaults = {
     'server': 'localhost:14000',
     'cachedir': None,
     'deltmpcache': True,
+    'hashes': None,
+    'multiplex': False,
+    'compression': None,
+    'download_wait': 0,
     'ctx.member': 'netfs',
 }
 
@@ -50,7 +59,8 @@ def init(confdict, ctx=None):
 
     :confkey:`server` :faint:`[default=localhost:14000]`
         The server to connect to for all remote operations. Read using the
-        generic :func:`score.init.parse_host_port`.
+        generic :func:`score.init.parse_host_port`, unless the value is the
+        path to a Unix domain socket given as ``unix:/path/to/socket``.
 
         The special value ``None`` indicates that all remote operations will
         immediately raise an exception. It is still possible to use higher
@@ -75,11 +85,49 @@ def init(confdict, ctx=None):
         want to operate on a temporary folder, but still keep its contents when
         you are done with this module.
 
+    :confkey:`hashes` :faint:`[default=blake2b sha256 sha512 blake2s]`
+        The hash algorithms for verifying transfers, in order of preference.
+        The algorithm actually used is negotiated with the server when
+        connecting. Servers that do not support this negotiation will always
+        use ``sha512``.
+
+        Which algorithm performs best depends on the hardware: ``sha256`` is
+        usually the fastest on CPUs with dedicated SHA instructions, while
+        ``blake2b`` is faster everywhere else.
+
+    :confkey:`multiplex` :faint:`[default=False]`
+        Whether all connections of this process should share a single TCP
+        connection to the server. Every :class:`.NetfsConnection` then uses a
+        stream of its own on that connection, so a large transfer in one
+        thread no longer blocks the requests of other threads behind it. See
+        :ref:`multiplexed mode <netfs_protocol_multiplex>` for details.
+
+        Servers, that do not support multiplexing, are connected to as usual.
+
+    :confkey:`compression` :faint:`[default=None]`
+        The codecs for compressing transferred files, in order of preference.
+        Supported values are ``zlib`` and ``lzma``. Uploads are compressed
+        with the first codec, while the server chooses one of the given codecs
+        for each download. Files in formats that are compressed already, like
+        images, and files that do not compress well are always transferred
+        as they are.
+
+        Compression pays off on slow networks, but costs CPU time on both
+        sides, which is why it is disabled by default.
+
+    :confkey:`download_wait` :faint:`[default=0]`
+        The number of seconds a download may wait for an upload of the same
+        file, that was not committed yet. The server responds as soon as the
+        upload is committed or aborted, instead of letting the download fail
+        right away. See :ref:`wait <netfs_protocol_wait>` for details.
+
     """
     conf = dict(defaults.items())
     conf.update(confdict)
     if conf['server'] in (None, 'None'):
         host, port = None, None
+    elif address.unix_path(conf['server']) is not None:
+        host, port = conf['server'], None
     else:
         host, port = parse_host_port(conf['server'], defaults['server'])
     cachedir = None
@@ -88,7 +136,28 @@ def init(confdict, ctx=None):
         cachedir = init_cache_folder(conf, 'cachedir')
     else:
         delcache = parse_bool(conf['deltmpcache'])
-    c = ConfiguredNetfsModule(host, port, cachedir, delcache)
+    if conf['hashes']:
+        hashes = tuple(parse_list(conf['hashes']))
+        for name in hashes:
+            if name not in hashing.ALGORITHMS:
+                raise ConfigurationError(
+                    __package__, 'Unsupported hash algorithm "%s"' % name)
+    else:
+        hashes = hashing.ALGORITHMS
+    try:
+        codecs = compression.parse(parse_list(conf['compression'] or ''))
+    except ValueError as e:
+        raise ConfigurationError(__package__, str(e))
+    try:
+        download_wait = float(conf['download_wait'])
+    except ValueError:
+        raise ConfigurationError(__package__, 'Invalid download_wait')
+    if download_wait < 0:
+        raise ConfigurationError(__package__, 'Invalid download_wait')
+    c = ConfiguredNetfsModule(host, port, cachedir, delcache, hashes,
+                              multiplex=parse_bool(conf['multiplex']),
+                              compression=codecs,
+                              download_wait=download_wait)
     c.ctx_conf = ctx
     if ctx and conf['ctx.member'] not in ('None', None):
         ctx.register(conf['ctx.member'], lambda _: c.connect())
@@ -101,12 +170,20 @@ class ConfiguredNetfsModule(ConfiguredModule):
     <score.init.ConfiguredModule>`.
     """
 
-    def __init__(self, host, port, cachedir, delcache):
+    def __init__(self, host, port, cachedir, delcache,
+                 hashes=hashing.ALGORITHMS, *, multiplex=False,
+                 compression=(), download_wait=0):
         super().__init__(__package__)
         self.host = host
         self.port = port
         self._cachedir = cachedir
         self.delcache = delcache
+        self.hashes = hashes
+        self.multiplex = multiplex
+        self.compression = compression
+        self.download_wait = download_wait
+        self._multiplexer = None
+        self._multiplexer_lock = threading.Lock()
 
     def __del__(self):
         if self.delcache and self._cachedir:
@@ -124,3 +201,21 @@ class ConfiguredNetfsModule(ConfiguredModule):
         :class:`.NetfsConnection`.
         """
         return NetfsConnection(self)
+
+    def _open_stream(self):
+        """
+        Opens a new stream on the multiplexed connection shared by this
+        process. Returns `None` if the server does not support multiplexing.
+        """
+        with self._multiplexer_lock:
+            mux = self._multiplexer
+            # a forked process must not share the connection of its parent
+            if mux is None or mux.closed or mux.pid != os.getpid():
+                try:
+                    mux = Multiplexer(self.host, self.port)
+                except MultiplexUnsupported:
+                    log.info('server does not support multiplexing')
+                    self.multiplex = False
+                    return None
+                self._multiplexer = mux
+        return mux.open()
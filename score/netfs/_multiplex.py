@@ -0,0 +1,206 @@
+from collections import deque
+import errno
+import logging
+import os
+import struct
+import threading
+import weakref
+from . import address
+from .constants import Constants
+
+
+log = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!IBI')
+
+
+class MultiplexUnsupported(Exception):
+    pass
+
+
+class Multiplexer:
+    """
+    A connection to a netfs server in :ref:`multiplexed mode
+    <netfs_protocol_multiplex>`, which carries any number of concurrent
+    streams. Each stream is a :class:`_VirtualSocket`, which may be used by a
+    single thread at a time.
+
+    Incoming frames are distributed among the streams by a background thread.
+    Raises :class:`MultiplexUnsupported` if the server does not support
+    multiplexing.
+    """
+
+    WINDOW = 1024 * 256
+
+    MAX_FRAME_SIZE = 1024 * 16
+
+    def __init__(self, host, port):
+        self.socket = address.connect(host, port)
+        try:
+            self.socket.sendall(struct.pack(
+                '!bI', Constants.REQ_MULTIPLEX, self.WINDOW))
+            status, self.peer_window = struct.unpack('!bI', self._recv(5))
+        except (RuntimeError, OSError) as e:
+            self.socket.close()
+            raise MultiplexUnsupported() from e
+        if status != Constants.RESP_OK:
+            self.socket.close()
+            raise MultiplexUnsupported()
+        self.pid = os.getpid()
+        self.closed = False
+        self.streams = weakref.WeakValueDictionary()
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # ids of streams, that were garbage collected without being closed
+        self.abandoned = deque()
+        self.thread = threading.Thread(target=self._receive, daemon=True)
+        self.thread.start()
+
+    def open(self):
+        """
+        Opens a new stream and returns it.
+        """
+        # the server discards frames of streams with ids lower than that of
+        # the latest stream, so streams must be announced in order
+        with self.send_lock:
+            with self.lock:
+                if self.closed:
+                    raise OSError(errno.ENOTCONN,
+                                  'multiplexed connection closed')
+                stream = _VirtualSocket(self, self.next_id)
+                self.streams[stream.id] = stream
+                self.next_id += 1
+            self.socket.sendall(
+                FRAME_HEADER.pack(stream.id, Constants.FRAME_DATA, 0))
+        return stream
+
+    def send_frame(self, stream_id, frame_type, payload=b''):
+        """
+        Sends a single frame. Frames of different threads never interleave.
+        """
+        with self.send_lock:
+            data = b''
+            while self.abandoned:
+                data += FRAME_HEADER.pack(
+                    self.abandoned.popleft(), Constants.FRAME_CLOSE, 0)
+            data += FRAME_HEADER.pack(stream_id, frame_type, len(payload))
+            self.socket.sendall(data + payload)
+
+    def remove(self, stream):
+        with self.lock:
+            self.streams.pop(stream.id, None)
+
+    def _recv(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                raise RuntimeError("socket connection broken")
+            data += chunk
+        return data
+
+    def _receive(self):
+        try:
+            while True:
+                stream_id, frame_type, length = FRAME_HEADER.unpack(
+                    self._recv(FRAME_HEADER.size))
+                payload = self._recv(length)
+                with self.lock:
+                    if frame_type == Constants.FRAME_CLOSE:
+                        stream = self.streams.pop(stream_id, None)
+                    else:
+                        stream = self.streams.get(stream_id)
+                if stream is not None:
+                    stream._frame(frame_type, payload)
+        except (RuntimeError, OSError) as e:
+            log.debug('multiplexed connection closed: {}'.format(e))
+        with self.lock:
+            self.closed = True
+            streams = list(self.streams.values())
+            self.streams.clear()
+        self.socket.close()
+        for stream in streams:
+            stream._frame(Constants.FRAME_CLOSE, b'')
+
+
+class _VirtualSocket:
+    """
+    A single stream of a :class:`Multiplexer`. Provides the parts of the
+    :class:`socket.socket` interface, that are used by
+    :class:`.NetfsConnection`.
+    """
+
+    def __init__(self, mux, stream_id):
+        self.mux = mux
+        self.id = stream_id
+        self.send_window = mux.peer_window
+        self.buffer = bytearray()
+        self.consumed = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __del__(self):
+        if not self.closed:
+            # sending a frame right here might interfere with a frame, that
+            # is being sent by this very thread
+            self.mux.abandoned.append(self.id)
+
+    def send(self, data):
+        with self.condition:
+            while not self.send_window and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise OSError(errno.EPIPE, 'stream closed')
+            length = min(len(data), self.send_window, self.mux.MAX_FRAME_SIZE)
+            self.send_window -= length
+        self.mux.send_frame(self.id, Constants.FRAME_DATA,
+                            bytes(data[:length]))
+        return length
+
+    def sendall(self, data):
+        data = memoryview(data)
+        while data:
+            data = data[self.send(data):]
+
+    def recv(self, bufsize):
+        with self.condition:
+            while not self.buffer and not self.closed:
+                self.condition.wait()
+            data = bytes(self.buffer[:bufsize])
+            del self.buffer[:bufsize]
+            self.consumed += len(data)
+            if self.closed or self.consumed < self.mux.WINDOW // 2:
+                return data
+            window, self.consumed = self.consumed, 0
+        self.mux.send_frame(self.id, Constants.FRAME_WINDOW,
+                            struct.pack('!I', window))
+        return data
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.mux.remove(self)
+        try:
+            self.mux.send_frame(self.id, Constants.FRAME_CLOSE)
+        except OSError:
+            pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def _frame(self, frame_type, payload):
+        with self.condition:
+            if frame_type == Constants.FRAME_DATA:
+                self.buffer += payload
+            elif frame_type == Constants.FRAME_WINDOW:
+                self.send_window += struct.unpack('!I', payload)[0]
+            elif frame_type == Constants.FRAME_CLOSE:
+                self.closed = True
+            self.condition.notify_all()
@@ -0,0 +1,121 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+Addresses of netfs servers, which are either a host and a port, or the path
+to a Unix domain socket. The latter is given as ``unix:/path/to/socket``,
+which is kept as the *host* of the address, while its *port* is `None`.
+"""
+
+import socket
+
+
+#: The prefix of addresses of Unix domain sockets.
+UNIX_PREFIX = 'unix:'
+
+
+def unix_path(host):
+    """
+    Returns the path of the Unix domain socket designated by given *host*, or
+    `None`, if the *host* is a network address.
+    """
+    if host is not None and host.startswith(UNIX_PREFIX):
+        return host[len(UNIX_PREFIX):]
+    return None
+
+
+def parse(value, default_port=14000):
+    """
+    Parses an address given as ``host:port``, ``host`` or
+    ``unix:/path/to/socket`` and returns its host and its port.
+    """
+    if unix_path(value) is not None:
+        return value, None
+    host, _, port = value.rpartition(':')
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+def describe(host, port):
+    """
+    Returns the textual representation of an address, which is understood by
+    :func:`parse`.
+    """
+    if unix_path(host) is not None:
+        return host
+    return '{}:{}'.format(host, port)
+
+
+def create_socket(host):
+    """
+    Returns a new, unconnected stream socket for connecting to *host*.
+    """
+    if unix_path(host) is not None:
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+def socket_address(host, port):
+    """
+    Returns the address to pass to :meth:`socket.socket.connect`.
+    """
+    path = unix_path(host)
+    if path is not None:
+        return path
+    return host, port
+
+
+def connect(host, port):
+    """
+    Returns a blocking socket connected to given address. Small writes are
+    sent right away.
+    """
+    path = unix_path(host)
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def bind(host, port):
+    """
+    Returns a list of listening sockets for given address, as expected by
+    :meth:`tornado.tcpserver.TCPServer.add_sockets`. Unix domain sockets are
+    accessible to all local users, just like a network address.
+    """
+    from tornado.netutil import bind_sockets, bind_unix_socket
+    path = unix_path(host)
+    if path is not None:
+        return [bind_unix_socket(path, mode=0o666)]
+    return bind_sockets(port, address=host)
@@ -28,6 +28,7 @@ import click
 import logging
 import logging.config
 import score.netfs as netfs
+from score.netfs import address
 import score.init
 import os.path
 
@@ -50,18 +51,81 @@ def main():
 
 
 @main.command('serve')
-@click.option('-h', '--host', default='0.0.0.0')
+@click.option('-h', '--host', default='0.0.0.0',
+              help='Address to listen on, or unix:/path/to/socket')
 @click.option('-p', '--port', default=14000)
+@click.option('-t', '--io-threads', default=4, type=click.IntRange(1),
+              help='Number of threads for disk operations')
+@click.option('-w', '--workers', default=1, type=click.IntRange(0),
+              help='Number of server processes, 0 for one per CPU')
+@click.option('-d', '--durable', is_flag=True,
+              help='Flush committed files to disk')
+@click.option('-c', '--cache-size', default=0, type=click.IntRange(0),
+              help='Bytes of small files to keep in memory')
+@click.option('-m', '--metrics-port', type=int,
+              help='Port serving the metrics as plain text')
+@click.option('--http-port', type=int,
+              help='Port serving the files via HTTP')
 @click.option('-l', '--logconf',
               type=click.Path(file_okay=True, dir_okay=False))
 @click.argument('folder', type=click.Path(file_okay=False, dir_okay=True))
-def serve(folder, host, port, logconf=None):
+def serve(folder, host, port, io_threads, workers, durable, cache_size,
+          metrics_port=None, http_port=None, logconf=None):
     init_logging(logconf)
+    options = {'io_threads': io_threads, 'durable': durable,
+               'cache_size': cache_size}
+    run_server(folder, host, port, workers, options, metrics_port, http_port)
+
+
+def run_server(folder, host, port, workers, options, metrics_port=None,
+               http_port=None):
+    """
+    Starts a :class:`StorageServer <score.netfs.server.StorageServer>` with
+    given *options*. If the number of *workers* is not 1, the listening socket
+    is created first and shared among that many forked processes.
+
+    If a *metrics_port* is given, the server's metrics are made available
+    there via :func:`score.netfs.metrics.listen`. As every worker keeps
+    metrics of its own, the worker with task id *n* listens on
+    *metrics_port* + *n*.
+
+    If an *http_port* is given, the files are made available via HTTP as
+    well, using the :mod:`score.netfs.gateway`. The HTTP socket is shared
+    among all workers, just like the netfs socket.
+
+    The *host* may also be a Unix domain socket given as
+    ``unix:/path/to/socket``, in which case the *port* is ignored and the
+    metrics and the HTTP gateway listen on the loopback interface.
+    """
+    from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
+    from tornado.netutil import bind_sockets
+    from tornado.process import fork_processes
+    from . import gateway, metrics
     from .server import StorageServer
     try:
-        server = StorageServer(folder)
-        server.listen(port, address=host)
+        sockets = address.bind(host, port)
+        if http_port is not None:
+            http_sockets = bind_sockets(http_port, address=_http_host(host))
+        if workers != 1:
+            # all processes share a journal of their changes, that starts out
+            # empty, as each process scans the folder on startup
+            options = dict(options, index_journal=True)
+            journal = StorageServer.journal_path(os.path.realpath(folder))
+            os.makedirs(os.path.dirname(journal), exist_ok=True)
+            open(journal, 'wb').close()
+            # the IOLoop and the thread pool of the server must not exist
+            # before this call, as neither of them survives a fork
+            task_id = fork_processes(workers)
+        else:
+            task_id = 0
+        server = StorageServer(folder, **options)
+        server.add_sockets(sockets)
+        if metrics_port is not None:
+            metrics.listen(server.metrics, metrics_port + task_id,
+                           _http_host(host))
+        if http_port is not None:
+            HTTPServer(gateway.application(server)).add_sockets(http_sockets)
         IOLoop.instance().start()
         IOLoop.instance().close()
     except Exception as e:
@@ -69,6 +133,16 @@ def serve(folder, host, port, logconf=None):
         raise
 
 
+def _http_host(host):
+    """
+    Returns the address the HTTP listeners should bind to, when the netfs
+    server or proxy listens on given *host*.
+    """
+    if address.unix_path(host) is not None:
+        return '127.0.0.1'
+    return host
+
+
 def read_server_conf(section):
     try:
         folder = section['folder']
@@ -87,6 +161,88 @@ def read_server_conf(section):
     return folder, host, port
 
 
+def read_server_workers(section):
+    try:
+        workers = int(section['workers'])
+    except KeyError:
+        return 1
+    except ValueError:
+        raise click.ClickException('Configured workers could not be parsed')
+    if workers < 0:
+        raise click.ClickException('Configured workers must not be negative')
+    return workers
+
+
+def read_http_port(section):
+    try:
+        return int(section['http_port'])
+    except KeyError:
+        return None
+    except ValueError:
+        raise click.ClickException('Configured http_port could not be parsed')
+
+
+def read_metrics_port(section):
+    try:
+        return int(section['metrics_port'])
+    except KeyError:
+        return None
+    except ValueError:
+        raise click.ClickException(
+            'Configured metrics_port could not be parsed')
+
+
+def read_server_options(section):
+    options = {}
+    try:
+        options['io_threads'] = int(section['io_threads'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException('Configured io_threads could not be parsed')
+    try:
+        options['max_index_entries'] = int(section['max_index_entries'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException(
+            'Configured max_index_entries could not be parsed')
+    try:
+        options['partial_ttl'] = int(section['partial_ttl'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException(
+            'Configured partial_ttl could not be parsed')
+    try:
+        options['durable'] = score.init.parse_bool(section['durable'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException('Configured durable could not be parsed')
+    for key in ('cache_size', 'cache_file_size', 'preallocate_size',
+                'bandwidth', 'connection_bandwidth', 'upload_bandwidth',
+                'download_bandwidth', 'metadata_entries', 'metadata_folders'):
+        try:
+            options[key] = int(section[key])
+        except KeyError:
+            pass
+        except ValueError:
+            raise click.ClickException(
+                'Configured %s could not be parsed' % key)
+    try:
+        options['download_priority'] = float(section['download_priority'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException(
+            'Configured download_priority could not be parsed')
+    if options.get('download_priority', 1) <= 0:
+        raise click.ClickException('Configured download_priority must be '
+                                   'positive')
+    return options
+
+
 @main.command('serve-conf')
 @click.argument('conf', type=click.Path(file_okay=True, dir_okay=False))
 @click.argument('name', required=False)
@@ -100,9 +256,34 @@ def serve_conf(conf, name=None):
     following keys:
 
     \b
-    - `host` (default: 0.0.0.0)
+    - `host` (default: 0.0.0.0, or unix:/path/to/socket)
     - `port` (default: 14000)
-    - `folder` (required, no default).
+    - `folder` (required, no default)
+    - `io_threads` (default: 4)
+    - `partial_ttl` (default: 86400, seconds to keep interrupted uploads)
+    - `max_index_entries` (default: unlimited, number of files to list)
+    - `workers` (default: 1, use 0 for one process per CPU)
+    - `durable` (default: false, flush committed files to disk)
+    - `cache_size` (default: 0, bytes of small files to keep in memory)
+    - `cache_file_size` (default: 65536, largest file size to cache)
+    - `preallocate_size` (default: 1048576, smallest file size to allocate
+      in one piece)
+    - `bandwidth` (default: unlimited, bytes per second of all transfers)
+    - `connection_bandwidth` (default: unlimited, bytes per second of each
+      connection)
+    - `upload_bandwidth` (default: unlimited, bytes per second of all
+      uploads)
+    - `download_bandwidth` (default: unlimited, bytes per second of all
+      downloads)
+    - `download_priority` (default: 1, share of the bandwidth for downloads
+      relative to uploads)
+    - `metadata_entries` (default: 65536, number of files to cache the size,
+      modification time and hash of, 0 to disable)
+    - `metadata_folders` (default: 1024, number of folders to cache and
+      watch for changes)
+    - `metrics_port` (default: none, port serving the metrics as plain text,
+      incremented for each additional worker)
+    - `http_port` (default: none, port serving the files via HTTP).
 
     If an optional NAME is provided, the application will instead look into the
     section [server.NAME], but the expected configuration format does not
@@ -120,39 +301,66 @@ def serve_conf(conf, name=None):
         raise click.ClickException('Section "%s" not found in configuration'
                                    % section_name)
     folder, host, port = read_server_conf(section)
+    options = read_server_options(section)
+    workers = read_server_workers(section)
+    metrics_port = read_metrics_port(section)
+    http_port = read_http_port(section)
     if not os.path.isdir(folder):
         raise click.ClickException('Configured folder (%s) does not exist'
                                    % folder)
-    from tornado.ioloop import IOLoop
+    run_server(folder, host, port, workers, options, metrics_port, http_port)
+
+
+@main.command('migrate')
+@click.option('--layout', type=click.Choice(['flat', 'sharded']),
+              default='sharded', help='The new layout of the folder')
+@click.option('-l', '--logconf',
+              type=click.Path(file_okay=True, dir_okay=False))
+@click.argument('folder', type=click.Path(file_okay=False, dir_okay=True,
+                                          exists=True))
+def migrate(folder, layout, logconf=None):
+    """
+    Rearrange the files of a server folder.
+
+    The sharded layout spreads the files over many folders on disk, which
+    keeps each folder small, while clients still see the same file names.
+    No server may be running on the folder during the migration.
+    """
+    init_logging(logconf)
+    from . import storage
     from .server import StorageServer
+    root = os.path.realpath(folder)
+    meta = os.path.join(root, StorageServer.META_FOLDER)
     try:
-        server = StorageServer(folder)
-        server.listen(port, address=host)
-        IOLoop.instance().start()
-        IOLoop.instance().close()
-    except Exception as e:
-        log.exception(e)
-        raise
+        storage.migrate(root, meta, layout)
+    except storage.LayoutError as e:
+        raise click.ClickException(str(e))
 
 
 @main.command('proxy')
-@click.option('-h', '--host', default='0.0.0.0')
+@click.option('-h', '--host', default='0.0.0.0',
+              help='Address to listen on, or unix:/path/to/socket')
 @click.option('-p', '--port', default=14000, type=int)
-@click.option('-b', '--backend', multiple=True)
+@click.option('-b', '--backend', multiple=True,
+              help='Server given as host:port or unix:/path/to/socket')
+@click.option('-m', '--metrics-port', type=int,
+              help='Port serving the metrics as plain text')
 @click.option('-l', '--logconf',
               type=click.Path(file_okay=True, dir_okay=False))
-def proxy(host, port, backend, logconf=None):
+def proxy(host, port, backend, metrics_port=None, logconf=None):
     init_logging(logconf)
     from tornado.ioloop import IOLoop
+    from . import metrics
     from .proxy import ProxyServer
-    backends = []
-    for b in backend:
-        b = b.split(':')
-        b[1] = int(b[1])
-        backends.append(b)
+    try:
+        backends = [address.parse(b) for b in backend]
+    except ValueError:
+        raise click.ClickException('Backends could not be parsed')
     try:
         server = ProxyServer(backends)
-        server.listen(port, address=host)
+        server.add_sockets(address.bind(host, port))
+        if metrics_port is not None:
+            metrics.listen(server.metrics, metrics_port, _http_host(host))
         IOLoop.instance().start()
         IOLoop.instance().close()
     except Exception as e:
@@ -180,14 +388,37 @@ def read_proxy_conf(section):
     except KeyError:
         pass
     else:
-        backends = []
-        for b in backend_list:
-            b = b.split(':')
-            b[1] = int(b[1])
-            backends.append(b)
+        try:
+            backends = [address.parse(b) for b in backend_list]
+        except ValueError:
+            raise click.ClickException(
+                'Configured backends could not be parsed')
     return host, port, backends
 
 
+def read_proxy_options(section):
+    options = {}
+    try:
+        options['heartbeat'] = float(section['heartbeat'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException('Configured heartbeat could not be parsed')
+    if options.get('heartbeat', 1) < 0:
+        raise click.ClickException('Configured heartbeat must not be negative')
+    try:
+        options['misses'] = int(section['heartbeat_misses'])
+    except KeyError:
+        pass
+    except ValueError:
+        raise click.ClickException(
+            'Configured heartbeat_misses could not be parsed')
+    if options.get('misses', 1) <= 0:
+        raise click.ClickException('Configured heartbeat_misses must be '
+                                   'positive')
+    return options
+
+
 @main.command('proxy-conf')
 @click.argument('conf', type=click.Path(file_okay=True, dir_okay=False))
 def proxy_conf(conf, name=None):
@@ -198,9 +429,15 @@ def proxy_conf(conf, name=None):
     keys:
 
     \b
-    - `host` (default: 0.0.0.0)
+    - `host` (default: 0.0.0.0, or unix:/path/to/socket)
     - `port` (default: 14000)
-    - `backends` (default: see below).
+    - `backends` (default: see below, one host:port or unix:/path/to/socket
+      per line)
+    - `metrics_port` (default: none, port serving the metrics as plain text)
+    - `heartbeat` (default: 0.25, seconds between two pings of each backend,
+      use 0 to disable)
+    - `heartbeat_misses` (default: 4, number of missed pings, after which a
+      backend is considered down).
 
     If no such section is found or the section contains no backends definition,
     the configuration will be done using all other sections in the file, parsing
@@ -210,8 +447,12 @@ def proxy_conf(conf, name=None):
     conf = score.init.parse_config_file(conf)
     if 'loggers' in conf:
         logging.config.fileConfig(conf, disable_existing_loggers=False)
+    metrics_port = None
+    options = {}
     if 'proxy' in conf:
         host, port, backends = read_proxy_conf(conf['proxy'])
+        metrics_port = read_metrics_port(conf['proxy'])
+        options = read_proxy_options(conf['proxy'])
         if backends is None:
             log.debug('No backends configured, browsing all sections')
     else:
@@ -227,18 +468,22 @@ def proxy_conf(conf, name=None):
                 # the proxy host/port
                 _, h, p = read_server_conf(conf[section])
                 if (h, p) in backends:
-                    log.debug('Ignoring duplicate backend %s:%d' % (h, p))
+                    log.debug('Ignoring duplicate backend %s'
+                              % address.describe(h, p))
                     continue
-                log.debug('Adding backend %s:%d' % (h, p))
+                log.debug('Adding backend %s' % address.describe(h, p))
                 backends.append((h, p))
     if not backends:
         raise click.ClickException('No backends configured')
     from tornado.ioloop import IOLoop
+    from . import metrics
     from .proxy import ProxyServer
     try:
-        log.debug('Starting proxy at %s:%d' % (host, port))
-        server = ProxyServer(backends)
-        server.listen(port, address=host)
+        log.debug('Starting proxy at %s' % address.describe(host, port))
+        server = ProxyServer(backends, **options)
+        server.add_sockets(address.bind(host, port))
+        if metrics_port is not None:
+            metrics.listen(server.metrics, metrics_port, _http_host(host))
         IOLoop.instance().start()
         IOLoop.instance().close()
     except Exception as e:
@@ -255,7 +500,8 @@ def proxy_conf(conf, name=None):
 @click.argument('file', type=click.File(mode='wb'))
 def download(host, port, path, file, logconf=None):
     init_logging(logconf)
-    conf = netfs.init({'server': '{}:{}'.format(host, port), 'cachedir': '.'})
+    conf = netfs.init({'server': address.describe(host, port),
+                       'cachedir': '.'})
     conf.connect().download(path, file)
 
 
@@ -268,11 +514,28 @@ def download(host, port, path, file, logconf=None):
 @click.argument('file', type=click.Path(file_okay=True, dir_okay=False))
 def upload(host, port, path, file, logconf=None):
     init_logging(logconf)
-    conf = netfs.init({'server': '{}:{}'.format(host, port), 'cachedir': '.'})
+    conf = netfs.init({'server': address.describe(host, port),
+                       'cachedir': '.'})
     fp = open(file, 'rb')
     conn = conf.connect()
-    conn.upload(path, fp)
+    conn.upload_resumable(path, fp)
     conn.commit()
 
+
+@main.command('stats')
+@click.option('-l', '--logconf',
+              type=click.Path(file_okay=True, dir_okay=False))
+@click.argument('server', default='127.0.0.1:14000')
+def stats(server, logconf=None):
+    """
+    Print the metrics of a server or proxy.
+
+    The SERVER is given as HOST:PORT or unix:/path/to/socket and defaults to
+    127.0.0.1:14000.
+    """
+    init_logging(logconf)
+    conf = netfs.init({'server': server, 'cachedir': '.'})
+    click.echo(conf.connect().stats(), nl=False)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,141 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+The codecs available for compressing transferred files. The sender of a file
+chooses one of the codecs accepted by the receiver, or sends the file without
+compression, if its content does not compress well. See :ref:`compressed
+uploads <netfs_protocol_upload_compressed>` for details.
+
+Compressed content is transferred in blocks of at most `BLOCK_SIZE`
+uncompressed bytes, which are compressed independently of each other.
+"""
+
+import lzma
+import os
+import zlib
+
+
+NONE = 0
+
+ZLIB = 1
+
+LZMA = 2
+
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+
+BLOCK_SIZE = 1024 * 256
+
+#: The largest acceptable size of a single compressed block. Content that
+#: does not compress at all may grow slightly larger than `BLOCK_SIZE`.
+MAX_BLOCK_SIZE = BLOCK_SIZE + 1024 * 4
+
+#: File name extensions of formats, that are compressed already.
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    '.7z', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.jpeg',
+    '.jpg', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.pdf', '.png',
+    '.rar', '.webm', '.webp', '.woff', '.woff2', '.xlsx', '.xz', '.zip',
+    '.zst',
+))
+
+SAMPLE_SIZE = 1024 * 64
+
+
+class CorruptBlock(Exception):
+    pass
+
+
+def parse(names):
+    """
+    Converts the given codec *names*, like ``zlib``, into codec identifiers.
+    """
+    try:
+        return tuple(CODECS[name] for name in names)
+    except KeyError as e:
+        raise ValueError('Unsupported codec "%s"' % e.args[0])
+
+
+def choose(offered, supported=(ZLIB, LZMA)):
+    """
+    Returns the first codec in *offered*, that is also *supported*, or
+    `NONE`, if there is no such codec.
+    """
+    for codec in offered:
+        if codec in supported:
+            return codec
+    return NONE
+
+
+def compressible(path, sample):
+    """
+    Tells whether the content of the file with given *path* is worth
+    compressing. The *sample* is the beginning of the file's content, which
+    must compress to less than 90% of its size.
+    """
+    if isinstance(path, bytes):
+        path = str(path, 'UTF-8', 'replace')
+    extension = os.path.splitext(path)[1].lower()
+    if extension in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    sample = sample[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+
+def compress(codec, data):
+    """
+    Compresses a single block of *data* using given *codec*.
+    """
+    if codec == ZLIB:
+        return zlib.compress(data, 6)
+    elif codec == LZMA:
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=1)
+    raise ValueError('Unsupported codec %d' % codec)
+
+
+def decompress(codec, data):
+    """
+    Decompresses a single block compressed with given *codec*. Raises
+    :class:`CorruptBlock` if the *data* is invalid or decompresses to more
+    than `BLOCK_SIZE` bytes.
+    """
+    try:
+        if codec == ZLIB:
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, BLOCK_SIZE + 1)
+            finished = decompressor.eof
+        elif codec == LZMA:
+            decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+            result = decompressor.decompress(data, BLOCK_SIZE + 1)
+            finished = decompressor.eof
+        else:
+            raise CorruptBlock('Unsupported codec %d' % codec)
+    except (zlib.error, lzma.LZMAError) as e:
+        raise CorruptBlock(str(e))
+    if not finished or len(result) > BLOCK_SIZE:
+        raise CorruptBlock('Invalid block')
+    return result
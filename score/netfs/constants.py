@@ -27,13 +27,33 @@
 
 class Constants:
 
+    PROTOCOL_VERSION = 12
+
     REQ_UPLOAD = 1
     REQ_DOWNLOAD = 2
     REQ_PREPARE = 3
     REQ_COMMIT = 4
     REQ_ROLLBACK = 5
+    REQ_HELLO = 6
+    REQ_DOWNLOAD_RANGE = 7
+    REQ_UPLOAD_RESUMABLE = 8
+    REQ_LINK = 9
+    REQ_STAT = 10
+    REQ_LIST = 11
+    REQ_MULTIPLEX = 12
+    REQ_UPLOAD_COMPRESSED = 13
+    REQ_DOWNLOAD_COMPRESSED = 14
+    REQ_SIGNATURE = 15
+    REQ_UPLOAD_DELTA = 16
+    REQ_STATS = 17
+    REQ_WAIT = 18
+    REQ_PING = 19
 
     RESP_OK = 1
     RESP_UPLOADING = 2
     RESP_NOTFOUND = 3
     RESP_ERROR = 4
+
+    FRAME_DATA = 0
+    FRAME_WINDOW = 1
+    FRAME_CLOSE = 2
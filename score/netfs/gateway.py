@@ -0,0 +1,151 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+A read-only HTTP interface to the files of a :class:`StorageServer
+<score.netfs.server.StorageServer>`, so that browsers and caching proxies can
+fetch the files directly.
+"""
+
+import datetime
+import os
+import stat
+from tornado import gen
+from tornado.web import Application, HTTPError, StaticFileHandler
+from . import hashing
+
+
+class GatewayHandler(StaticFileHandler):
+    """
+    Serves the files of given *server* in response to GET and HEAD requests,
+    including requests for byte ranges.
+
+    The strong ETag of a file is the hexadecimal hash of its content
+    calculated with given *algorithm*, which is usually known already. Both
+    the ETag and the modification time of the file are honored in conditional
+    requests. Files currently being uploaded are answered with status 503.
+
+    The file is opened before the headers are sent, and the whole response is
+    read from that same file, so that all parts of the response match, even
+    if the file is replaced in the meantime. The content itself is read on
+    the IOLoop, just like in the parent class.
+    """
+
+    def initialize(self, server, algorithm=hashing.DEFAULT):
+        super().initialize(server.root)
+        self.server = server
+        self.algorithm = algorithm
+        self.file = None
+        self.stat = None
+        self.digest = None
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        try:
+            absolute_path = self.server.get_path(path)
+        except ValueError:
+            raise HTTPError(404)
+        status = yield self.server.executor.submit(self._open, absolute_path)
+        if status == 503:
+            # error responses would drop the header
+            self.set_status(503)
+            self.set_header('Retry-After', '1')
+        elif status is not None:
+            raise HTTPError(status)
+        else:
+            yield super().get(path, include_body)
+
+    def _open(self, path):
+        if self.server.is_uploading(path):
+            return 503
+        try:
+            file = self.server.open_file(path)
+        except OSError:
+            return 404
+        try:
+            file_stat = os.fstat(file.fileno())
+            if not stat.S_ISREG(file_stat.st_mode):
+                file.close()
+                return 404
+            self.digest = self.server.get_digest(path, file, file_stat,
+                                                 self.algorithm)
+        except OSError:
+            file.close()
+            raise
+        self.file, self.stat = file, file_stat
+        return None
+
+    def get_absolute_path(self, root, path):
+        return self.server.get_path(path)
+
+    def validate_absolute_path(self, root, absolute_path):
+        return absolute_path
+
+    def get_modified_time(self):
+        return datetime.datetime.utcfromtimestamp(int(self.stat.st_mtime))
+
+    def get_content_size(self):
+        return self.stat.st_size
+
+    def compute_etag(self):
+        if self.digest is None:
+            return None
+        return '"%s"' % self.digest.hex()
+
+    def get_content(self, absolute_path, start=None, end=None):
+        offset = start or 0
+        end = self.stat.st_size if end is None else end
+        while offset < end:
+            chunk = os.pread(self.file.fileno(), min(65536, end - offset),
+                             offset)
+            if not chunk:
+                raise OSError('File truncated: {}'.format(absolute_path))
+            offset += len(chunk)
+            yield chunk
+
+    def on_finish(self):
+        self.server.metrics.increment('http_requests_total',
+                                      status=self.get_status())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def application(server, algorithm=hashing.DEFAULT):
+    """
+    Returns a :class:`tornado.web.Application` serving the files of given
+    *server* via the :class:`GatewayHandler`.
+    """
+    return Application([(r'/(.*)', GatewayHandler,
+                         {'server': server, 'algorithm': algorithm})])
+
+
+def listen(server, port, address='', algorithm=hashing.DEFAULT):
+    """
+    Starts an HTTP server on the current IOLoop, that serves the files of
+    given *server*. Returns the :class:`tornado.httpserver.HTTPServer`.
+    """
+    return application(server, algorithm).listen(port, address=address)
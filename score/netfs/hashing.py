@@ -0,0 +1,66 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+The hash algorithms available for verifying transferred files. Clients and
+servers agree on one of these during the :ref:`hello <netfs_protocol_hello>`
+handshake. Peers that do not perform the handshake always use the `DEFAULT`.
+"""
+
+import hashlib
+
+
+DEFAULT = 'sha512'
+
+ALGORITHMS = ('blake2b', 'sha256', 'sha512', 'blake2s')
+
+
+def new(name=DEFAULT):
+    """
+    Returns a new hash object for the algorithm with given *name*.
+    """
+    if name not in ALGORITHMS:
+        raise ValueError('Unsupported hash algorithm "%s"' % name)
+    return hashlib.new(name)
+
+
+def digest_size(name=DEFAULT):
+    """
+    Returns the length of the digests of the algorithm with given *name* in
+    bytes.
+    """
+    return new(name).digest_size
+
+
+def choose(offered, supported=ALGORITHMS):
+    """
+    Returns the first algorithm in *offered*, that is also *supported*, or the
+    `DEFAULT`, if there is no such algorithm.
+    """
+    for name in offered:
+        if name in supported:
+            return name
+    return DEFAULT
@@ -0,0 +1,172 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+Counters, gauges and latency histograms of a running :class:`StorageServer
+<score.netfs.server.StorageServer>` or :class:`ProxyServer
+<score.netfs.proxy.ProxyServer>`. The values are rendered in the plain text
+format understood by Prometheus, which is what the :ref:`stats request
+<netfs_protocol_stats>` and the scrape listener started by :func:`listen`
+deliver.
+
+The servers update their metrics on the IOLoop only, which is why no locking
+takes place.
+"""
+
+from bisect import bisect_left
+import time
+from .constants import Constants
+
+
+#: Maps request bytes to the names used as the *op* label.
+OPERATIONS = {value: name[4:].lower()
+              for name, value in vars(Constants).items()
+              if name.startswith('REQ_')}
+
+#: Upper bounds of the latency histogram buckets in seconds.
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """
+    The distribution of observed values among the given *buckets*.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    A collection of metrics, whose names are prefixed with *prefix* when
+    rendered. Every metric may carry labels, which are passed as keyword
+    arguments and distinguish several values of the same metric.
+    """
+
+    def __init__(self, prefix='netfs'):
+        self.prefix = prefix
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.gauge('uptime_seconds', lambda: time.time() - self.started)
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Adds *amount* to the counter with given *name* and *labels*.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Adds *value*, usually a duration in seconds, to the histogram with
+        given *name* and *labels*.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, getter, **labels):
+        """
+        Registers a gauge, whose current value is determined by calling
+        *getter* whenever the metrics are rendered. The gauge is left out if
+        *getter* returns `None`.
+        """
+        self.gauges[(name, tuple(sorted(labels.items())))] = getter
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def add(kind, values, format):
+            current = None
+            for (name, labels), value in sorted(values.items()):
+                name = '{}_{}'.format(self.prefix, name)
+                if name != current:
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                    current = name
+                format(name, labels, value)
+
+        def sample(name, labels, value):
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+        def histogram(name, labels, histogram):
+            total = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                total += count
+                sample(name + '_bucket', labels + (('le', bound),), total)
+            sample(name + '_bucket', labels + (('le', '+Inf'),),
+                   histogram.count)
+            sample(name + '_sum', labels, histogram.sum)
+            sample(name + '_count', labels, histogram.count)
+
+        add('counter', self.counters, sample)
+        gauges = {key: getter() for key, getter in self.gauges.items()}
+        add('gauge', {key: value for key, value in gauges.items()
+                      if value is not None}, sample)
+        add('histogram', self.histograms, histogram)
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels) + '}'
+
+
+def listen(metrics, port, address=''):
+    """
+    Starts an HTTP server on the current IOLoop, that responds to every GET
+    request with the rendered *metrics*. Returns the
+    :class:`tornado.httpserver.HTTPServer`.
+    """
+    from tornado.web import Application, RequestHandler
+
+    class MetricsHandler(RequestHandler):
+
+        def get(self):
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.write(metrics.render())
+
+    app = Application([(r'/.*', MetricsHandler)])
+    return app.listen(port, address=address)
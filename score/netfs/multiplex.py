@@ -0,0 +1,290 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+import logging
+import struct
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from .constants import Constants
+
+
+log = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!IBI')
+
+
+class StreamMultiplexer:
+    """
+    Splits a connection in :ref:`multiplexed mode <netfs_protocol_multiplex>`
+    into independent :class:`VirtualStream` objects. Every stream opened by
+    the client is passed to the *handler*, which usually starts a new
+    conversation on it.
+
+    Each stream may buffer up to *window* bytes, that were received but not
+    read yet. The client accepts *peer_window* bytes per stream in the same
+    manner, which limits the amount of data written to each stream until the
+    client grants more.
+
+    The frames of all streams with pending data are written in turns, so that
+    a large transfer cannot delay the responses on other streams by more than
+    a frame.
+    """
+
+    WINDOW = 1024 * 256
+
+    MAX_FRAME_SIZE = 1024 * 16
+
+    def __init__(self, stream, handler, window, peer_window):
+        self.stream = stream
+        self.handler = handler
+        self.window = window
+        self.peer_window = peer_window
+        self.streams = {}
+        self.last_id = 0
+        self.sending = []
+        self.blocked = False
+        stream.set_close_callback(self._stream_closed)
+        self._read_frame()
+
+    def _read_frame(self):
+        if not self.stream.closed():
+            self.stream.read_bytes(FRAME_HEADER.size, self._handle_header)
+
+    def _handle_header(self, header):
+        stream_id, frame_type, length = FRAME_HEADER.unpack(header)
+        if length > max(self.MAX_FRAME_SIZE, self.window):
+            log.error('Received oversized frame ({} bytes)'.format(length))
+            self.stream.close()
+        elif length:
+            self.stream.read_bytes(length, lambda payload: self._handle_frame(
+                stream_id, frame_type, payload))
+        else:
+            self._handle_frame(stream_id, frame_type, b'')
+
+    def _handle_frame(self, stream_id, frame_type, payload):
+        vstream = self.streams.get(stream_id)
+        if frame_type == Constants.FRAME_DATA:
+            if vstream is None and stream_id > self.last_id:
+                # the first frame of a new stream
+                self.last_id = stream_id
+                vstream = VirtualStream(self, stream_id)
+                self.streams[stream_id] = vstream
+                self.handler(vstream)
+            if vstream is not None and not vstream._receive(payload):
+                log.error('Stream {} exceeded its window'.format(stream_id))
+                self.stream.close()
+                return
+        elif frame_type == Constants.FRAME_WINDOW:
+            if vstream is not None:
+                vstream.send_window += struct.unpack('!I', payload)[0]
+                self._flush()
+        elif frame_type == Constants.FRAME_CLOSE:
+            if vstream is not None:
+                self._remove(vstream)
+                vstream._closed_by_peer()
+        else:
+            log.error('Received bogus frame type %d' % frame_type)
+            self.stream.close()
+            return
+        # frames for streams, that were already closed, are discarded
+        self._read_frame()
+
+    def write_frame(self, stream_id, frame_type, payload=b''):
+        """
+        Writes a single frame to the underlying stream.
+        """
+        if self.stream.closed():
+            return
+        self.stream.write(
+            FRAME_HEADER.pack(stream_id, frame_type, len(payload)) + payload)
+
+    def schedule(self, vstream):
+        """
+        Queues the pending data of given :class:`VirtualStream` for sending.
+        """
+        if vstream not in self.sending:
+            self.sending.append(vstream)
+        self._flush()
+
+    def _flush(self):
+        while self.sending and not self.blocked:
+            progress = False
+            for vstream in self.sending[:]:
+                length = min(len(vstream._write_buffer), vstream.send_window,
+                             self.MAX_FRAME_SIZE)
+                if length:
+                    payload = bytes(vstream._write_buffer[:length])
+                    del vstream._write_buffer[:length]
+                    vstream.send_window -= length
+                    self.write_frame(vstream.id, Constants.FRAME_DATA, payload)
+                    progress = True
+                if not vstream._write_buffer:
+                    self.sending.remove(vstream)
+                    vstream._written()
+            if not progress:
+                # all remaining streams are waiting for a window update
+                break
+            if self.stream.writing():
+                self.blocked = True
+                self.stream.write(b'', self._drained)
+
+    def _drained(self):
+        self.blocked = False
+        self._flush()
+
+    def _remove(self, vstream):
+        self.streams.pop(vstream.id, None)
+        try:
+            self.sending.remove(vstream)
+        except ValueError:
+            pass
+
+    def close_stream(self, vstream):
+        """
+        Removes given :class:`VirtualStream` and notifies the client.
+        """
+        self._remove(vstream)
+        self.write_frame(vstream.id, Constants.FRAME_CLOSE)
+
+    def _stream_closed(self):
+        log.debug('multiplexed connection closed')
+        streams, self.streams = self.streams, {}
+        self.sending = []
+        for vstream in streams.values():
+            vstream._closed_by_peer()
+
+
+class VirtualStream:
+    """
+    A single stream of a :class:`StreamMultiplexer`. Provides the parts of
+    the :class:`tornado.iostream.IOStream` interface, that are used by the
+    conversations of the server and the proxy.
+    """
+
+    # there is no socket of its own to pass to os.sendfile()
+    socket = None
+
+    def __init__(self, mux, stream_id):
+        self.mux = mux
+        self.id = stream_id
+        self.send_window = mux.peer_window
+        self._read_buffer = bytearray()
+        self._write_buffer = bytearray()
+        self._read = None
+        self._write_callback = None
+        self._consumed = 0
+        self._closed = False
+        self._close_callback = None
+        self.loop = IOLoop.current()
+
+    def read_bytes(self, num_bytes, callback, streaming_callback=None,
+                   partial=False):
+        if self._closed:
+            raise StreamClosedError()
+        assert self._read is None, 'Already reading'
+        self._read = [num_bytes, callback, streaming_callback, partial]
+        self._try_read()
+
+    def write(self, data, callback=None):
+        if self._closed:
+            raise StreamClosedError()
+        self._write_buffer += data
+        if callback is not None:
+            self._write_callback = callback
+        if self._write_buffer:
+            self.mux.schedule(self)
+        else:
+            self._written()
+
+    def writing(self):
+        return bool(self._write_buffer)
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        self.mux.close_stream(self)
+        self._closed_by_peer()
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def set_nodelay(self, value):
+        pass
+
+    def _receive(self, data):
+        self._read_buffer += data
+        if len(self._read_buffer) > self.mux.window:
+            return False
+        self._try_read()
+        return True
+
+    def _try_read(self):
+        if self._read is None:
+            return
+        num_bytes, callback, streaming_callback, partial = self._read
+        if streaming_callback:
+            if self._read_buffer:
+                chunk = self._consume(num_bytes)
+                self._read[0] -= len(chunk)
+                self.loop.add_callback(streaming_callback, chunk)
+            if self._read[0]:
+                return
+            data = b''
+        elif len(self._read_buffer) >= num_bytes or \
+                (partial and self._read_buffer):
+            data = self._consume(num_bytes)
+        else:
+            return
+        self._read = None
+        self.loop.add_callback(callback, data)
+
+    def _consume(self, num_bytes):
+        data = bytes(self._read_buffer[:num_bytes])
+        del self._read_buffer[:num_bytes]
+        self._consumed += len(data)
+        if self._consumed >= self.mux.window // 2:
+            self.mux.write_frame(self.id, Constants.FRAME_WINDOW,
+                                 struct.pack('!I', self._consumed))
+            self._consumed = 0
+        return data
+
+    def _written(self):
+        callback, self._write_callback = self._write_callback, None
+        if callback:
+            self.loop.add_callback(callback)
+
+    def _closed_by_peer(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._read = None
+        self._write_buffer.clear()
+        if self._close_callback:
+            callback, self._close_callback = self._close_callback, None
+            self.loop.add_callback(callback)
@@ -24,11 +24,16 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
-from datetime import timedelta
+import functools
 import logging
-import socket
+import random
+import struct
+import weakref
 from tornado.iostream import IOStream, StreamClosedError
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from score.netfs import address, hashing
+from score.netfs.constants import Constants
+from score.netfs.metrics import Metrics
 
 
 log = logging.getLogger('score.netfs.proxy')
@@ -39,14 +44,78 @@ class NotConnected(Exception):
 
 
 class Backend:
+    """
+    A connection to a storage server. The server's *host* may also designate
+    a Unix domain socket, see :mod:`score.netfs.address`.
 
-    def __init__(self, host, port, *, autoconnect=True):
+    The connection performs a :ref:`hello <netfs_protocol_hello>` handshake
+    whenever it is established, storing the server's protocol *version* and
+    the negotiated *hash_name*. Servers predating the handshake close the
+    connection, in which case it is re-established without a handshake and
+    the *version* is set to 0.
+
+    Operations on shared connections must :meth:`acquire` the connection
+    before sending anything and :meth:`release` it once the response was read
+    completely.
+
+    The connection's state, its traffic and the durations of its leases are
+    recorded in given :class:`Metrics <score.netfs.metrics.Metrics>`, using
+    the label *backend*.
+
+    Connections to servers supporting the :ref:`ping <netfs_protocol_ping>`
+    request are monitored by sending one every *heartbeat* seconds over a
+    separate probe connection, as the connection itself may be leased for any
+    amount of time. Once a ping has remained unanswered for *misses*
+    heartbeats, or no ping could be sent for as long, the server is considered
+    down and the connection is closed, along with all connections opened via
+    :meth:`transaction`. Attempts to establish a
+    connection are abandoned after the same amount of time. Lost connections
+    are re-established after a random delay, whose upper bound starts at
+    `RECONNECT_DELAY` seconds and doubles with every failed attempt up to
+    `RECONNECT_MAX_DELAY` seconds.
+    """
+
+    #: Default number of seconds between two heartbeats.
+    HEARTBEAT = 0.25
+
+    #: Default number of missed heartbeats, after which the server is down.
+    MISSES = 4
+
+    RECONNECT_DELAY = 0.2
+
+    RECONNECT_MAX_DELAY = 30
+
+    def __init__(self, host, port, *, autoconnect=True,
+                 hashes=hashing.ALGORITHMS, metrics=None,
+                 heartbeat=HEARTBEAT, misses=MISSES):
         self.host = host
         self.port = port
+        self.label = address.describe(host, port)
+        self.metrics = metrics if metrics is not None else Metrics()
         self.stream = None
         self.close_callbacks = []
         self.autoconnect = autoconnect
+        self.hashes = hashes
+        self.version = None
+        self.hash_name = hashing.DEFAULT
+        self.lease = None
+        self.leased = None
+        self.waiting = []
+        self.heartbeat = heartbeat
+        self.misses = misses
+        self.heartbeats = None
+        self.probe = None
+        self.probe_connected = None
+        # send time of the ping, that was not answered yet
+        self.pinged = None
+        self.answered = None
+        self.attempts = 0
+        self.transactions = weakref.WeakSet()
         if autoconnect:
+            self.metrics.gauge('backend_up', lambda: int(self.connected()),
+                               backend=self.label)
+            self.metrics.gauge('backend_waiting', lambda: len(self.waiting),
+                               backend=self.label)
             self.connect()
 
     def send(self, data, callback=None):
@@ -56,50 +125,256 @@ class Backend:
             self.stream.write(data, callback=callback)
         except StreamClosedError:
             raise NotConnected()
+        self.metrics.increment('backend_sent_bytes_total', len(data),
+                               backend=self.label)
 
     def read(self, length, callback=None, streaming_callback=None):
         # log.debug('{}.read({})'.format(self, length))
+        self.metrics.increment('backend_received_bytes_total', length,
+                               backend=self.label)
         self.stream.read_bytes(length, callback,
                                streaming_callback=streaming_callback)
 
-    def connect(self, success_callback=None, error_callback=None):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        stream = IOStream(s)
+    def connect(self, success_callback=None, error_callback=None, *,
+                hello=True):
+        stream = IOStream(address.create_socket(self.host))
+        loop = IOLoop.current()
+        timeout = None
+        expired = False
+
+        def expire():
+            nonlocal expired
+            log.warn('timeout connecting to {}'.format(self))
+            expired = True
+            stream.close()
+
+        def cancel_timeout():
+            if timeout is not None:
+                loop.remove_timeout(timeout)
+
+        def failed():
+            cancel_timeout()
+            if self.autoconnect:
+                self.reconnect()
+            elif error_callback:
+                error_callback(self)
 
         def connected(future):
             if future.exception():
-                if self.autoconnect:
-                    return self.reconnect()
-                elif error_callback:
-                    error_callback(self)
+                return failed()
             log.debug('connected to {}'.format(self))
+            stream.set_nodelay(True)
+            if not hello:
+                self.version = 0
+                self.hash_name = hashing.DEFAULT
+                return established()
+            stream.set_close_callback(hello_failed)
+            self._hello(stream, self.hashes, hello_done)
+
+        def hello_done(version, hash_name):
+            self.version = version
+            self.hash_name = hash_name
+            established()
+
+        def hello_failed():
+            if expired:
+                # the server did not answer, rather than closing the
+                # connection
+                return failed()
+            cancel_timeout()
+            log.debug('{} does not support hello'.format(self))
+            self.connect(success_callback, error_callback, hello=False)
+
+        def established():
+            cancel_timeout()
             stream.set_close_callback(self._stream_closed)
             self.stream = stream
+            self.attempts = 0
+            if self.autoconnect:
+                self._start_heartbeats()
             if success_callback:
                 success_callback(self)
-        stream.connect((self.host, self.port)).\
+
+        if self.heartbeat:
+            timeout = loop.call_later(self.heartbeat * self.misses, expire)
+        stream.connect(address.socket_address(self.host, self.port)).\
             add_done_callback(connected)
 
+    def _hello(self, stream, hashes, callback):
+        data = struct.pack('!bBB', Constants.REQ_HELLO,
+                           Constants.PROTOCOL_VERSION, len(hashes))
+        for name in hashes:
+            name = name.encode('ASCII')
+            data += struct.pack('!B', len(name)) + name
+
+        def read_header(header_bytes):
+            status, version, length = struct.unpack('!bBB', header_bytes)
+            stream.read_bytes(length, lambda name_bytes: callback(
+                version, str(name_bytes, 'ASCII')))
+
+        stream.write(data)
+        stream.read_bytes(3, read_header)
+
+    def use_hash(self, name, success_callback, error_callback):
+        """
+        Makes sure the connection uses the hash algorithm with given *name*.
+        The connection must have been :meth:`acquired <acquire>` for this
+        operation.
+        """
+        if self.hash_name == name:
+            return success_callback()
+        if not self.version:
+            return error_callback()
+
+        def done(version, hash_name):
+            self.hash_name = hash_name
+            if hash_name == name:
+                success_callback()
+            else:
+                error_callback()
+
+        try:
+            self._hello(self.stream, (name,), done)
+        except StreamClosedError:
+            raise NotConnected()
+
+    def acquire(self, callback):
+        """
+        Calls *callback* with a lease object as soon as no other operation is
+        using this connection. The lease must be passed to :meth:`release`
+        when the operation is done.
+        """
+        if self.lease is None:
+            self.lease = object()
+            self.leased = IOLoop.current().time()
+            self.metrics.increment('backend_leases_total', backend=self.label)
+            callback(self.lease)
+        else:
+            self.waiting.append(callback)
+
+    def release(self, lease):
+        """
+        Releases a lease acquired via :meth:`acquire`. Leases that were
+        invalidated by a lost connection are silently ignored.
+        """
+        if lease is not self.lease:
+            return
+        self.metrics.observe('backend_lease_seconds',
+                             IOLoop.current().time() - self.leased,
+                             backend=self.label)
+        self.lease = None
+        if self.waiting:
+            IOLoop.current().add_callback(self.acquire, self.waiting.pop(0))
+
     def close(self):
-        pass
+        if self.stream:
+            self.stream.close()
 
     def reconnect(self):
-        loop = IOLoop.current()
-        loop.add_timeout(timedelta(seconds=2), self.connect)
+        self.metrics.increment('backend_reconnects_total', backend=self.label)
+        limit = min(self.RECONNECT_MAX_DELAY,
+                    self.RECONNECT_DELAY * 2 ** self.attempts)
+        if limit < self.RECONNECT_MAX_DELAY:
+            self.attempts += 1
+        # the jitter keeps proxies, that lost the same server, from
+        # reconnecting in lockstep
+        delay = random.uniform(limit / 2, limit)
+        log.debug('reconnecting to {} in {:.2f}s'.format(self, delay))
+        IOLoop.current().call_later(delay, self.connect)
+
+    def _start_heartbeats(self):
+        if not self.heartbeat or self.version < 12:
+            return
+        self.answered = IOLoop.current().time()
+        self.heartbeats = PeriodicCallback(self._beat, self.heartbeat * 1000)
+        self.heartbeats.start()
+
+    def _stop_heartbeats(self):
+        if self.heartbeats:
+            self.heartbeats.stop()
+            self.heartbeats = None
+        if self.probe:
+            probe, self.probe = self.probe, None
+            probe.close()
+        self.pinged = None
+
+    def _beat(self):
+        now = IOLoop.current().time()
+        # a pending ping is given the full period, even if it was sent late
+        # because this process was busy
+        since = self.answered if self.pinged is None else self.pinged
+        if now - since >= self.heartbeat * self.misses:
+            return self._missed()
+        if self.probe is None or self.probe.closed():
+            self._open_probe()
+        elif self.pinged is None and self.probe_connected.done():
+            self.pinged = now
+            self.probe.write(struct.pack('!b', Constants.REQ_PING))
+            self.probe.read_bytes(1, functools.partial(self._pong,
+                                                       self.probe))
+
+    def _open_probe(self):
+        probe = IOStream(address.create_socket(self.host))
+
+        def closed():
+            if probe is self.probe:
+                # the next heartbeat opens another probe connection, the
+                # server is considered down if that does not work either
+                self.probe = None
+                self.pinged = None
+
+        probe.set_close_callback(closed)
+        self.probe = probe
+        self.probe_connected = probe.connect(
+            address.socket_address(self.host, self.port))
+        # failures are handled by the close callback
+        self.probe_connected.add_done_callback(
+            lambda future: future.exception())
+
+    def _pong(self, probe, status_bytes):
+        if probe is not self.probe:
+            # answer on a probe connection closed in the meantime
+            return
+        if struct.unpack('!b', status_bytes)[0] != Constants.RESP_OK:
+            # the heartbeat counts as missed, the next one opens another
+            # probe connection
+            log.debug('unexpected heartbeat of {}'.format(self))
+            self.probe.close()
+            return
+        self.answered = IOLoop.current().time()
+        self.metrics.observe('backend_heartbeat_seconds',
+                             self.answered - self.pinged, backend=self.label)
+        self.pinged = None
+
+    def _missed(self):
+        log.warn('missed heartbeats of {}'.format(self))
+        self.metrics.increment('backend_heartbeat_failures_total',
+                               backend=self.label)
+        self._stop_heartbeats()
+        for backend in list(self.transactions):
+            backend.close()
+        # the close callback takes care of everything else
+        self.close()
 
     def connected(self):
         return self.stream is not None
 
     def __str__(self):
-        return 'Backend({}:{})'.format(self.host, self.port)
+        return 'Backend({})'.format(self.label)
 
     __repr__ = __str__
 
     def _stream_closed(self):
         self.stream = None
-        for callback in self.close_callbacks:
+        self.lease = None
+        self._stop_heartbeats()
+        # callbacks tend to remove themselves, so we are iterating a copy
+        callbacks, self.close_callbacks = self.close_callbacks, []
+        for callback in callbacks:
             callback(self)
-        self.close_callbacks = []
+        waiting, self.waiting = self.waiting, []
+        for callback in waiting:
+            self.acquire(callback)
         if self.autoconnect:
             log.warn('lost connection to {}'.format(self))
             self.reconnect()
@@ -115,7 +390,23 @@ class Backend:
         except ValueError:
             pass
 
-    def transaction(self, success_callback, error_callback):
-        backend = Backend(self.host, self.port, autoconnect=False)
-        backend.connect(success_callback, error_callback)
+    def transaction(self, success_callback, error_callback,
+                    hash_name=hashing.DEFAULT):
+        """
+        Opens a new, dedicated connection to the same server for a
+        transaction, that will use the hash algorithm with given *hash_name*.
+        """
+        backend = Backend(self.host, self.port, autoconnect=False,
+                          hashes=(hash_name,), metrics=self.metrics,
+                          heartbeat=self.heartbeat, misses=self.misses)
+        self.transactions.add(backend)
+
+        def connected(backend):
+            if backend.hash_name != hash_name:
+                log.debug('{} does not support {}'.format(backend, hash_name))
+                backend.stream.close()
+                return error_callback(backend)
+            success_callback(backend)
+
+        backend.connect(connected, error_callback)
         return backend
@@ -25,12 +25,19 @@
 # Licensee has his registered seat, an establishment or assets.
 
 import logging
+from score.netfs import hashing
 from score.netfs.constants import Constants
+from score.netfs.metrics import Metrics, OPERATIONS
+from score.netfs.multiplex import StreamMultiplexer, VirtualStream
+from score.netfs.storage import InFlightUploads
 import struct
+from tornado.ioloop import IOLoop
 from tornado.tcpserver import TCPServer
 from .backend import Backend, NotConnected
 from .operation import (DownloadOperation, CommitOperation, PrepareOperation,
-                        UploadOperation)
+                        UploadOperation, HelloOperation, LinkOperation,
+                        StatOperation, ListOperation, SignatureOperation,
+                        WaitOperation)
 
 
 log = logging.getLogger(__name__)
@@ -41,8 +48,17 @@ class FrontendCommunication:
     def __init__(self, server, stream):
         self.server = server
         self.stream = stream
+        self.stream.set_nodelay(True)
         self.stream.set_close_callback(self._stream_closed)
         self.transaction_backends = None
+        # names of the files uploaded in the current transaction
+        self.uploads = []
+        self.hash_name = hashing.DEFAULT
+        self.loop = IOLoop.current()
+        self.metrics = server.metrics
+        self.op_name = None
+        self.op_started = None
+        server.communications.add(self)
         self.read_op()
 
     def init_transaction(self, callback):
@@ -69,7 +85,57 @@ class FrontendCommunication:
 
         remaining = []
         for backend in self.backends:
-            remaining.append(backend.transaction(connected, failed))
+            remaining.append(
+                backend.transaction(connected, failed, self.hash_name))
+
+    def add_upload(self, name):
+        """
+        Registers the upload of the file with given *name* in the current
+        transaction, so that ``wait`` requests for that file are parked until
+        the transaction ends.
+        """
+        self.uploads.append(name)
+        self.server.uploads.add(name)
+
+    def end_transaction(self, rolled_back=()):
+        """
+        Forgets about the current transaction, after it was committed or
+        rolled back. The uploads of the transaction are considered finished
+        right away, or once all backends in *rolled_back* confirmed the
+        rollback.
+        """
+        self.transaction_backends = None
+        uploads, self.uploads = self.uploads, []
+        remaining = set(rolled_back)
+
+        def confirmed(backend):
+            if backend not in remaining:
+                return
+            remaining.remove(backend)
+            # the connection was dedicated to the transaction
+            backend.close()
+            if not remaining:
+                finished()
+
+        def finished():
+            for name in uploads:
+                self.server.uploads.remove(name)
+
+        if not remaining:
+            return finished()
+        # the rollback itself has no response, but requests are processed in
+        # order: a prepare request without uploads is answered once the
+        # rollback is done
+        data = struct.pack('!bb', Constants.REQ_ROLLBACK,
+                           Constants.REQ_PREPARE)
+        for backend in rolled_back:
+            try:
+                backend.send(data)
+                backend.add_close_callback(confirmed)
+            except NotConnected:
+                confirmed(backend)
+                continue
+            backend.read(1, lambda _, backend=backend: confirmed(backend))
 
     def remove_from_transaction(self, backend):
         try:
@@ -82,11 +148,19 @@ class FrontendCommunication:
             pass
 
     def read_op(self):
+        if self.op_started is not None:
+            self.metrics.observe('request_duration_seconds',
+                                 self.loop.time() - self.op_started,
+                                 op=self.op_name)
+            self.op_started = None
         if self.stream:
             self.stream.read_bytes(1, self.handle_op)
 
     def handle_op(self, op_bytes):
         op = struct.unpack('!b', op_bytes)[0]
+        self.op_name = OPERATIONS.get(op, 'unknown')
+        self.op_started = self.loop.time()
+        self.metrics.increment('requests_total', op=self.op_name)
         if op == Constants.REQ_UPLOAD:
             return UploadOperation(self)
         elif op == Constants.REQ_ROLLBACK:
@@ -97,6 +171,34 @@ class FrontendCommunication:
             return CommitOperation(self)
         elif op == Constants.REQ_DOWNLOAD:
             return DownloadOperation(self)
+        elif op == Constants.REQ_DOWNLOAD_RANGE:
+            return DownloadOperation(self, ranged=True)
+        elif op == Constants.REQ_UPLOAD_RESUMABLE:
+            return UploadOperation(self, resumable=True)
+        elif op == Constants.REQ_UPLOAD_COMPRESSED:
+            return UploadOperation(self, compressed=True)
+        elif op == Constants.REQ_DOWNLOAD_COMPRESSED:
+            return DownloadOperation(self, compressed=True)
+        elif op == Constants.REQ_SIGNATURE:
+            return SignatureOperation(self)
+        elif op == Constants.REQ_UPLOAD_DELTA:
+            return UploadOperation(self, delta=True)
+        elif op == Constants.REQ_LINK:
+            return LinkOperation(self)
+        elif op == Constants.REQ_STAT:
+            return StatOperation(self)
+        elif op == Constants.REQ_LIST:
+            return ListOperation(self)
+        elif op == Constants.REQ_HELLO:
+            return HelloOperation(self)
+        elif op == Constants.REQ_MULTIPLEX:
+            return self.handle_multiplex_request()
+        elif op == Constants.REQ_STATS:
+            return self.handle_stats_request()
+        elif op == Constants.REQ_WAIT:
+            return WaitOperation(self)
+        elif op == Constants.REQ_PING:
+            return self.handle_ping_request()
         else:
             log.error('Received bogus request byte %d' % op)
             self.terminate()
@@ -115,6 +217,21 @@ class FrontendCommunication:
         if self.stream:
             self.stream.write(*args, **kwargs)
 
+    def respond(self, data):
+        """
+        Writes the last part of a response and proceeds with the next request
+        right away, unless the client is not keeping up with reading the
+        responses. See :meth:`Communication.respond
+        <score.netfs.server.Communication.respond>` for details.
+        """
+        if not self.stream:
+            return
+        self.stream.write(data)
+        if self.stream.writing():
+            self.stream.write(b'', self.read_op)
+        else:
+            self.read_op()
+
     @property
     def backends(self):
         return self.server.backends
@@ -124,16 +241,42 @@ class FrontendCommunication:
         if self.transaction_backends is None:
             self.read_op()
             return
-        data = struct.pack('!b', Constants.REQ_ROLLBACK)
         for backend in self.transaction_backends:
             backend.remove_close_callback(self._backend_closed)
-            try:
-                backend.send(data)
-            except NotConnected:
-                pass
-        self.transaction_backends = None
+        self.end_transaction(rolled_back=self.transaction_backends)
         self.read_op()
 
+    def handle_multiplex_request(self):
+        log.debug('multiplex')
+
+        def read_window(window_bytes):
+            window = struct.unpack('!I', window_bytes)[0]
+            if not window or self.transaction_backends is not None or \
+                    isinstance(self.stream, VirtualStream):
+                self.respond(struct.pack('!bI', Constants.RESP_ERROR, 0))
+                return
+            self.write(struct.pack('!bI', Constants.RESP_OK,
+                                   StreamMultiplexer.WINDOW))
+            self.server.communications.discard(self)
+            self.op_started = None
+            StreamMultiplexer(
+                self.stream,
+                lambda stream: FrontendCommunication(self.server, stream),
+                StreamMultiplexer.WINDOW, window)
+
+        self.read(4, read_window)
+
+    def handle_stats_request(self):
+        # the proxy reports its own metrics, including those of its backends
+        log.debug('stats')
+        text = self.metrics.render().encode('UTF-8')
+        self.respond(struct.pack('!bI', Constants.RESP_OK, len(text)) + text)
+
+    def handle_ping_request(self):
+        # the proxy is alive, regardless of the state of its backends
+        log.debug('ping')
+        self.respond(struct.pack('!b', Constants.RESP_OK))
+
     def _backend_closed(self, backend):
         if self.transaction_backends is None:
             return
@@ -145,17 +288,54 @@ class FrontendCommunication:
     def _stream_closed(self):
         log.debug('connection closed')
         self.stream = None
-        if not self.transaction_backends:
+        self.server.communications.discard(self)
+        backends = self.transaction_backends
+        self.end_transaction()
+        if not backends:
             return
-        for backend in self.transaction_backends:
+        for backend in backends:
             backend.close()
 
 
 class ProxyServer(TCPServer):
+    """
+    A server relaying requests to given *backends*, which are `(host, port)`
+    pairs. The *heartbeat* and *misses* are passed to each :class:`Backend
+    <score.netfs.proxy.backend.Backend>`.
+    """
 
-    def __init__(self, backends, **kwargs):
-        self.backends = [Backend(b[0], b[1]) for b in backends]
+    def __init__(self, backends, *, heartbeat=Backend.HEARTBEAT,
+                 misses=Backend.MISSES, **kwargs):
+        self.uploads = InFlightUploads()
+        self.communications = set()
+        self.metrics = Metrics()
+        self.metrics.gauge('connections', lambda: len(self.communications))
+        self.metrics.gauge('transactions', lambda: sum(
+            1 for c in self.communications
+            if c.transaction_backends is not None))
+        self.backends = [Backend(b[0], b[1], metrics=self.metrics,
+                                 heartbeat=heartbeat, misses=misses)
+                         for b in backends]
         TCPServer.__init__(self, **kwargs)
 
+    @property
+    def version(self):
+        """
+        The protocol version announced to clients: the lowest version among
+        all backends, that have established a connection.
+        """
+        versions = [b.version for b in self.backends if b.version is not None]
+        return min([Constants.PROTOCOL_VERSION] + versions)
+
+    @property
+    def hashes(self):
+        """
+        The hash algorithms that may be negotiated with clients. This is just
+        the default algorithm, if any backend predates the negotiation.
+        """
+        if self.version == 0:
+            return (hashing.DEFAULT,)
+        return hashing.ALGORITHMS
+
     def handle_stream(self, stream, address):
         FrontendCommunication(self, stream)
@@ -28,6 +28,14 @@ from .upload import UploadOperation
 from .commit import CommitOperation
 from .prepare import PrepareOperation
 from .download import DownloadOperation
+from .hello import HelloOperation
+from .link import LinkOperation
+from .stat import StatOperation
+from .list import ListOperation
+from .signature import SignatureOperation
+from .wait import WaitOperation
 
 __all__ = ['UploadOperation', 'CommitOperation',
-           'PrepareOperation', 'DownloadOperation']
+           'PrepareOperation', 'DownloadOperation', 'HelloOperation',
+           'LinkOperation', 'StatOperation', 'ListOperation',
+           'SignatureOperation', 'WaitOperation']
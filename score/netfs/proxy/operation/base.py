@@ -64,3 +64,10 @@ class Operation(metaclass=OperationMeta):
 
     def write(self, *args, **kwargs):
         self.frontend.write(*args, **kwargs)
+
+    def finish(self, data):
+        """
+        Sends the last part of the response and lets the frontend proceed with
+        the next request.
+        """
+        self.frontend.respond(data)
@@ -36,16 +36,18 @@ class CommitOperation(Operation):
         if self.frontend.transaction_backends is None:
             self.log.debug('success (no operations)!')
             data = struct.pack('!b', Constants.RESP_OK)
-            self.write(data, self.frontend.read_op)
+            self.finish(data)
             return
         if not self.frontend.transaction_backends:
             self.log.debug('error (no backends)!')
             data = struct.pack('!b', Constants.RESP_ERROR)
-            self.write(data, self.frontend.read_op)
+            self.finish(data)
             return
         self.success = False
+        self.backends = self.frontend.transaction_backends[:]
         data = struct.pack('!b', Constants.REQ_COMMIT)
-        for backend in self.frontend.transaction_backends:
+        for backend in self.backends:
+            backend.add_close_callback(self._backend_closed)
             backend.send(data)
             backend.read(1, self.create_backend_handler(backend))
 
@@ -59,14 +61,24 @@ class CommitOperation(Operation):
         self.log.debug('{}: {}'.format(backend, status))
         if status == Constants.RESP_OK:
             self.success = True
-        self.frontend.transaction_backends.remove(backend)
-        if self.frontend.transaction_backends:
+        backend.remove_close_callback(self._backend_closed)
+        self.backend_done(backend)
+
+    def backend_done(self, backend):
+        self.backends.remove(backend)
+        if self.backends:
             return
-        self.frontend.transaction_backends = None
+        self.frontend.end_transaction()
         if self.success:
             self.log.debug('success!')
             data = struct.pack('!b', Constants.RESP_OK)
         else:
             self.log.debug('error!')
             data = struct.pack('!b', Constants.RESP_ERROR)
-        self.write(data, self.frontend.read_op)
+        self.finish(data)
+
+    def _backend_closed(self, backend):
+        # the backend discards the transaction, unless the commit was
+        # already processed
+        self.log.debug('lost {}'.format(backend))
+        self.backend_done(backend)
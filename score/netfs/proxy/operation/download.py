@@ -26,18 +26,30 @@
 
 from .base import Operation
 import random
+from score.netfs import compression, hashing
 from score.netfs.proxy.backend import NotConnected
 from score.netfs.constants import Constants
 import struct
 
 
 class DownloadOperation(Operation):
+    """
+    Delegates a download to one of the backends. If *compressed* is `True`,
+    the operation is a ``compressed download``, whose compressed blocks are
+    relayed to the client as they are.
+    """
 
-    def __init__(self, frontend):
+    def __init__(self, frontend, ranged=False, compressed=False):
         super().__init__(frontend, 'download')
+        self.ranged = ranged
+        self.compressed = compressed
+        self.range_bytes = b''
+        self.codec_bytes = b''
         self.path = None
         self.backend = None
+        self.lease = None
         self.backends = self.frontend.backends[:]
+        self.hash_name = self.frontend.hash_name
         self.sent_bytes = 0
         self.read(4, self.read_request_name_length)
 
@@ -48,52 +60,128 @@ class DownloadOperation(Operation):
     def read_request_name(self, name_bytes):
         self.path = str(name_bytes, 'UTF-8')
         self.log.debug('path = {}'.format(self.path))
+        if self.ranged:
+            self.read(16, self.read_request_range)
+        elif self.compressed:
+            self.read(1, self.read_request_codec_count)
+        else:
+            self.response_attempt()
+
+    def read_request_codec_count(self, count_bytes):
+        self.codec_bytes = count_bytes
+        count = struct.unpack('!B', count_bytes)[0]
+        self.read(count, self.read_request_codecs)
+
+    def read_request_codecs(self, codec_bytes):
+        self.codec_bytes += codec_bytes
+        self.response_attempt()
+
+    def read_request_range(self, range_bytes):
+        self.range_bytes = range_bytes
         self.response_attempt()
 
     def response_attempt(self):
+        self.release_backend()
         if not self.backends:
             data = struct.pack('!b', Constants.RESP_ERROR)
             self.write(data, self.frontend.read_op)
-            if self.backend:
-                self.backend.remove_close_callback(self._backend_closed)
             return
         backend = random.choice(self.backends)
         self.backends.remove(backend)
+        if not backend.connected():
+            return self.response_attempt()
+        backend.acquire(lambda lease: self.acquired(backend, lease))
+
+    def acquired(self, backend, lease):
         try:
             backend.add_close_callback(self._backend_closed)
         except NotConnected:
+            backend.release(lease)
             return self.response_attempt()
         self.log.debug('chosen: {}'.format(backend))
         self.backend = backend
-        data = struct.pack('!b', Constants.REQ_DOWNLOAD)
+        self.lease = lease
+        self.backend.use_hash(self.hash_name, self.send_request,
+                              self.response_attempt)
+
+    def send_request(self):
+        if self.ranged:
+            data = struct.pack('!b', Constants.REQ_DOWNLOAD_RANGE)
+        elif self.compressed:
+            data = struct.pack('!b', Constants.REQ_DOWNLOAD_COMPRESSED)
+        else:
+            data = struct.pack('!b', Constants.REQ_DOWNLOAD)
         data += struct.pack('!i', len(self.path.encode('UTF-8')))
         data += self.path.encode('UTF-8')
+        data += self.range_bytes
+        data += self.codec_bytes
         self.skipped_bytes = 0
         self.backend.send(data)
         self.backend.read(1, self.handle_response_status)
 
+    def release_backend(self):
+        if not self.backend:
+            return
+        self.backend.remove_close_callback(self._backend_closed)
+        self.backend.release(self.lease)
+        self.backend = None
+        self.lease = None
+
     def handle_response_status(self, status_bytes):
         status = struct.unpack('!b', status_bytes)[0]
         if status != Constants.RESP_OK:
             self.response_attempt()
             return
         self.write(status_bytes)
-        self.backend.read(8, self.handle_response_size)
+        if self.ranged:
+            # the total file size precedes the length of the range
+            self.backend.read(16, self.handle_response_size)
+        else:
+            self.backend.read(8, self.handle_response_size)
 
     def handle_response_size(self, size_bytes):
         self.write(size_bytes)
-        size = struct.unpack('!q', size_bytes)[0]
-        self.backend.read(size, self.read_response_hash,
+        self.size = struct.unpack('!q', size_bytes[-8:])[0]
+        if self.compressed:
+            self.backend.read(1, self.handle_response_codec)
+        else:
+            self.read_response_content()
+
+    def read_response_content(self):
+        self.backend.read(self.size, self.read_response_hash,
+                          streaming_callback=self.handle_response_chunk)
+
+    def handle_response_codec(self, codec_bytes):
+        self.write(codec_bytes)
+        if struct.unpack('!B', codec_bytes)[0] == compression.NONE:
+            self.read_response_content()
+        else:
+            self.read_response_block_length()
+
+    def read_response_block_length(self, _=None):
+        self.backend.read(4, self.handle_response_block_length)
+
+    def handle_response_block_length(self, length_bytes):
+        self.write(length_bytes)
+        length = struct.unpack('!I', length_bytes)[0]
+        if not length:
+            self.read_response_hash(None)
+            return
+        self.backend.read(length, self.read_response_block_length,
                           streaming_callback=self.handle_response_chunk)
 
     def handle_response_chunk(self, chunk):
         self.write(chunk)
 
     def read_response_hash(self, _):
-        self.backend.read(512 // 8 + 4, self.handle_response_hash)
+        length = hashing.digest_size(self.hash_name)
+        if self.ranged:
+            # hash of the range and hash of the whole file
+            length *= 2
+        self.backend.read(length + 4, self.handle_response_hash)
 
     def handle_response_hash(self, hash_bytes):
-        self.backend.remove_close_callback(self._backend_closed)
+        self.release_backend()
         self.write(hash_bytes)
         self.frontend.read_op()
 
@@ -109,11 +197,12 @@ class DownloadOperation(Operation):
 
     def _backend_closed(self, backend):
         assert self.backend == backend
-        backend.remove_close_callback(self._backend_closed)
-        if self.sent_bytes > 0 and not self.backends:
+        self.release_backend()
+        if self.sent_bytes > 0 and (self.codec_bytes or not self.backends):
             # Already startend sending data, but can't continue due to lack of
             # working backends. The only remaining option is to terminate the
-            # frontend connection.
+            # frontend connection. The same applies to compressed downloads,
+            # as another backend might compress the file differently.
             self.log.debug('lost last backend connection, terminating')
             return self.frontend.terminate()
         self.log.debug('lost backend connection, retrying')
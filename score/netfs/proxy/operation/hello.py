@@ -0,0 +1,70 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from .base import Operation
+import struct
+from score.netfs import hashing
+from score.netfs.constants import Constants
+
+
+class HelloOperation(Operation):
+
+    def __init__(self, frontend):
+        super().__init__(frontend, 'hello')
+        self.names = []
+        self.read(2, self.handle_header)
+
+    def handle_header(self, header_bytes):
+        version, self.count = struct.unpack('!BB', header_bytes)
+        self.log.debug('client version = {}'.format(version))
+        self.read_name_length()
+
+    def read_name_length(self):
+        if len(self.names) == self.count:
+            return self.respond()
+        self.read(1, self.handle_name_length)
+
+    def handle_name_length(self, length_bytes):
+        length = struct.unpack('!B', length_bytes)[0]
+        self.read(length, self.handle_name)
+
+    def handle_name(self, name_bytes):
+        self.names.append(str(name_bytes, 'ASCII'))
+        self.read_name_length()
+
+    def respond(self):
+        if self.frontend.transaction_backends is None:
+            # the transaction connections to the backends were established
+            # with the current algorithm, so it cannot change until the end
+            # of the transaction
+            self.frontend.hash_name = hashing.choose(
+                self.names, self.frontend.server.hashes)
+        self.log.debug('hash = {}'.format(self.frontend.hash_name))
+        name = self.frontend.hash_name.encode('ASCII')
+        data = struct.pack('!bBB', Constants.RESP_OK,
+                           self.frontend.server.version, len(name))
+        data += name
+        self.finish(data)
@@ -0,0 +1,102 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from .base import Operation
+import struct
+from score.netfs import hashing
+from score.netfs.constants import Constants
+from score.netfs.proxy.backend import NotConnected
+
+
+class LinkOperation(Operation):
+    """
+    Delegates a ``link`` request to all backends of the transaction. The
+    request succeeds only if every backend found the content. Otherwise the
+    client will upload the file, replacing the copies created by those
+    backends, that did find it.
+    """
+
+    def __init__(self, frontend):
+        super().__init__(frontend, 'link')
+        self.request = struct.pack('!b', Constants.REQ_LINK)
+        self.statuses = []
+        self.read(4, self.handle_name_length)
+
+    def handle_name_length(self, length_bytes):
+        self.request += length_bytes
+        length = struct.unpack('!i', length_bytes)[0]
+        self.read(length + 8 + hashing.digest_size(self.frontend.hash_name),
+                  self.handle_request)
+
+    def handle_request(self, request_bytes):
+        self.request += request_bytes
+        length = struct.unpack('!i', self.request[1:5])[0]
+        self.frontend.add_upload(str(request_bytes[:length], 'UTF-8'))
+        self.frontend.init_transaction(self.created_transaction)
+
+    def created_transaction(self, transaction):
+        self.backends = transaction[:]
+        for backend in self.backends[:]:
+            try:
+                backend.add_close_callback(self._backend_closed)
+                backend.send(self.request)
+            except NotConnected:
+                self.backends.remove(backend)
+                continue
+            backend.read(1, self.create_backend_handler(backend))
+        self.respond()
+
+    def create_backend_handler(self, backend):
+        def handler(b):
+            self.handle_backend_response(backend, b)
+        return handler
+
+    def handle_backend_response(self, backend, status_bytes):
+        backend.remove_close_callback(self._backend_closed)
+        self.backends.remove(backend)
+        status = struct.unpack('!b', status_bytes)[0]
+        self.log.debug('{}: {}'.format(backend, status))
+        if status == Constants.RESP_ERROR:
+            self.frontend.remove_from_transaction(backend)
+        else:
+            self.statuses.append(status)
+        self.respond()
+
+    def respond(self):
+        if self.backends:
+            # Not all backends have responded yet
+            return
+        if not self.frontend.transaction_backends:
+            status = Constants.RESP_ERROR
+        elif all(s == Constants.RESP_OK for s in self.statuses):
+            status = Constants.RESP_OK
+        else:
+            status = Constants.RESP_NOTFOUND
+        self.finish(struct.pack('!b', status))
+
+    def _backend_closed(self, backend):
+        self.backends.remove(backend)
+        self.respond()
@@ -0,0 +1,159 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from .base import Operation
+import struct
+from score.netfs.constants import Constants
+from score.netfs.proxy.backend import NotConnected
+
+
+class ListOperation(Operation):
+    """
+    Delegates a ``list`` request to all connected backends and merges their
+    responses, reporting the most recently modified version of each file.
+
+    A backend, that has more entries than it returned, may still have files
+    sorting before the last entry of another backend's response. The merged
+    response thus ends at the lowest last entry of all such backends.
+    """
+
+    record = struct.Struct('!qii')
+
+    def __init__(self, frontend):
+        super().__init__(frontend, 'list')
+        self.request = struct.pack('!b', Constants.REQ_LIST)
+        self.limit = None
+        self.results = []
+        self.leases = {}
+        self.pending = []
+        self.read(4, self.read_prefix_length)
+
+    def read_prefix_length(self, length_bytes):
+        self.request += length_bytes
+        length = struct.unpack('!i', length_bytes)[0]
+        self.read(length + 4, self.read_prefix)
+
+    def read_prefix(self, data):
+        self.request += data
+        length = struct.unpack('!i', data[-4:])[0]
+        self.read(length + 4, self.read_cursor)
+
+    def read_cursor(self, data):
+        self.request += data
+        self.limit = struct.unpack('!i', data[-4:])[0]
+        self.query_backends()
+
+    def query_backends(self):
+        self.pending = [backend for backend in self.frontend.backends
+                        if backend.connected()]
+        if not self.pending:
+            self.respond()
+            return
+        for backend in self.pending[:]:
+            backend.acquire(self.create_acquired_handler(backend))
+
+    def create_acquired_handler(self, backend):
+        def handler(lease):
+            self.acquired(backend, lease)
+        return handler
+
+    def acquired(self, backend, lease):
+        self.leases[backend] = lease
+        try:
+            backend.add_close_callback(self._backend_closed)
+            backend.send(self.request)
+        except NotConnected:
+            self.finish_backend(backend)
+            return
+        backend.read(1, lambda b: self.handle_status(backend, b))
+
+    def handle_status(self, backend, status_bytes):
+        status = struct.unpack('!b', status_bytes)[0]
+        self.log.debug('{}: {}'.format(backend, status))
+        if status != Constants.RESP_OK:
+            self.finish_backend(backend)
+            return
+        backend.read(9, lambda b: self.handle_header(backend, b))
+
+    def handle_header(self, backend, header_bytes):
+        more, count, length = struct.unpack('!Bii', header_bytes)
+        backend.read(length, lambda b: self.handle_records(
+            backend, bool(more), count, b))
+
+    def handle_records(self, backend, more, count, records):
+        entries = []
+        offset = 0
+        for _ in range(count):
+            size, mtime, length = self.record.unpack_from(records, offset)
+            offset += self.record.size
+            entries.append((records[offset:offset + length], size, mtime))
+            offset += length
+        self.results.append((entries, more))
+        self.finish_backend(backend)
+
+    def finish_backend(self, backend):
+        if backend not in self.pending:
+            return
+        self.pending.remove(backend)
+        backend.remove_close_callback(self._backend_closed)
+        backend.release(self.leases.pop(backend, None))
+        self.respond()
+
+    def respond(self):
+        if self.pending:
+            # Not all backends have responded yet
+            return
+        if not self.results:
+            self.finish(struct.pack('!b', Constants.RESP_ERROR))
+            return
+        cutoff = None
+        files = {}
+        for entries, more in self.results:
+            if more and entries:
+                last = entries[-1][0]
+                if cutoff is None or last < cutoff:
+                    cutoff = last
+            for path, size, mtime in entries:
+                if path not in files or files[path][1] < mtime:
+                    files[path] = (size, mtime)
+        more = cutoff is not None
+        paths = sorted(path for path in files
+                       if cutoff is None or path <= cutoff)
+        if len(paths) > self.limit:
+            paths = paths[:max(0, self.limit)]
+            more = True
+        records = []
+        for path in paths:
+            size, mtime = files[path]
+            records.append(self.record.pack(size, mtime, len(path)))
+            records.append(path)
+        records = b''.join(records)
+        data = struct.pack('!bBii', Constants.RESP_OK, more, len(paths),
+                           len(records))
+        self.finish(data + records)
+
+    def _backend_closed(self, backend):
+        self.finish_backend(backend)
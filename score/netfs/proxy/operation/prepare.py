@@ -36,12 +36,12 @@ class PrepareOperation(Operation):
         if self.frontend.transaction_backends is None:
             self.log.debug('success (no operations)!')
             data = struct.pack('!b', Constants.RESP_OK)
-            self.write(data, self.frontend.read_op)
+            self.finish(data)
             return
         if not self.frontend.transaction_backends:
             self.log.debug('error (no backends)!')
             data = struct.pack('!b', Constants.RESP_ERROR)
-            self.write(data, self.frontend.read_op)
+            self.finish(data)
             return
         self.success = False
         self.backends = self.frontend.transaction_backends[:]
@@ -67,16 +67,20 @@ class PrepareOperation(Operation):
             backend.send(data)
         self.backends.remove(backend)
         backend.remove_close_callback(self._backend_closed)
-        if self.backends:
-            return
+        if not self.backends:
+            self.finished()
+
+    def finished(self):
         if self.success:
             data = struct.pack('!b', Constants.RESP_OK)
             self.log.debug('success!')
         else:
             data = struct.pack('!b', Constants.RESP_ERROR)
-            self.frontend.transaction_backends = None
+            self.frontend.end_transaction()
             self.log.debug('error!')
-        self.write(data, self.frontend.read_op)
+        self.finish(data)
 
     def _backend_closed(self, backend):
         self.backends.remove(backend)
+        if not self.backends:
+            self.finished()
@@ -0,0 +1,115 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from .base import Operation
+import random
+import struct
+from score.netfs.constants import Constants
+from score.netfs.proxy.backend import NotConnected
+
+
+class SignatureOperation(Operation):
+    """
+    Delegates a ``signature`` request to one of the connected backends. The
+    delta upload following this request is sent to all backends of the
+    transaction, which reject it, if their version of the file differs from
+    the one described by this signature.
+    """
+
+    def __init__(self, frontend):
+        super().__init__(frontend, 'signature')
+        self.request = struct.pack('!b', Constants.REQ_SIGNATURE)
+        self.backend = None
+        self.lease = None
+        self.backends = self.frontend.backends[:]
+        self.read(4, self.read_request_name_length)
+
+    def read_request_name_length(self, length_bytes):
+        self.request += length_bytes
+        length = struct.unpack('!i', length_bytes)[0]
+        self.read(length, self.read_request_name)
+
+    def read_request_name(self, name_bytes):
+        self.request += name_bytes
+        self.response_attempt()
+
+    def response_attempt(self):
+        self.release_backend()
+        if not self.backends:
+            self.finish(struct.pack('!b', Constants.RESP_ERROR))
+            return
+        backend = random.choice(self.backends)
+        self.backends.remove(backend)
+        if not backend.connected():
+            return self.response_attempt()
+        backend.acquire(lambda lease: self.acquired(backend, lease))
+
+    def acquired(self, backend, lease):
+        try:
+            backend.add_close_callback(self._backend_closed)
+        except NotConnected:
+            backend.release(lease)
+            return self.response_attempt()
+        self.log.debug('chosen: {}'.format(backend))
+        self.backend = backend
+        self.lease = lease
+        self.backend.send(self.request)
+        self.backend.read(1, self.handle_response_status)
+
+    def release_backend(self):
+        if not self.backend:
+            return
+        self.backend.remove_close_callback(self._backend_closed)
+        self.backend.release(self.lease)
+        self.backend = None
+        self.lease = None
+
+    def handle_response_status(self, status_bytes):
+        status = struct.unpack('!b', status_bytes)[0]
+        if status == Constants.RESP_NOTFOUND:
+            self.release_backend()
+            self.finish(status_bytes)
+        elif status != Constants.RESP_OK:
+            self.response_attempt()
+        else:
+            self.backend.read(16, self.handle_response_header)
+
+    def handle_response_header(self, header_bytes):
+        length = struct.unpack('!qII', header_bytes)[2]
+        self.backend.read(length, lambda signature: self.handle_signature(
+            header_bytes, signature))
+
+    def handle_signature(self, header_bytes, signature):
+        self.release_backend()
+        self.finish(struct.pack('!b', Constants.RESP_OK) + header_bytes +
+                    signature)
+
+    def _backend_closed(self, backend):
+        assert self.backend == backend
+        self.backend = None
+        self.lease = None
+        self.log.debug('lost backend connection, retrying')
+        self.response_attempt()
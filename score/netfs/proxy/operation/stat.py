@@ -0,0 +1,141 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from .base import Operation
+import struct
+from score.netfs import hashing
+from score.netfs.constants import Constants
+from score.netfs.proxy.backend import NotConnected
+
+
+class StatOperation(Operation):
+    """
+    Delegates a ``stat`` request to all connected backends and merges their
+    responses: A file is reported as found, if any backend has it. If several
+    backends have the file, the most recently modified version wins.
+    """
+
+    header = struct.Struct('!bqi')
+
+    def __init__(self, frontend):
+        super().__init__(frontend, 'stat')
+        self.hash_name = self.frontend.hash_name
+        self.record_size = (self.header.size +
+                            hashing.digest_size(self.hash_name))
+        self.request = struct.pack('!b', Constants.REQ_STAT)
+        self.count = None
+        self.records = None
+        self.leases = {}
+        self.pending = []
+        self.read(8, self.read_header)
+
+    def read_header(self, header_bytes):
+        self.request += header_bytes
+        # malformed requests are rejected by the backends
+        self.count, length = struct.unpack('!ii', header_bytes)
+        self.read(length, self.read_names)
+
+    def read_names(self, names_bytes):
+        self.request += names_bytes
+        self.query_backends()
+
+    def query_backends(self):
+        self.pending = [backend for backend in self.frontend.backends
+                        if backend.connected()]
+        if not self.pending:
+            self.respond()
+            return
+        for backend in self.pending[:]:
+            backend.acquire(self.create_acquired_handler(backend))
+
+    def create_acquired_handler(self, backend):
+        def handler(lease):
+            self.acquired(backend, lease)
+        return handler
+
+    def acquired(self, backend, lease):
+        self.leases[backend] = lease
+        try:
+            backend.add_close_callback(self._backend_closed)
+            backend.use_hash(self.hash_name,
+                             lambda: self.send_request(backend),
+                             lambda: self.finish_backend(backend))
+        except NotConnected:
+            self.finish_backend(backend)
+
+    def send_request(self, backend):
+        backend.send(self.request)
+        backend.read(1, lambda b: self.handle_status(backend, b))
+
+    def handle_status(self, backend, status_bytes):
+        status = struct.unpack('!b', status_bytes)[0]
+        self.log.debug('{}: {}'.format(backend, status))
+        if status != Constants.RESP_OK:
+            self.finish_backend(backend)
+            return
+        backend.read(self.count * self.record_size,
+                     lambda b: self.handle_records(backend, b))
+
+    def handle_records(self, backend, records):
+        if self.records is None:
+            self.records = records
+        else:
+            self.records = b''.join(self.merge(self.records, records))
+        self.finish_backend(backend)
+
+    def merge(self, records, other):
+        size = self.record_size
+        for offset in range(0, len(records), size):
+            record = records[offset:offset + size]
+            candidate = other[offset:offset + size]
+            status, _, mtime = self.header.unpack(record[:self.header.size])
+            other_status, _, other_mtime = \
+                self.header.unpack(candidate[:self.header.size])
+            if other_status == Constants.RESP_OK and (
+                    status != Constants.RESP_OK or other_mtime > mtime):
+                yield candidate
+            else:
+                yield record
+
+    def finish_backend(self, backend):
+        if backend not in self.pending:
+            return
+        self.pending.remove(backend)
+        backend.remove_close_callback(self._backend_closed)
+        backend.release(self.leases.pop(backend, None))
+        self.respond()
+
+    def respond(self):
+        if self.pending:
+            # Not all backends have responded yet
+            return
+        if self.records is None:
+            self.finish(struct.pack('!b', Constants.RESP_ERROR))
+            return
+        self.finish(struct.pack('!b', Constants.RESP_OK) + self.records)
+
+    def _backend_closed(self, backend):
+        self.finish_backend(backend)
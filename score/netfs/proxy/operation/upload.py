@@ -26,14 +26,36 @@
 
 from .base import Operation
 import struct
+from score.netfs import compression, hashing, rsync
 from score.netfs.constants import Constants
 from score.netfs.proxy.backend import NotConnected
 
 
 class UploadOperation(Operation):
+    """
+    Delegates an upload to all backends of the transaction. If *resumable* is
+    `True`, the operation is a ``resumable upload``: each backend reports how
+    many bytes it already received and the client is asked to continue at the
+    lowest of these offsets. Backends that are further ahead skip the part of
+    the content they already have.
 
-    def __init__(self, frontend):
+    If *compressed* is `True`, the operation is a ``compressed upload``, whose
+    compressed blocks are passed on to the backends as they are. If *delta* is
+    `True`, the operation is a ``delta upload``, which succeeds only if all
+    backends were able to assemble the file. Otherwise the client uploads the
+    whole file, replacing the results of the successful backends.
+    """
+
+    def __init__(self, frontend, resumable=False, compressed=False,
+                 delta=False):
         super().__init__(frontend, 'upload')
+        self.resumable = resumable
+        self.compressed = compressed
+        self.delta = delta
+        self.statuses = []
+        self.skip = {}
+        self.offsets = {}
+        self.state = 'request'
         self.frontend.init_transaction(self.created_transaction)
 
     def created_transaction(self, transaction):
@@ -41,15 +63,30 @@ class UploadOperation(Operation):
         for backend in transaction:
             backend.add_close_callback(self._backend_closed)
         self.backends = transaction[:]
-        self.distribute(struct.pack('!b', Constants.REQ_UPLOAD))
+        if self.resumable:
+            op = Constants.REQ_UPLOAD_RESUMABLE
+        elif self.compressed:
+            op = Constants.REQ_UPLOAD_COMPRESSED
+        elif self.delta:
+            op = Constants.REQ_UPLOAD_DELTA
+        else:
+            op = Constants.REQ_UPLOAD
+        self.distribute(struct.pack('!b', op))
         self.read(4, self.handle_name_length)
 
     def distribute(self, data):
         self.log.debug('delegating to {} backends: {}'.
                        format(len(self.backends), data))
         for backend in self.backends:
+            chunk = data
+            skip = self.skip.get(backend)
+            if skip:
+                self.skip[backend] = max(0, skip - len(chunk))
+                chunk = chunk[skip:]
+                if not chunk:
+                    continue
             try:
-                backend.send(data)
+                backend.send(chunk)
             except NotConnected:
                 pass
 
@@ -60,27 +97,132 @@ class UploadOperation(Operation):
 
     def handle_name(self, name_bytes):
         self.distribute(name_bytes)
+        self.frontend.add_upload(str(name_bytes, 'UTF-8'))
         self.read(8, self.handle_content_length)
 
     def handle_content_length(self, length_bytes):
         self.distribute(length_bytes)
-        length = struct.unpack('!q', length_bytes)[0]
-        self.read(length, self.read_hash, streaming_callback=self.handle_chunk)
+        self.length = struct.unpack('!q', length_bytes)[0]
+        if self.resumable:
+            self.read(16, self.handle_token)
+        elif self.compressed:
+            self.read(1, self.handle_codec)
+        elif self.delta:
+            self.read(4, self.handle_block_size)
+        else:
+            self.read_content()
+
+    def handle_block_size(self, size_bytes):
+        self.distribute(size_bytes)
+        self.read_instruction()
+
+    def read_instruction(self, _=None):
+        self.read(1, self.handle_instruction)
+
+    def handle_instruction(self, type_bytes):
+        self.distribute(type_bytes)
+        instruction = struct.unpack('!B', type_bytes)[0]
+        if instruction == rsync.END:
+            self.read_hash(None)
+        elif instruction == rsync.LITERAL:
+            self.read(4, self.handle_literal_length)
+        elif instruction == rsync.COPY:
+            self.read(8, self.handle_copy)
+        else:
+            self.log.debug('bogus delta instruction, terminating')
+            self.frontend.terminate()
+
+    def handle_literal_length(self, length_bytes):
+        self.distribute(length_bytes)
+        length = struct.unpack('!I', length_bytes)[0]
+        self.read(length, self.read_instruction,
+                  streaming_callback=self.handle_chunk)
+
+    def handle_copy(self, copy_bytes):
+        self.distribute(copy_bytes)
+        self.read_instruction()
+
+    def handle_codec(self, codec_bytes):
+        self.distribute(codec_bytes)
+        self.read_block_length()
+
+    def read_block_length(self, _=None):
+        self.read(4, self.handle_block_length)
+
+    def handle_block_length(self, length_bytes):
+        self.distribute(length_bytes)
+        length = struct.unpack('!I', length_bytes)[0]
+        if not length:
+            self.read_hash(None)
+        elif length > compression.MAX_BLOCK_SIZE:
+            self.log.debug('oversized block, terminating')
+            self.frontend.terminate()
+        else:
+            self.read(length, self.read_block_length,
+                      streaming_callback=self.handle_chunk)
+
+    def handle_token(self, token_bytes):
+        self.distribute(token_bytes)
+        self.state = 'offsets'
+        if not self.backends:
+            self.handle_offsets()
+            return
+        for backend in self.backends[:]:
+            backend.read(9, self.create_offset_handler(backend))
+
+    def create_offset_handler(self, backend):
+        def handler(b):
+            self.handle_backend_offset(backend, b)
+        return handler
+
+    def handle_backend_offset(self, backend, response_bytes):
+        status, offset = struct.unpack('!bq', response_bytes)
+        self.log.debug('{}: {} at {}'.format(backend, status, offset))
+        if status == Constants.RESP_OK:
+            self.offsets[backend] = offset
+        else:
+            # the backend does not expect any content, so it must not take
+            # part in the remainder of this operation
+            backend.remove_close_callback(self._backend_closed)
+            self.backends.remove(backend)
+            self.frontend.remove_from_transaction(backend)
+        if len(self.offsets) < len(self.backends):
+            return
+        self.handle_offsets()
+
+    def handle_offsets(self):
+        self.state = 'content'
+        if not self.backends:
+            result = struct.pack('!bq', Constants.RESP_ERROR, 0)
+            self.finish(result)
+            return
+        offset = min(self.offsets[backend] for backend in self.backends)
+        for backend in self.backends:
+            self.skip[backend] = self.offsets[backend] - offset
+        self.length -= offset
+        result = struct.pack('!bq', Constants.RESP_OK, offset)
+        self.write(result, self.read_content)
+
+    def read_content(self):
+        self.read(self.length, self.read_hash,
+                  streaming_callback=self.handle_chunk)
 
     def handle_chunk(self, chunk):
         self.distribute(chunk)
 
     def read_hash(self, _):
-        self.read(512 // 8, self.handle_hash)
+        self.read(hashing.digest_size(self.frontend.hash_name),
+                  self.handle_hash)
 
     def handle_hash(self, hash_bytes):
         if not self.transaction:
             # not a single backend connection received the upload in full,
             # return error response
             result = struct.pack('!b', Constants.RESP_ERROR)
-            self.write(result, self.frontend.read_op)
+            self.finish(result)
             return
         self.distribute(hash_bytes)
+        self.state = 'responses'
         for backend in self.transaction:
             backend.read(1, self.create_backend_handler(backend))
 
@@ -94,16 +236,30 @@ class UploadOperation(Operation):
         self.backends.remove(backend)
         status = struct.unpack('!b', status_bytes)[0]
         self.log.debug('{}: {}'.format(backend, status))
-        if status != Constants.RESP_OK:
+        if self.delta and status == Constants.RESP_NOTFOUND:
+            # the backend remains in the transaction for the full upload
+            self.statuses.append(status)
+        elif status != Constants.RESP_OK:
             self.frontend.remove_from_transaction(backend)
+        self.respond()
+
+    def respond(self):
         if self.backends:
             # Not all backends have responded yet
             return
         if not self.transaction:
             result = struct.pack('!b', Constants.RESP_ERROR)
+        elif self.statuses:
+            result = struct.pack('!b', Constants.RESP_NOTFOUND)
         else:
             result = struct.pack('!b', Constants.RESP_OK)
-        self.write(result, self.frontend.read_op)
+        self.finish(result)
 
     def _backend_closed(self, backend):
         self.backends.remove(backend)
+        if self.state == 'offsets':
+            self.offsets.pop(backend, None)
+            if len(self.offsets) == len(self.backends):
+                self.handle_offsets()
+        elif self.state == 'responses':
+            self.respond()
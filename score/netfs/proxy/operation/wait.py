@@ -0,0 +1,91 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from .base import Operation
+import struct
+from tornado.ioloop import IOLoop
+from score.netfs.constants import Constants
+
+
+class WaitOperation(Operation):
+    """
+    Answers a ``wait`` request without involving the backends, as a request
+    waiting on a shared backend connection would hold up all other requests
+    on that connection. The proxy waits for the uploads passing through it
+    instead, which are only finished once every backend of the transaction
+    committed or aborted them.
+    """
+
+    #: The longest time in seconds a request may wait.
+    MAX_WAIT = 300
+
+    def __init__(self, frontend):
+        super().__init__(frontend, 'wait')
+        self.loop = IOLoop.current()
+        self.uploads = self.frontend.server.uploads
+        self.name = None
+        self.timeout = None
+        self.read(4, self.read_name_length)
+
+    def read_name_length(self, length_bytes):
+        length = struct.unpack('!i', length_bytes)[0]
+        self.read(length, self.read_name)
+
+    def read_name(self, name_bytes):
+        self.name = str(name_bytes, 'UTF-8')
+        self.log.debug('name = {}'.format(self.name))
+        self.read(4, self.read_timeout)
+
+    def read_timeout(self, timeout_bytes):
+        timeout = struct.unpack('!I', timeout_bytes)[0] / 1000
+        if self.name in self.frontend.uploads:
+            # our own upload would never finish while we are waiting
+            self.finish(struct.pack('!b', Constants.RESP_UPLOADING))
+            return
+        if not self.uploads.wait(self.name, self.woken):
+            self.finish(struct.pack('!b', Constants.RESP_OK))
+            return
+        self.timeout = self.loop.call_later(
+            min(timeout, self.MAX_WAIT), self.expired)
+
+    def woken(self):
+        # uploads are finished on the IOLoop, but possibly in the middle of
+        # another operation
+        self.loop.add_callback(self.resume)
+
+    def resume(self):
+        if self.timeout is None:
+            return
+        self.loop.remove_timeout(self.timeout)
+        self.timeout = None
+        self.log.debug('done')
+        self.finish(struct.pack('!b', Constants.RESP_OK))
+
+    def expired(self):
+        self.timeout = None
+        self.uploads.cancel(self.name, self.woken)
+        self.log.debug('expired')
+        self.finish(struct.pack('!b', Constants.RESP_UPLOADING))
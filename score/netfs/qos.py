@@ -0,0 +1,200 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+Bandwidth limits and weighted fair sharing for the transfers of a
+:class:`StorageServer <score.netfs.server.StorageServer>`.
+
+Every connection asks the server's :class:`Scheduler` for permission before
+transferring the next portion of a file. The scheduler delays the permission
+until the configured limits allow the transfer, so a single client can no
+longer starve all others by saturating the storage node.
+
+The scheduler runs on the IOLoop only, which is why no locking takes place.
+"""
+
+import heapq
+import itertools
+from tornado.ioloop import IOLoop
+
+
+#: The kinds of transfers distinguished by the :class:`Scheduler`.
+KINDS = ('upload', 'download')
+
+
+class TokenBucket:
+    """
+    Admits *rate* bytes per second on average, allowing bursts of up to
+    *burst* bytes, which defaults to the amount of a whole second.
+
+    Transfers may exceed the available tokens, in which case the bucket goes
+    into debt and following transfers must wait until it is paid off.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = None
+
+    def delay(self, now):
+        """
+        Returns the number of seconds until the bucket is out of debt.
+        """
+        self._refill(now)
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def take(self, amount, now):
+        """
+        Removes the tokens for a transfer of *amount* bytes.
+        """
+        self._refill(now)
+        self.tokens -= amount
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class _Flow:
+    """
+    The transfers of a single connection, as seen by the :class:`Scheduler`.
+    """
+
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.finish = 0
+        self.closed = False
+
+
+class Scheduler:
+    """
+    Decides when the connections of a server may transfer their data.
+
+    The limits are given in bytes per second, where `None` stands for no
+    limit at all:
+
+    - *rate* limits the bandwidth of all transfers taken together,
+    - *connection_rate* limits the bandwidth of each connection and
+    - *limits* maps :data:`KINDS` to the bandwidth of all transfers of the
+      kind.
+
+    Transfers waiting for the total *rate* are granted in the order of
+    start-time fair queuing: Each connection gets a share of the bandwidth
+    proportional to the weight of its current kind of transfer, as given in
+    *weights*, which defaults to 1 for each kind. Increasing the weight of
+    downloads keeps them responsive while other clients are uploading large
+    amounts of data, for example.
+    """
+
+    def __init__(self, rate=None, *, connection_rate=None, limits=None,
+                 weights=None):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.connection_rate = connection_rate
+        self.limits = {kind: TokenBucket(limit)
+                       for kind, limit in (limits or {}).items()
+                       if limit}
+        self.weights = dict.fromkeys(KINDS, 1)
+        self.weights.update(weights or {})
+        self.flows = {}
+        self.delayed = 0
+        self.queue = []
+        self.vtime = 0
+        self.timer = None
+        self._counter = itertools.count()
+
+    def __len__(self):
+        """
+        The number of transfers waiting for permission.
+        """
+        return self.delayed + len(self.queue)
+
+    def request(self, connection, kind, amount, callback):
+        """
+        Calls *callback* on the IOLoop as soon as the *connection* may
+        transfer *amount* bytes of given *kind*.
+        """
+        flow = self.flows.get(connection)
+        if flow is None:
+            flow = self.flows[connection] = _Flow(self.connection_rate)
+        loop = IOLoop.current()
+        now = loop.time()
+        buckets = [bucket for bucket in (flow.bucket, self.limits.get(kind))
+                   if bucket is not None]
+        delay = max((bucket.delay(now) for bucket in buckets), default=0)
+        for bucket in buckets:
+            bucket.take(amount, now)
+        if not delay:
+            self._enqueue(flow, kind, amount, callback)
+            return
+        self.delayed += 1
+
+        def delayed():
+            self.delayed -= 1
+            if not flow.closed:
+                self._enqueue(flow, kind, amount, callback)
+
+        loop.call_later(delay, delayed)
+
+    def remove(self, connection):
+        """
+        Forgets about a closed *connection*. Its pending transfers are
+        dropped.
+        """
+        flow = self.flows.pop(connection, None)
+        if flow is not None:
+            flow.closed = True
+
+    def _enqueue(self, flow, kind, amount, callback):
+        if self.bucket is None:
+            IOLoop.current().add_callback(callback)
+            return
+        start = max(self.vtime, flow.finish)
+        flow.finish = start + amount / self.weights[kind]
+        heapq.heappush(self.queue,
+                       (start, next(self._counter), flow, amount, callback))
+        if self.timer is None:
+            self._dispatch()
+
+    def _dispatch(self):
+        loop = IOLoop.current()
+        self.timer = None
+        now = loop.time()
+        while self.queue:
+            delay = self.bucket.delay(now)
+            if delay:
+                self.timer = loop.call_later(delay, self._dispatch)
+                return
+            start, _, flow, amount, callback = heapq.heappop(self.queue)
+            if flow.closed:
+                continue
+            self.vtime = start
+            self.bucket.take(amount, now)
+            loop.add_callback(callback)
@@ -0,0 +1,186 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+"""
+Signatures and deltas for :ref:`delta uploads <netfs_protocol_upload_delta>`.
+
+The server splits its version of a file into blocks and sends a signature
+consisting of a weak and a strong checksum per block. The weak checksum is
+the Adler-32 checksum of the block, which can be rolled along the content of
+the new version cheaply, while the strong checksum confirms a match.
+"""
+
+import hashlib
+import os
+import struct
+import zlib
+
+
+END = 0
+
+LITERAL = 1
+
+COPY = 2
+
+MIN_BLOCK_SIZE = 1024 * 2
+
+MAX_BLOCK_SIZE = 1024 * 128
+
+STRONG_SIZE = 16
+
+RECORD = struct.Struct('!I%ds' % STRONG_SIZE)
+
+#: The number of bytes the client rolls its weak checksum over after a block
+#: did not match, in multiples of the block size, but at least `SCAN_SIZE`
+#: bytes. Content shifted by more than that is sent literally.
+SCAN_BLOCKS = 2
+
+SCAN_SIZE = 1024 * 64
+
+_MOD = 65521
+
+
+def block_size(size):
+    """
+    Returns the block size for signatures of files with given *size*. The size
+    is roughly the square root of the file size, which keeps both the
+    signature and the literal data for each changed block small.
+    """
+    size = int(size ** 0.5) + 1023 & ~1023
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+
+def strong(data):
+    """
+    Returns the strong checksum of a block.
+    """
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+def signature(fd, size, block_size, chunk_size=1024 * 1024):
+    """
+    Calculates the signature of the first *size* bytes of the file with given
+    file descriptor *fd* and returns it as bytes.
+    """
+    records = []
+    offset = 0
+    chunk_size -= chunk_size % block_size
+    while offset < size:
+        chunk = os.pread(fd, min(chunk_size, size - offset), offset)
+        if not chunk:
+            break
+        for start in range(0, len(chunk), block_size):
+            block = chunk[start:start + block_size]
+            records.append(RECORD.pack(zlib.adler32(block), strong(block)))
+        offset += len(chunk)
+    return b''.join(records)
+
+
+class Signature:
+    """
+    The parsed signature of a file with given *size*.
+    """
+
+    def __init__(self, data, size, block_size):
+        self.size = size
+        self.block_size = block_size
+        self.blocks = {}
+        count = len(data) // RECORD.size
+        self.last = None
+        for index in range(count):
+            weak, digest = RECORD.unpack_from(data, index * RECORD.size)
+            if index == count - 1 and size % block_size:
+                # the last block is shorter than the others
+                self.last = (weak, digest, index, size % block_size)
+                break
+            self.blocks.setdefault(weak, {}).setdefault(digest, index)
+
+    def find(self, weak, data):
+        """
+        Returns the index of the block with the given *weak* checksum, that
+        matches *data*, or `None`.
+        """
+        candidates = self.blocks.get(weak)
+        if candidates is None:
+            return None
+        return candidates.get(strong(data))
+
+    def delta(self, data):
+        """
+        Returns the instructions for assembling *data*, a bytes-like object
+        containing the new version of the file: tuples `(COPY, index, count)`
+        for copying *count* blocks starting at block *index* and `(LITERAL,
+        start, end)` for sending the data between given offsets.
+        """
+        size = len(data)
+        bs = self.block_size
+        instructions = []
+        literal = 0
+
+        def match(pos, index, end):
+            nonlocal literal
+            if literal < pos:
+                instructions.append((LITERAL, literal, pos))
+            last = instructions[-1] if instructions else None
+            if last and last[0] == COPY and last[1] + last[2] == index:
+                instructions[-1] = (COPY, last[1], last[2] + 1)
+            else:
+                instructions.append((COPY, index, 1))
+            literal = end
+
+        scan = max(SCAN_BLOCKS * bs, SCAN_SIZE)
+        pos = 0
+        scan_end = scan
+        weak = None
+        while pos + bs <= size:
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + bs])
+            index = self.find(weak, data[pos:pos + bs])
+            if index is not None:
+                match(pos, index, pos + bs)
+                pos += bs
+                scan_end = pos + scan
+                weak = None
+            elif pos < scan_end and pos + bs < size:
+                # roll the checksum one byte further
+                out, new = data[pos], data[pos + bs]
+                a = ((weak & 0xffff) - out + new) % _MOD
+                b = ((weak >> 16) - bs * out + a - 1) % _MOD
+                weak = b << 16 | a
+                pos += 1
+            else:
+                pos += bs
+                weak = None
+        if self.last:
+            weak, digest, index, length = self.last
+            pos = size - length
+            tail = data[pos:]
+            if pos >= literal and zlib.adler32(tail) == weak and \
+                    strong(tail) == digest:
+                match(pos, index, size)
+        if literal < size:
+            instructions.append((LITERAL, literal, size))
+        return instructions
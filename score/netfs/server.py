@@ -24,14 +24,27 @@
 # the discretion of STRG.AT GmbH also the competent court, in whose district the
 # Licensee has his registered seat, an establishment or assets.
 
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import fcntl
 import logging
-import hashlib
 import os
 import shutil
 import struct
 import tempfile
+import time
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import SSLIOStream
 from tornado.tcpserver import TCPServer
+from . import compression, hashing, rsync
+from .metrics import Metrics, OPERATIONS
+from .qos import Scheduler
 from .constants import Constants
+from .multiplex import StreamMultiplexer, VirtualStream
+from .storage import (
+    BlobIndex, ChangeJournal, DigestIndex, FolderSync, IndexUnavailable,
+    InFlightUploads, MetadataCache, NamespaceIndex, ResponseCache,
+    SerialExecutor, read_layout)
 
 
 log = logging.getLogger(__name__)
@@ -41,16 +54,127 @@ class UploadError(Exception):
     pass
 
 
+def _file_digest(file, offset, length, chunk_size, algorithm):
+    """
+    Calculates the hash of *length* bytes of given :term:`file object`,
+    starting at *offset*, using given *algorithm* without altering its current
+    position.
+    """
+    sha = hashing.new(algorithm)
+    end = offset + length
+    while offset < end:
+        chunk = os.pread(file.fileno(), min(chunk_size, end - offset), offset)
+        if not chunk:
+            raise OSError('File truncated: {}'.format(file.name))
+        sha.update(chunk)
+        offset += len(chunk)
+    return sha.digest()
+
+
+def _copy_file(source, target, length, chunk_size):
+    """
+    Copies *length* bytes from file descriptor *source* to file descriptor
+    *target*, starting at their current positions. The copy is performed by the
+    kernel, where possible, which can even share the data blocks of both files
+    on file systems supporting it.
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    while length:
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(source, target, length)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP):
+                    raise
+                copy_file_range = None
+                continue
+        else:
+            chunk = os.read(source, min(chunk_size, length))
+            copied = len(chunk)
+            while chunk:
+                chunk = chunk[os.write(target, chunk):]
+        if not copied:
+            raise OSError('Source file truncated')
+        length -= copied
+
+
+def _has_space(fd, size):
+    """
+    Tests whether the file system containing the file opened as *fd* has at
+    least *size* bytes of free space, that may be used by unprivileged users.
+    """
+    stat = os.fstatvfs(fd)
+    return stat.f_bavail * stat.f_frsize >= size
+
+
+def _unpack_names(data, count):
+    """
+    Decodes *count* UTF-8 encoded names from *data*, each of which is prefixed
+    with its length. Raises a :class:`ValueError` if *data* is malformed.
+    """
+    names = []
+    offset = 0
+    for _ in range(count):
+        length = struct.unpack_from('!i', data, offset)[0]
+        offset += 4
+        if length < 0 or offset + length > len(data):
+            raise ValueError('Invalid name length')
+        names.append(str(data[offset:offset + length], 'UTF-8'))
+        offset += length
+    if offset != len(data):
+        raise ValueError('Trailing data')
+    return names
+
+
+def _is_linked(fd, path):
+    """
+    Tests whether the file at *path* is the file opened as *fd*.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fdstat = os.fstat(fd)
+    return (stat.st_dev, stat.st_ino) == (fdstat.st_dev, fdstat.st_ino)
+
+
+def _open_locked(path, flags):
+    """
+    Opens the file at *path* with given *flags*, locks it with
+    :func:`fcntl.flock` and returns the file descriptor. Returns `None`, if the
+    file is locked by someone else.
+    """
+    while True:
+        fd = os.open(path, flags | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        # the previous owner of the lock might have renamed or removed the
+        # file while we were waiting for the lock
+        if _is_linked(fd, path):
+            return fd
+        os.close(fd)
+
+
 class FileUpload:
     """
     An ongoing file upload process. After this object is created, it expects the
     following members to be set in the specified order:
 
     - ``upload.path = 'path/to/file'``
+    - ``upload.open()``
+    - ``upload.reserve(size)`` (optional)
     - ``upload.write(chunk)``
-    - ``upload.hash = sha512-hash``
+    - ``upload.hash = hash``
     - ``upload.finish()``
 
+    All methods, except for the *path* setter, block on disk access and are
+    supposed to be called in the communication's
+    :class:`SerialExecutor <score.netfs.storage.SerialExecutor>`.
+
     All errors will be silantly registered, up until the call to
     :meth:`.finish`. That last function call will either return `None` (in case
     of success), or raise an UploadError with a message describing the error
@@ -59,14 +183,23 @@ class FileUpload:
     If any of the file chunks could not be written, for example, the upload will
     continue normally and will raise an :class:`.UploadError` when
     :meth:`.finish` is called with the message "ErrorWritingFile".
+
+    The temporary file is locked with :func:`fcntl.flock` until the upload is
+    committed or aborted. This guarantees that the same file is not uploaded
+    by two clients at once, even if they are served by different processes.
+    While the lock is held, the path is registered in the server's
+    :class:`InFlightUploads <score.netfs.storage.InFlightUploads>`.
     """
 
     def __init__(self, communication):
         self.communication = communication
         self._path = None
-        self.sha = hashlib.sha512()
+        self.tmp = None
+        self.file = None
+        self.sha = communication.new_hash()
         self._error = None
         self.committed = False
+        self.reserved = False
 
     @property
     def path(self):
@@ -75,30 +208,123 @@ class FileUpload:
     @path.setter
     def path(self, value):
         """
-        Sets the path, makes sure the designated folder exists and creates a
-        lock file to prevent parallell processing of the same file.
+        Sets the path and removes any previous upload of the same file from the
+        current transaction.
         """
         self._path = value
-        os.makedirs(os.path.dirname(value), exist_ok=True)
         self.tmp = value + '.tmp'
         try:
             op = next(op
                       for op in self.communication.transaction
                       if isinstance(op, FileUpload) and op.tmp == self.tmp)
-            op.abort()
             self.communication.transaction.remove(op)
+            self.communication.io.submit(op.abort)
         except StopIteration:
             pass
+
+    def open(self):
+        """
+        Makes sure the designated folder exists and creates a lock file to
+        prevent parallell processing of the same file.
+
+        A temporary file, that is not locked, was left behind by a crashed
+        process and will be taken over.
+        """
+        server = self.communication.server
+        folder = os.path.dirname(self.path)
         try:
-            self.file = open(self.tmp, 'xb')
+            server.make_folder(folder)
+            try:
+                fd = _open_locked(self.tmp, os.O_WRONLY)
+            except FileNotFoundError:
+                # the folder was removed by other means since it was cached
+                server.metadata.discard_folder(folder)
+                server.make_folder(folder)
+                fd = _open_locked(self.tmp, os.O_WRONLY)
+            if fd is None:
+                self.error = 'FileLocked'
+                return
+            os.ftruncate(fd, 0)
+            self.file = os.fdopen(fd, 'wb')
+            server.uploads.add(self.path)
         except OSError as e:
             log.error(e)
             self.error = 'ErrorOpeningFile'
 
+    def link(self, size):
+        """
+        Fills the temporary file with a copy of an existing file of given
+        *size* and the *hash*, that must have been set beforehand. The existing
+        file is looked up in the server's :class:`BlobIndex
+        <score.netfs.storage.BlobIndex>`.
+
+        Returns `False`, if there is no such file, in which case the file
+        content must be uploaded as usual. Raises an :class:`.UploadError` if
+        the temporary file could not be written. Otherwise the upload is ready
+        to be committed and neither :meth:`.write`, nor :meth:`.finish` may be
+        called.
+        """
+        server = self.communication.server
+        source = server.blobs.get(self.sha.name, self.hash)
+        if source is None:
+            return False
+        try:
+            with open(source, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                if stat.st_size != size:
+                    return False
+                digest = server.digests.get(source, self.sha.name, stat)
+                if digest != self.hash:
+                    # the file was changed since it was added to the index
+                    return False
+                self.open()
+                if self.error is None:
+                    _copy_file(file.fileno(), self.file.fileno(), size,
+                               self.communication.CHUNK_SIZE)
+        except OSError as e:
+            log.error(e)
+            if self.file is None:
+                return False
+            self.error = 'ErrorWritingFile'
+        if self.error:
+            raise UploadError(self.error)
+        return True
+
+    def reserve(self, size):
+        """
+        Makes sure there is enough free disk space for a file of given *size*
+        and sets the error "InsufficientSpace" otherwise. Files of at least the
+        server's *preallocate_size* are allocated in one piece, so that they
+        are not fragmented by the many small writes of the upload.
+        """
+        if self.error:
+            return
+        try:
+            if not _has_space(self.file.fileno(), size):
+                self.error = 'InsufficientSpace'
+                return
+            if size < self.communication.server.preallocate_size or \
+                    not hasattr(os, 'posix_fallocate'):
+                return
+            os.posix_fallocate(self.file.fileno(), 0, size)
+            self.reserved = True
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                self.error = 'InsufficientSpace'
+            elif e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                # file systems without support for preallocation are fine
+                log.error(e)
+                self.error = 'ErrorOpeningFile'
+
     def __del__(self):
         """
         Remove temporary file on destruction.
         """
+        if self.file is None and not self.committed:
+            # the temporary file is not ours
+            return
+        if self.file is not None:
+            self.communication.server.uploads.remove(self.path)
         if self.tmp is None:
             return
         try:
@@ -111,6 +337,8 @@ class FileUpload:
             os.unlink(self.path)
             if self.tmp:
                 shutil.move(self.tmp, self.path)
+            self.communication.server.digests.remove(self.path)
+            self.communication.server.file_changed(self.path)
         self.error = 'Aborted'
 
     def prepare(self):
@@ -121,6 +349,13 @@ class FileUpload:
         # test if the target path is writable
         open(self.path, 'ab')
 
+    def sync(self):
+        """
+        Makes sure the content of the temporary file is on disk. This is done
+        before :meth:`.commit`, if the server is *durable*.
+        """
+        os.fsync(self.file.fileno())
+
     def commit(self):
         """
         Commits this operation, i.e. moves the temporary file to its rightful
@@ -136,6 +371,29 @@ class FileUpload:
             shutil.move(self.tmp, self.path)
             self.tmp = None
         self.committed = True
+        self.file.close()
+        self.file = None
+        self.communication.server.file_changed(self.path)
+        try:
+            self.communication.server.store_digest(
+                self.path, self.sha.name, self.hash)
+        except OSError as e:
+            # the hash will be re-calculated on the next download
+            log.error(e)
+        self.communication.server.uploads.remove(self.path)
+
+    def cleanup(self):
+        """
+        Removes the previous version of the file, that was kept by
+        :meth:`.commit` in case the transaction needed to be aborted.
+        """
+        if not self.committed or self.tmp is None:
+            return
+        try:
+            os.unlink(self.tmp)
+        except OSError as e:
+            log.error(e)
+        self.tmp = None
 
     def write(self, chunk):
         """
@@ -149,13 +407,31 @@ class FileUpload:
         except OSError:
             self.error = 'ErrorWritingFile'
 
+    def write_block(self, codec, block):
+        """
+        Decompresses a block of a compressed upload, that was compressed with
+        given *codec*, and writes its content.
+        """
+        if self.error:
+            return
+        try:
+            chunk = compression.decompress(codec, block)
+        except compression.CorruptBlock:
+            self.error = 'CorruptBlock'
+            return
+        self.write(chunk)
+
     def finish(self):
         """
         Wraps up the upload process. See class description for details.
         """
         if self.error is None:
             try:
-                self.file.close()
+                # the file remains open, as it holds the lock
+                self.file.flush()
+                if self.reserved:
+                    # drop the space reserved for data that never arrived
+                    self.file.truncate()
             except OSError:
                 self.error = 'ErrorClosingFile'
             else:
@@ -173,12 +449,238 @@ class FileUpload:
         """
         Removes temporary file on error.
         """
-        self.file = None
         self._error = error
+        if self.file is None:
+            return
         try:
             os.unlink(self.tmp)
         except:
             pass
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+        self.communication.server.uploads.remove(self.path)
+
+
+class ResumableUpload(FileUpload):
+    """
+    A :class:`.FileUpload`, that stores the received data in a partial file
+    identified by a *token* chosen by the client. If the upload is interrupted,
+    the partial file is kept and another upload with the same token continues
+    where the previous one stopped.
+
+    The *token* and the announced *length* of the file must be set before
+    calling :meth:`.open`, which will set *offset* to the number of bytes
+    already received. Upon successful completion, the partial file becomes the
+    temporary file of the upload and is treated like that of any other
+    :class:`.FileUpload`.
+    """
+
+    def __init__(self, communication):
+        super().__init__(communication)
+        self.token = None
+        self.length = None
+        self.offset = 0
+        self.partial = None
+        self.partial_file = None
+
+    def open(self):
+        """
+        Opens the temporary file, as well as the partial file, calculating the
+        hash of the data already received.
+        """
+        super().open()
+        if self.error:
+            return
+        folder = self.communication.server.partial_folder
+        self.partial = os.path.join(folder, self.token.hex())
+        try:
+            self.communication.server.make_folder(folder)
+            fd = _open_locked(self.partial, os.O_RDWR)
+            if fd is None:
+                self.error = 'FileLocked'
+                return
+            self.partial_file = os.fdopen(fd, 'r+b')
+            if self._read_info() == (self.length, self._relpath()):
+                self.offset = os.fstat(fd).st_size
+            if self.offset > self.length:
+                self.offset = 0
+            if not self.offset:
+                self.partial_file.truncate(0)
+                self._write_info()
+            chunk_size = self.communication.CHUNK_SIZE
+            for chunk in iter(lambda: self.partial_file.read(chunk_size), b''):
+                self.sha.update(chunk)
+        except OSError as e:
+            log.error(e)
+            self.error = 'ErrorOpeningFile'
+
+    def reserve(self, size):
+        """
+        Makes sure there is enough free disk space for the rest of the file.
+        The partial file is never preallocated, as its size is the offset to
+        continue at.
+        """
+        if self.error:
+            return
+        try:
+            if not _has_space(self.partial_file.fileno(), size - self.offset):
+                self.error = 'InsufficientSpace'
+        except OSError as e:
+            log.error(e)
+            self.error = 'ErrorOpeningFile'
+
+    def _relpath(self):
+        return os.path.relpath(self.path, self.communication.server.root)
+
+    def _read_info(self):
+        try:
+            with open(self.partial + '.info', 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        return struct.unpack('!q', data[:8])[0], str(data[8:], 'UTF-8')
+
+    def _write_info(self):
+        with open(self.partial + '.info', 'wb') as file:
+            file.write(struct.pack('!q', self.length))
+            file.write(self._relpath().encode('UTF-8'))
+
+    def write(self, chunk):
+        """
+        Appends a part of the file to the partial file.
+        """
+        if self.error:
+            return
+        try:
+            self.partial_file.write(chunk)
+            self.sha.update(chunk)
+        except OSError:
+            self.error = 'ErrorWritingFile'
+
+    def finish(self):
+        """
+        Verifies the hash and turns the partial file into the temporary file
+        of this upload. A partial file with an invalid hash is removed.
+        """
+        if self.error is None:
+            try:
+                self.partial_file.flush()
+            except OSError:
+                self.error = 'ErrorClosingFile'
+            else:
+                if self.sha.digest() != self.hash:
+                    self._remove_partial()
+                    self.error = 'HashMismatch'
+        if self.error:
+            raise UploadError(self.error)
+        try:
+            # the partial file is locked as well, so the temporary file remains
+            # locked after this rename
+            os.replace(self.partial, self.tmp)
+        except OSError as e:
+            log.error(e)
+            self.error = 'ErrorClosingFile'
+            raise UploadError(self.error)
+        self.file.close()
+        self.file, self.partial_file = self.partial_file, None
+        try:
+            os.unlink(self.partial + '.info')
+        except OSError:
+            pass
+
+    def _remove_partial(self):
+        for path in (self.partial, self.partial + '.info'):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    @FileUpload.error.setter
+    def error(self, error):
+        """
+        Removes the temporary file on error, but keeps the partial file.
+        """
+        FileUpload.error.fset(self, error)
+        if self.partial_file is not None:
+            try:
+                self.partial_file.close()
+            except OSError:
+                pass
+            self.partial_file = None
+
+
+class DeltaUpload(FileUpload):
+    """
+    A :class:`.FileUpload`, whose content is assembled from literal data sent
+    by the client and blocks of the file currently stored at the same path,
+    the *basis*. The *block_size* of the basis' signature must be set before
+    calling :meth:`.copy`.
+
+    Errors listed in `BASIS_ERRORS` indicate, that the basis is missing or
+    differs from the one the client based its delta upon. The client must
+    upload the whole file in that case.
+    """
+
+    BASIS_ERRORS = ('BasisNotFound', 'InvalidBlock', 'HashMismatch')
+
+    def __init__(self, communication):
+        super().__init__(communication)
+        self.basis = None
+        self.block_size = None
+
+    def open(self):
+        """
+        Opens the temporary file and the basis.
+        """
+        super().open()
+        if self.error:
+            return
+        try:
+            self.basis = open(self.path, 'rb')
+        except OSError:
+            self.error = 'BasisNotFound'
+
+    def copy(self, index, count):
+        """
+        Appends *count* blocks of the basis, starting at block *index*.
+        """
+        if self.error:
+            return
+        offset = index * self.block_size
+        end = offset + count * self.block_size
+        chunk_size = self.communication.CHUNK_SIZE
+        try:
+            while offset < end:
+                chunk = os.pread(self.basis.fileno(),
+                                 min(chunk_size, end - offset), offset)
+                if not chunk:
+                    break
+                self.write(chunk)
+                offset += len(chunk)
+        except OSError as e:
+            log.error(e)
+            self.error = 'ErrorReadingBasis'
+            return
+        if offset == index * self.block_size:
+            self.error = 'InvalidBlock'
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            self._close_basis()
+
+    def abort(self):
+        self._close_basis()
+        super().abort()
+
+    def _close_basis(self):
+        if self.basis is not None:
+            self.basis.close()
+            self.basis = None
 
 
 class Communication:
@@ -186,14 +688,46 @@ class Communication:
     The conversation between a client and this server process. See
     :ref:`narrative documentation <netfs_protocol>` for the details of the whole
     communication.
+
+    All blocking disk operations of a communication are performed in its
+    :class:`SerialExecutor <score.netfs.storage.SerialExecutor>` *io*.
+
+    The hash algorithm used for verifying transfers is stored in *hash_name*
+    and may be changed by the client with a :ref:`hello
+    <netfs_protocol_hello>` request.
     """
 
     CHUNK_SIZE = 1024 * 32
 
+    UPLOAD_READ_SIZE = 1024 * 1024
+
+    MAX_PENDING_WRITES = 8
+
+    MAX_LIST_ENTRIES = 10000
+
+    #: The longest time in seconds a ``wait`` request may wait.
+    MAX_WAIT = 300
+
+    #: How often in seconds to look for the temporary files of other
+    #: processes while waiting.
+    WAIT_POLL_INTERVAL = 0.25
+
     def __init__(self, server, stream):
         self.server = server
         self.stream = stream
         self.transaction = []
+        self.uploading = None
+        self.hash_name = hashing.DEFAULT
+        self.client_version = 0
+        self.io = SerialExecutor(server.executor)
+        self.loop = IOLoop.current()
+        self.metrics = server.metrics
+        self.op_name = None
+        self.op_started = None
+        server.communications.add(self)
+        # responses consist of several small writes, which must not wait for
+        # the acknowledgement of the previous ones
+        stream.set_nodelay(True)
         stream.set_close_callback(self.stream_closed)
         self.read_op()
 
@@ -201,23 +735,105 @@ class Communication:
         """
         Abort all pending operations if the connection is closed prematurely.
         """
-        for op in self.transaction:
-            op.abort()
+        self.server.communications.discard(self)
+        if self.server.scheduler is not None:
+            self.server.scheduler.remove(self)
+        transaction = self.transaction
+        if self.uploading is not None:
+            # releases the locks of an unfinished upload right away, instead
+            # of waiting for the garbage collector
+            transaction = transaction + [self.uploading]
+            self.uploading = None
+        self.io.submit(self._abort, transaction)
+        self.transaction = []
+
+    def run(self, callback, fn, *args):
+        """
+        Calls *fn* with given *args* in the communication's *io* executor and
+        passes the resulting :class:`concurrent.futures.Future` to *callback*
+        on the IOLoop.
+        """
+        self.loop.add_future(self.io.submit(fn, *args), callback)
+
+    def throttle(self, kind, amount, callback):
+        """
+        Calls *callback* as soon as the server's :class:`Scheduler
+        <score.netfs.qos.Scheduler>` allows this connection to transfer
+        *amount* bytes of file content of given *kind*, which is either
+        ``upload``, or ``download``. Without a scheduler, *callback* is called
+        right away.
+        """
+        if self.server.scheduler is None:
+            callback()
+        else:
+            self.server.scheduler.request(self, kind, amount, callback)
+
+    def new_hash(self):
+        """
+        Returns a new hash object for the algorithm in use.
+        """
+        return hashing.new(self.hash_name)
 
     def read_op(self):
         """
         Read the :ref:`job byte <netfs_protocol>` and call `.handle_op`.
+
+        This is also where the previous operation is considered finished, so
+        its duration is recorded here.
         """
+        if self.op_started is not None:
+            self.metrics.observe('request_duration_seconds',
+                                 self.loop.time() - self.op_started,
+                                 op=self.op_name)
+            self.op_started = None
         self.stream.read_bytes(1, self.handle_op)
 
+    def respond(self, data):
+        """
+        Writes the last part of a response and proceeds with the next request.
+
+        Clients may send several requests without waiting for the responses,
+        so the next request is read right away, while the response is still
+        being sent. If the client is not keeping up with reading the responses,
+        though, the next request is only read once this one was sent.
+        Requests are still processed one after another, so that the order of
+        the responses matches that of the requests.
+        """
+        if self.stream.closed():
+            # requests, that were buffered before the client went away, are
+            # still processed
+            return
+        self.stream.write(data)
+        if self.stream.writing():
+            self.stream.write(b'', self.read_op)
+        else:
+            self.read_op()
+
     def handle_op(self, op_bytes):
         """
         Starts the operation designated by given :ref:`job byte
         <netfs_protocol>`.
         """
         op = struct.unpack('!b', op_bytes)[0]
+        self.op_name = OPERATIONS.get(op, 'unknown')
+        self.op_started = self.loop.time()
+        self.metrics.increment('requests_total', op=self.op_name)
         if op == Constants.REQ_UPLOAD:
             return self.handle_upload()
+        elif op == Constants.REQ_UPLOAD_RESUMABLE:
+            return self.handle_upload(resumable=True)
+        elif op == Constants.REQ_UPLOAD_COMPRESSED:
+            return self.handle_upload(compressed=True)
+        elif op == Constants.REQ_UPLOAD_DELTA:
+            return self.handle_upload(delta=True)
+        elif op == Constants.REQ_SIGNATURE:
+            return self.handle_signature()
+        elif op == Constants.REQ_LINK:
+            return self.handle_link()
+        elif op == Constants.REQ_STAT:
+            return self.handle_stat()
+        elif op == Constants.REQ_LIST:
+            return self.handle_list()
         elif op == Constants.REQ_PREPARE:
             return self.handle_prepare()
         elif op == Constants.REQ_COMMIT:
@@ -226,24 +842,214 @@ class Communication:
             return self.handle_rollback()
         elif op == Constants.REQ_DOWNLOAD:
             return self.handle_download()
+        elif op == Constants.REQ_DOWNLOAD_RANGE:
+            return self.handle_download(ranged=True)
+        elif op == Constants.REQ_DOWNLOAD_COMPRESSED:
+            return self.handle_download(compressed=True)
+        elif op == Constants.REQ_HELLO:
+            return self.handle_hello()
+        elif op == Constants.REQ_MULTIPLEX:
+            return self.handle_multiplex()
+        elif op == Constants.REQ_STATS:
+            return self.handle_stats()
+        elif op == Constants.REQ_WAIT:
+            return self.handle_wait()
+        elif op == Constants.REQ_PING:
+            return self.handle_ping()
         else:
             log.error('Received bogus request byte %d' % op)
             self.stream.close()
 
+    def handle_hello(self):
+        """
+        Handles a ``hello`` operation. See :ref:`narrative documentation
+        <netfs_protocol_hello>` for details.
+        """
+        log.debug('hello')
+        count = None
+        names = []
+
+        def read_header(header_bytes):
+            nonlocal count
+            self.client_version, count = struct.unpack('!BB', header_bytes)
+            log.debug('  version = {}'.format(self.client_version))
+            read_name_length()
+
+        def read_name_length():
+            if len(names) == count:
+                return respond()
+            self.stream.read_bytes(1, read_name)
+
+        def read_name(length_bytes):
+            length = struct.unpack('!B', length_bytes)[0]
+            self.stream.read_bytes(length, add_name)
+
+        def add_name(name_bytes):
+            names.append(str(name_bytes, 'ASCII'))
+            read_name_length()
+
+        def respond():
+            self.hash_name = hashing.choose(names)
+            log.debug('  hash = {}'.format(self.hash_name))
+            name = self.hash_name.encode('ASCII')
+            data = struct.pack('!bBB', Constants.RESP_OK,
+                               Constants.PROTOCOL_VERSION, len(name))
+            data += name
+            self.respond(data)
+
+        self.stream.read_bytes(2, read_header)
+
+    def handle_multiplex(self):
+        """
+        Handles a ``multiplex`` operation. See :ref:`narrative documentation
+        <netfs_protocol_multiplex>` for details.
+
+        Every stream of the multiplexed connection is served by a
+        communication of its own, while this one stops reading requests.
+        """
+        log.debug('multiplex')
+
+        def read_window(window_bytes):
+            window = struct.unpack('!I', window_bytes)[0]
+            log.debug('  window = {}'.format(window))
+            if not window or self.transaction or \
+                    isinstance(self.stream, VirtualStream):
+                self.respond(struct.pack('!bI', Constants.RESP_ERROR, 0))
+                return
+            self.stream.write(struct.pack('!bI', Constants.RESP_OK,
+                                          StreamMultiplexer.WINDOW))
+            # the connection is now represented by the communications of its
+            # streams
+            self.server.communications.discard(self)
+            self.op_started = None
+            StreamMultiplexer(
+                self.stream, lambda stream: Communication(self.server, stream),
+                StreamMultiplexer.WINDOW, window)
+
+        self.stream.read_bytes(4, read_window)
+
+    def handle_stats(self):
+        """
+        Handles a ``stats`` operation. See :ref:`narrative documentation
+        <netfs_protocol_stats>` for details.
+        """
+        log.debug('stats')
+        text = self.metrics.render().encode('UTF-8')
+        self.respond(struct.pack('!bI', Constants.RESP_OK, len(text)) + text)
+
+    def handle_ping(self):
+        """
+        Handles a ``ping`` operation. See :ref:`narrative documentation
+        <netfs_protocol_ping>` for details.
+        """
+        log.debug('ping')
+        self.respond(struct.pack('!b', Constants.RESP_OK))
+
+    def handle_wait(self):
+        """
+        Handles a ``wait`` operation. See :ref:`narrative documentation
+        <netfs_protocol_wait>` for details.
+
+        The request is parked until the upload of the file is committed or
+        aborted, which is announced by the server's :class:`InFlightUploads
+        <score.netfs.storage.InFlightUploads>`. The uploads of other processes
+        sharing the same folder can only be detected by their temporary files,
+        which are polled every `WAIT_POLL_INTERVAL` seconds instead.
+        """
+        log.debug('wait')
+        path = None
+        deadline = None
+        pending = None
+
+        def read_name_length(length_bytes):
+            length = struct.unpack('!i', length_bytes)[0]
+            self.stream.read_bytes(length, read_name)
+
+        def read_name(name_bytes):
+            nonlocal path
+            try:
+                path = self.get_path(str(name_bytes, 'UTF-8'))
+            except ValueError:
+                path = None
+            log.debug('  name = {}'.format(path))
+            self.stream.read_bytes(4, read_timeout)
+
+        def read_timeout(timeout_bytes):
+            nonlocal deadline
+            timeout = struct.unpack('!I', timeout_bytes)[0] / 1000
+            log.debug('  timeout = {}'.format(timeout))
+            deadline = self.loop.time() + min(timeout, self.MAX_WAIT)
+            if path is None:
+                self.respond(struct.pack('!b', Constants.RESP_ERROR))
+                return
+            own = [op for op in self.transaction + [self.uploading]
+                   if isinstance(op, FileUpload) and op.path == path]
+            if own:
+                # our own upload would never finish while we are waiting
+                self.respond(struct.pack('!b', Constants.RESP_UPLOADING))
+            else:
+                check()
+
+        def check():
+            nonlocal pending
+            now = self.loop.time()
+            if self.server.uploads.wait(path, woken):
+                pending = self.loop.call_at(deadline, expired)
+            elif self.server.journal is None or \
+                    not os.path.exists(path + '.tmp'):
+                log.debug('  done')
+                self.respond(struct.pack('!b', Constants.RESP_OK))
+            elif now >= deadline:
+                log.debug('  expired')
+                self.respond(struct.pack('!b', Constants.RESP_UPLOADING))
+            else:
+                pending = self.loop.call_at(
+                    min(deadline, now + self.WAIT_POLL_INTERVAL), check)
+
+        def woken():
+            # called by the thread, that finished the upload
+            self.loop.add_callback(resume)
+
+        def resume():
+            nonlocal pending
+            if pending is None:
+                # the request expired in the meantime
+                return
+            self.loop.remove_timeout(pending)
+            pending = None
+            if not self.stream.closed():
+                check()
+
+        def expired():
+            nonlocal pending
+            pending = None
+            self.server.uploads.cancel(path, woken)
+            if not self.stream.closed():
+                log.debug('  expired')
+                self.respond(struct.pack('!b', Constants.RESP_UPLOADING))
+
+        self.stream.read_bytes(4, read_name_length)
+
     def handle_prepare(self):
         """
         Handles a ``prepare`` operation. See :ref:`narrative documentation
         <netfs_protocol_prepare>` for details.
         """
         log.debug('prepare')
-        try:
-            for op in self.transaction:
+
+        def prepare(transaction):
+            for op in transaction:
                 op.prepare()
-            result = Constants.RESP_OK
-        except:
-            result = Constants.RESP_ERROR
-        result = struct.pack('!b', result)
-        self.stream.write(result, self.read_op)
+
+        def prepared(future):
+            if future.exception():
+                result = Constants.RESP_ERROR
+            else:
+                result = Constants.RESP_OK
+            result = struct.pack('!b', result)
+            self.respond(result)
+
+        self.run(prepared, prepare, self.transaction[:])
 
     def handle_rollback(self):
         """
@@ -251,9 +1057,9 @@ class Communication:
         <netfs_protocol_rollback>` for details.
         """
         log.debug('rollback')
-        for op in self.transaction:
-            op.abort()
+        self.io.submit(self._abort, self.transaction)
         self.transaction = []
+        self.read_op()
 
     def handle_commit(self):
         """
@@ -261,27 +1067,64 @@ class Communication:
         <netfs_protocol_commit>` for details.
         """
         log.debug('commit')
-        for op in self.transaction:
+
+        def commit(transaction):
+            durable = self.server.durable
             try:
-                op.commit()
+                if durable:
+                    for op in transaction:
+                        op.sync()
+                for op in transaction:
+                    op.commit()
+                if durable:
+                    self.server.sync_folders(op.path for op in transaction)
             except Exception as e:
                 log.debug(e)
-                for op in self.transaction:
-                    op.abort()
-                self.transaction = []
+                self._abort(transaction)
+                return False
+            for op in transaction:
+                op.cleanup()
+            return True
+
+        def committed(future):
+            if future.result():
+                result = struct.pack('!b', Constants.RESP_OK)
+            else:
                 result = struct.pack('!b', Constants.RESP_ERROR)
-                self.stream.write(result, self.read_op)
-                return
+            self.respond(result)
+
+        self.run(committed, commit, self.transaction)
         self.transaction = []
-        result = struct.pack('!b', Constants.RESP_OK)
-        self.stream.write(result, self.read_op)
 
-    def handle_upload(self):
+    def _abort(self, transaction):
+        for op in transaction:
+            try:
+                op.abort()
+            except Exception as e:
+                log.error(e)
+
+    def handle_upload(self, resumable=False, compressed=False, delta=False):
         """
-        Handles a ``upload`` operation. See :ref:`narrative documentation
-        <netfs_protocol_upload>` for details.
+        Handles a ``upload`` operation, a ``resumable upload`` operation, if
+        *resumable* is `True`, a ``compressed upload`` operation, if
+        *compressed* is `True`, or a ``delta upload`` operation, if *delta* is
+        `True`. See :ref:`narrative documentation <netfs_protocol_upload>` for
+        details.
+
+        The file content is read in portions of at most `UPLOAD_READ_SIZE`
+        bytes, or one compressed block at a time. Reading pauses whenever
+        `MAX_PENDING_WRITES` portions are still waiting to be written to disk,
+        and while the connection is :meth:`throttled <throttle>`.
         """
-        upload = FileUpload(self)
+        if resumable:
+            upload = ResumableUpload(self)
+        elif delta:
+            upload = DeltaUpload(self)
+        else:
+            upload = FileUpload(self)
+        self.uploading = upload
+        remaining = None
+        codec = None
         log.debug('upload')
 
         def read_name_length(length_bytes):
@@ -292,47 +1135,413 @@ class Communication:
         def read_name(name_bytes):
             upload.path = self.get_path(str(name_bytes, 'UTF-8'))
             log.debug('  name = {}'.format(upload.path))
+            if not resumable:
+                self.io.submit(upload.open)
             self.stream.read_bytes(8, read_content_length)
 
         def read_content_length(length_bytes):
+            nonlocal remaining
             log.debug('  content length bytes = {}'.format(length_bytes))
-            length = struct.unpack('!q', length_bytes)[0]
-            log.debug('  content length = {}'.format(length))
-            self.stream.read_bytes(length, finished,
-                                   streaming_callback=handle_chunk)
+            remaining = struct.unpack('!q', length_bytes)[0]
+            log.debug('  content length = {}'.format(remaining))
+            if not resumable:
+                # an upload exceeding the free space fails before any of its
+                # content is written
+                self.io.submit(upload.reserve, remaining)
+            if resumable:
+                self.stream.read_bytes(16, read_token)
+            elif compressed:
+                self.stream.read_bytes(1, read_codec)
+            elif delta:
+                self.stream.read_bytes(4, read_block_size)
+            else:
+                read_chunk()
+
+        def read_block_size(size_bytes):
+            upload.block_size = struct.unpack('!I', size_bytes)[0]
+            log.debug('  block size = {}'.format(upload.block_size))
+            if not upload.block_size:
+                upload.error = 'InvalidBlock'
+            read_instruction()
+
+        def read_instruction(_=None):
+            self.stream.read_bytes(1, handle_instruction)
+
+        def handle_instruction(type_bytes):
+            instruction = struct.unpack('!B', type_bytes)[0]
+            if instruction == rsync.END:
+                log.debug('  ... done')
+                self.stream.read_bytes(upload.sha.digest_size, read_hash)
+            elif instruction == rsync.LITERAL:
+                self.stream.read_bytes(4, read_literal_length)
+            elif instruction == rsync.COPY:
+                self.stream.read_bytes(8, read_copy)
+            else:
+                log.error('Received bogus delta instruction %d' % instruction)
+                self.stream.close()
+
+        def read_literal_length(length_bytes):
+            nonlocal remaining
+            remaining = struct.unpack('!I', length_bytes)[0]
+            read_chunk()
+
+        def read_copy(copy_bytes):
+            index, count = struct.unpack('!II', copy_bytes)
+            log.debug('  ... copy {}+{} ...'.format(index, count))
+            future = self.io.submit(upload.copy, index, count)
+            if self.io.pending < self.MAX_PENDING_WRITES:
+                read_instruction()
+            else:
+                self.loop.add_future(future, read_instruction)
+
+        def read_codec(codec_bytes):
+            nonlocal codec
+            codec = struct.unpack('!B', codec_bytes)[0]
+            log.debug('  codec = {}'.format(codec))
+            if codec not in (compression.ZLIB, compression.LZMA):
+                # the blocks must be read nonetheless
+                upload.error = 'UnsupportedCodec'
+            read_block_length()
+
+        def read_block_length(_=None):
+            self.stream.read_bytes(4, read_block)
+
+        def read_block(length_bytes):
+            length = struct.unpack('!I', length_bytes)[0]
+            if not length:
+                log.debug('  ... done')
+                self.stream.read_bytes(upload.sha.digest_size, read_hash)
+            elif length > compression.MAX_BLOCK_SIZE:
+                log.error('Received oversized block ({} bytes)'.format(length))
+                self.stream.close()
+            else:
+                self.stream.read_bytes(length, handle_block)
+
+        def handle_block(block):
+            log.debug('  ... block ...')
+            self.metrics.increment('received_bytes_total', len(block))
+            future = self.io.submit(upload.write_block, codec, block)
+            proceed(future, len(block), read_block_length)
+
+        def read_token(token_bytes):
+            upload.token = token_bytes
+            upload.length = remaining
+            log.debug('  token = {}'.format(token_bytes.hex()))
+            self.run(opened, open_resumable)
+
+        def open_resumable():
+            upload.open()
+            upload.reserve(upload.length)
+
+        def opened(future):
+            nonlocal remaining
+            future.result()
+            if upload.error:
+                log.warn(upload.error)
+                self.uploading = None
+                result = struct.pack('!bq', Constants.RESP_ERROR, 0)
+                self.respond(result)
+                return
+            log.debug('  offset = {}'.format(upload.offset))
+            remaining -= upload.offset
+            result = struct.pack('!bq', Constants.RESP_OK, upload.offset)
+            self.stream.write(result, read_chunk)
+
+        def read_chunk(_=None):
+            if self.stream.closed():
+                # a partial read delivers the buffered data upon close
+                return
+            if not remaining and delta:
+                # the end of a literal
+                read_instruction()
+            elif not remaining:
+                log.debug('  ... done')
+                self.stream.read_bytes(upload.sha.digest_size, read_hash)
+            else:
+                self.stream.read_bytes(min(remaining, self.UPLOAD_READ_SIZE),
+                                       handle_chunk, partial=True)
 
         def handle_chunk(chunk):
+            nonlocal remaining
             log.debug('  ... chunk ...')
-            upload.write(chunk)
+            remaining -= len(chunk)
+            self.metrics.increment('received_bytes_total', len(chunk))
+            future = self.io.submit(upload.write, chunk)
+            proceed(future, len(chunk), read_chunk)
 
-        def finished(_):
-            log.debug('  ... done')
-            self.stream.read_bytes(512 // 8, read_hash)
+        def proceed(future, amount, callback):
+            # the next portion is read once the scheduler allows it and there
+            # are not too many portions waiting to be written
+            if self.io.pending < self.MAX_PENDING_WRITES:
+                self.throttle('upload', amount, callback)
+            else:
+                self.loop.add_future(future, lambda _: self.throttle(
+                    'upload', amount, callback))
 
         def read_hash(hash_bytes):
             upload.hash = hash_bytes
             log.debug('  hash = {}'.format(upload.hash))
+            self.run(finished, upload.finish)
+
+        def finished(future):
+            self.uploading = None
             try:
-                upload.finish()
+                future.result()
                 log.debug('  all ok!')
                 self.transaction.append(upload)
                 result = struct.pack('!b', Constants.RESP_OK)
-                self.stream.write(result, self.read_op)
+                self.respond(result)
             except UploadError as e:
                 log.warn(e)
+                if delta and str(e) in DeltaUpload.BASIS_ERRORS:
+                    result = struct.pack('!b', Constants.RESP_NOTFOUND)
+                else:
+                    result = struct.pack('!b', Constants.RESP_ERROR)
+                self.respond(result)
+
+        self.stream.read_bytes(4, read_name_length)
+
+    def handle_signature(self):
+        """
+        Handles a ``signature`` operation. See :ref:`narrative documentation
+        <netfs_protocol_signature>` for details.
+        """
+        log.debug('signature')
+
+        def read_name_length(length_bytes):
+            length = struct.unpack('!i', length_bytes)[0]
+            self.stream.read_bytes(length, read_name)
+
+        def read_name(name_bytes):
+            try:
+                path = self.get_path(str(name_bytes, 'UTF-8'))
+            except ValueError:
                 result = struct.pack('!b', Constants.RESP_ERROR)
-                self.stream.write(result, self.read_op)
+                self.respond(result)
+                return
+            log.debug('  name = {}'.format(path))
+            self.run(respond, self.file_signature, path)
+
+        def respond(future):
+            try:
+                result = future.result()
+            except OSError as e:
+                log.error(e)
+                result = struct.pack('!b', Constants.RESP_ERROR)
+            self.respond(result)
+
+        self.stream.read_bytes(4, read_name_length)
+
+    def file_signature(self, path):
+        """
+        Returns the response to a ``signature`` request for the file at given
+        *path*. Blocks on disk access.
+        """
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return struct.pack('!b', Constants.RESP_NOTFOUND)
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            block_size = rsync.block_size(size)
+            signature = rsync.signature(file.fileno(), size, block_size,
+                                        self.UPLOAD_READ_SIZE)
+        log.debug('  size = {}, block size = {}'.format(size, block_size))
+        result = struct.pack('!bqII', Constants.RESP_OK, size, block_size,
+                             len(signature))
+        return result + signature
+
+    def handle_link(self):
+        """
+        Handles a ``link`` operation. See :ref:`narrative documentation
+        <netfs_protocol_link>` for details.
+        """
+        log.debug('link')
+        upload = FileUpload(self)
+        size = None
+
+        def read_name_length(length_bytes):
+            length = struct.unpack('!i', length_bytes)[0]
+            self.stream.read_bytes(length, read_name)
+
+        def read_name(name_bytes):
+            upload.path = self.get_path(str(name_bytes, 'UTF-8'))
+            log.debug('  name = {}'.format(upload.path))
+            self.stream.read_bytes(8, read_size)
+
+        def read_size(size_bytes):
+            nonlocal size
+            size = struct.unpack('!q', size_bytes)[0]
+            log.debug('  size = {}'.format(size))
+            self.stream.read_bytes(upload.sha.digest_size, read_hash)
+
+        def read_hash(hash_bytes):
+            upload.hash = hash_bytes
+            log.debug('  hash = {}'.format(upload.hash))
+            self.uploading = upload
+            self.run(linked, upload.link, size)
+
+        def linked(future):
+            self.uploading = None
+            try:
+                if future.result():
+                    log.debug('  linked')
+                    self.transaction.append(upload)
+                    status = Constants.RESP_OK
+                else:
+                    log.debug('  not found')
+                    status = Constants.RESP_NOTFOUND
+            except UploadError as e:
+                log.warn(e)
+                status = Constants.RESP_ERROR
+            self.respond(struct.pack('!b', status))
+
         self.stream.read_bytes(4, read_name_length)
 
-    def handle_download(self):
+    def handle_stat(self):
+        """
+        Handles a ``stat`` operation. See :ref:`narrative documentation
+        <netfs_protocol_stat>` for details.
+        """
+        log.debug('stat')
+        count = None
+
+        def read_header(header_bytes):
+            nonlocal count
+            count, length = struct.unpack('!ii', header_bytes)
+            log.debug('  count = {}'.format(count))
+            self.stream.read_bytes(length, read_names)
+
+        def read_names(names_bytes):
+            try:
+                names = _unpack_names(names_bytes, count)
+            except (ValueError, struct.error):
+                result = struct.pack('!b', Constants.RESP_ERROR)
+                self.respond(result)
+                return
+            self.run(respond, self.stat_files, names)
+
+        def respond(future):
+            self.respond(future.result())
+
+        self.stream.read_bytes(8, read_header)
+
+    def stat_files(self, names):
+        """
+        Returns the response to a ``stat`` request for files with given
+        *names*. Blocks on disk access.
+        """
+        digest_size = hashing.digest_size(self.hash_name)
+        result = [struct.pack('!b', Constants.RESP_OK)]
+        for name in names:
+            status = Constants.RESP_NOTFOUND
+            try:
+                path = self.get_path(name)
+                entry = self.server.metadata.get(path)
+                if self.server.is_uploading(path):
+                    status = Constants.RESP_UPLOADING
+                elif entry is not None and entry.stat is None:
+                    pass
+                elif entry is not None and self.hash_name in entry.digests:
+                    stat = entry.stat
+                    digest = entry.digests[self.hash_name]
+                    status = Constants.RESP_OK
+                else:
+                    with self.server.open_file(path) as file:
+                        stat = os.fstat(file.fileno())
+                        digest = self.server.get_digest(
+                            path, file, stat, self.hash_name)
+                    status = Constants.RESP_OK
+            except (ValueError, OSError):
+                pass
+            if status == Constants.RESP_OK:
+                result.append(struct.pack('!bqi', status, stat.st_size,
+                                          int(stat.st_mtime)))
+                result.append(digest)
+            else:
+                result.append(struct.pack('!bqi', status, 0, 0))
+                result.append(bytes(digest_size))
+        return b''.join(result)
+
+    def handle_list(self):
         """
-        Handles a ``download`` operation. See :ref:`narrative documentation
-        <netfs_protocol_upload>` for details.
+        Handles a ``list`` operation. See :ref:`narrative documentation
+        <netfs_protocol_list>` for details.
+
+        At most `MAX_LIST_ENTRIES` entries are returned, regardless of the
+        requested limit.
+        """
+        log.debug('list')
+        prefix = None
+
+        def read_prefix_length(length_bytes):
+            length = struct.unpack('!i', length_bytes)[0]
+            self.stream.read_bytes(length, read_prefix)
+
+        def read_prefix(prefix_bytes):
+            nonlocal prefix
+            prefix = prefix_bytes
+            log.debug('  prefix = {}'.format(prefix))
+            self.stream.read_bytes(4, read_cursor_length)
+
+        def read_cursor_length(length_bytes):
+            length = struct.unpack('!i', length_bytes)[0]
+            self.stream.read_bytes(length, read_cursor)
+
+        def read_cursor(cursor_bytes):
+            cursor = cursor_bytes or None
+            log.debug('  cursor = {}'.format(cursor))
+            self.stream.read_bytes(
+                4, lambda limit_bytes: read_limit(cursor, limit_bytes))
+
+        def read_limit(cursor, limit_bytes):
+            limit = struct.unpack('!i', limit_bytes)[0]
+            limit = max(0, min(limit, self.MAX_LIST_ENTRIES))
+            log.debug('  limit = {}'.format(limit))
+            self.run(respond, self.server.list_files, prefix, cursor, limit)
+
+        def respond(future):
+            try:
+                entries, more = future.result()
+            except IndexUnavailable:
+                log.warn('namespace index unavailable')
+                result = struct.pack('!b', Constants.RESP_ERROR)
+                self.respond(result)
+                return
+            records = []
+            for path, size, mtime in entries:
+                records.append(struct.pack('!qii', size, mtime, len(path)))
+                records.append(path)
+            records = b''.join(records)
+            result = struct.pack('!bBii', Constants.RESP_OK, more,
+                                 len(entries), len(records))
+            self.respond(result + records)
+
+        self.stream.read_bytes(4, read_prefix_length)
+
+    def handle_download(self, ranged=False, compressed=False):
+        """
+        Handles a ``download`` operation, a ``download range`` operation, if
+        *ranged* is `True`, or a ``compressed download`` operation, if
+        *compressed* is `True`. See :ref:`narrative documentation
+        <netfs_protocol_download>` for details.
+
+        Complete downloads of small files are answered from the server's
+        :class:`ResponseCache <score.netfs.storage.ResponseCache>`, if it has
+        one. Compressed downloads of such files are always served
+        uncompressed, so that both kinds of downloads can share the cached
+        responses.
         """
         log.debug('download')
         path = None
         file = None
-        sha = hashlib.sha512()
+        stat = None
+        offset = 0
+        length = -1
+        codec = compression.NONE
+        cache = None if ranged else self.server.cache
+        cached = None
+        hit = False
 
         def read_name_length(length_bytes):
             length = struct.unpack('!i', length_bytes)[0]
@@ -340,52 +1549,326 @@ class Communication:
             self.stream.read_bytes(length, read_name)
 
         def read_name(name_bytes):
-            nonlocal path, file, sha
-            name = self.get_path(str(name_bytes, 'UTF-8'))
-            log.debug('  name = {}'.format(name))
-            path = self.get_path(name)
-            if os.path.exists(path + '.tmp'):
-                log.debug('  uploading')
-                data = struct.pack('!b', Constants.RESP_UPLOADING)
-                self.stream.write(data, self.read_op)
+            nonlocal path
+            path = self.get_path(str(name_bytes, 'UTF-8'))
+            log.debug('  name = {}'.format(path))
+            if ranged:
+                self.stream.read_bytes(16, read_range)
+            elif compressed:
+                self.stream.read_bytes(1, read_codec_count)
+            else:
+                lookup()
+
+        def read_codec_count(count_bytes):
+            count = struct.unpack('!B', count_bytes)[0]
+            self.stream.read_bytes(count, read_codecs)
+
+        def read_codecs(codec_bytes):
+            nonlocal codec
+            codec = compression.choose(codec_bytes)
+            log.debug('  codec = {}'.format(codec))
+            lookup()
+
+        def read_range(range_bytes):
+            nonlocal offset, length
+            offset, length = struct.unpack('!qq', range_bytes)
+            log.debug('  range = {}+{}'.format(offset, length))
+            if offset < 0 or length < -1:
+                data = struct.pack('!b', Constants.RESP_ERROR)
+                self.respond(data)
                 return
+            self.run(opened, open_file)
+
+        def lookup():
+            # responses can be taken from the cache right away, unless other
+            # processes might have changed the file in the meantime
+            if cache is not None and self.server.journal is None and \
+                    path not in self.server.uploads:
+                entry = cache.get(path, self.hash_name)
+                if entry is not None:
+                    log.debug('  cached')
+                    self.metrics.increment('cache_hits_total')
+                    send_cached(entry.response)
+                    return
+            self.run(opened, open_file)
+
+        def open_file():
+            nonlocal file, stat, cached
+            if cache is not None:
+                generation = cache.generation
+            if self.server.is_uploading(path):
+                return Constants.RESP_UPLOADING
             try:
-                file = open(path, 'rb')
+                file = self.server.open_file(path)
             except OSError:
-                log.debug('  not found')
-                data = struct.pack('!b', Constants.RESP_NOTFOUND)
-                self.stream.write(data, self.read_op)
-                return
+                return Constants.RESP_NOTFOUND
+            try:
+                stat = os.fstat(file.fileno())
+                if cache is not None and stat.st_size <= cache.max_file_size:
+                    cached = cache_response(generation)
+                    file.close()
+                    return Constants.RESP_OK
+                if codec != compression.NONE:
+                    check_compressible()
+            except OSError:
+                file.close()
+                raise
+            return Constants.RESP_OK
+
+        def cache_response(generation):
+            nonlocal hit
+            entry = cache.get(path, self.hash_name)
+            if entry is not None and entry.identity == cache.identity(stat):
+                hit = True
+                return entry.response
+            content = os.pread(file.fileno(), stat.st_size, 0)
+            digest = self.server.get_digest(path, file, stat, self.hash_name)
+            response = b''.join((
+                struct.pack('!bq', Constants.RESP_OK, len(content)),
+                content,
+                digest,
+                struct.pack('!i', int(stat.st_mtime))))
+            if len(content) == stat.st_size:
+                cache.put(path, self.hash_name, response, cache.identity(stat),
+                          generation)
+            return response
+
+        def send_cached(response):
+            if compressed:
+                # the codec follows the status byte and the size
+                response = b''.join((response[:9],
+                                     struct.pack('!B', compression.NONE),
+                                     response[9:]))
+            self.metrics.increment('sent_bytes_total', len(response))
+            self.throttle('download', len(response),
+                          lambda: self.respond(response))
+
+        def check_compressible():
+            nonlocal codec
+            sample = os.pread(file.fileno(), compression.SAMPLE_SIZE, 0)
+            if not compression.compressible(path, sample):
+                log.debug('  incompressible')
+                codec = compression.NONE
+
+        def opened(future):
             try:
-                # seek to end, read file size, go back to beginning of file
-                file.seek(0, 2)
-                data = struct.pack('!b', Constants.RESP_OK)
-                data += struct.pack('!q', file.tell())
-                log.debug('  length = {}'.format(file.tell()))
-                file.seek(0, 0)
-                self.stream.write(data, write_chunk)
+                status = future.result()
             except OSError as e:
                 log.debug('  error')
                 log.error(e)
-                data = struct.pack('!b', Constants.RESP_ERROR)
-                self.stream.write(data, self.read_op)
-
-        def write_chunk():
-            chunk = file.read(self.CHUNK_SIZE)
-            if chunk:
-                sha.update(chunk)
-                self.stream.write(chunk, write_chunk)
-                log.debug('  ... chunk ... ({})'.format(len(chunk)))
+                status = Constants.RESP_ERROR
+            if status != Constants.RESP_OK:
+                log.debug('  status = {}'.format(status))
+                data = struct.pack('!b', status)
+                self.respond(data)
+                return
+            if cached is not None:
+                if hit:
+                    log.debug('  cached')
+                    self.metrics.increment('cache_hits_total')
+                send_cached(cached)
+                return
+            nonlocal offset, length
+            offset = min(offset, stat.st_size)
+            if length < 0 or offset + length > stat.st_size:
+                length = stat.st_size - offset
+            data = struct.pack('!b', Constants.RESP_OK)
+            data += struct.pack('!q', stat.st_size)
+            if ranged:
+                data += struct.pack('!q', length)
+            if compressed:
+                data += struct.pack('!B', codec)
+            log.debug('  length = {}'.format(length))
+            self.stream.write(data, write_body)
+
+        def write_body():
+            if self.stream.closed():
+                # the client went away, before the header was written
+                file.close()
                 return
+            if codec != compression.NONE:
+                self.send_compressed(file, length, codec, read_trailer)
+            else:
+                self.send_file(file, offset, length, read_trailer)
+
+        def read_trailer():
             log.debug('  ... done')
+            self.run(write_trailer, get_trailer_hashes, self.hash_name)
+
+        def get_trailer_hashes(algorithm):
+            digest = self.server.get_digest(path, file, stat, algorithm)
+            if not ranged:
+                return digest
+            if length == stat.st_size:
+                return digest + digest
+            return _file_digest(file, offset, length, self.CHUNK_SIZE,
+                                algorithm) + digest
+
+        def write_trailer(future):
             file.close()
-            log.debug('  hash = {}'.format(sha.digest()))
-            data = sha.digest()
-            data += struct.pack('!i', int(os.path.getmtime(path)))
-            self.stream.write(data, self.read_op)
+            try:
+                data = future.result()
+            except OSError as e:
+                # the status byte has already been sent, there is no way to
+                # report this error to the client
+                log.error(e)
+                self.stream.close()
+                return
+            log.debug('  hash = {}'.format(data))
+            data += struct.pack('!i', int(stat.st_mtime))
+            self.respond(data)
 
         self.stream.read_bytes(4, read_name_length)
 
+    def send_file(self, file, offset, length, callback):
+        """
+        Writes *length* bytes of given :term:`file object`, starting at
+        *offset*, to the stream and calls *callback* when done.
+
+        The data is handed to the kernel via :func:`os.sendfile` as long as the
+        socket accepts it. Whenever the socket buffer is full, a single chunk
+        is read in the *io* executor and written through the stream instead,
+        which resumes this process once the socket is writable again. Streams
+        that cannot be used with :func:`os.sendfile` (SSL connections and
+        multiplexed streams, for example) are served through the stream alone.
+
+        The calls to :func:`os.sendfile` remain on the IOLoop, as the socket
+        must not be used by another thread while the stream owns it.
+
+        If the server has a :class:`Scheduler <score.netfs.qos.Scheduler>`,
+        the file is sent in portions of `CHUNK_SIZE` bytes, each of which must
+        be granted by the scheduler first.
+        """
+        end = offset + length
+        fd = self._sendfile_fd()
+        # the number of bytes granted by the scheduler, if there is one
+        allowance = None if self.server.scheduler is None else 0
+
+        def allowed():
+            # returns how many bytes may be sent right now, requesting the
+            # next portion from the scheduler when there are none
+            if allowance is None:
+                return end - offset
+            if not allowance:
+                amount = min(self.CHUNK_SIZE, end - offset)
+                self.throttle('download', amount, lambda: granted(amount))
+            return min(allowance, end - offset)
+
+        def granted(amount):
+            nonlocal allowance
+            allowance = amount
+            send()
+
+        def consumed(amount):
+            nonlocal offset, allowance
+            offset += amount
+            if allowance is not None:
+                allowance -= amount
+            self.metrics.increment('sent_bytes_total', amount)
+
+        def send():
+            nonlocal fd
+            while fd is not None and offset < end:
+                count = allowed()
+                if not count:
+                    return
+                try:
+                    sent = os.sendfile(fd, file.fileno(), offset, count)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    log.debug('  sendfile failed, falling back: {}'.format(e))
+                    fd = None
+                    break
+                if not sent:
+                    return truncated()
+                consumed(sent)
+                log.debug('  ... sendfile ... ({})'.format(sent))
+            if offset >= end:
+                return callback()
+            count = allowed()
+            if count:
+                self.run(write_chunk, os.pread, file.fileno(),
+                         min(self.CHUNK_SIZE, count), offset)
+
+        def write_chunk(future):
+            try:
+                chunk = future.result()
+            except OSError as e:
+                log.error(e)
+                return self.stream.close()
+            if not chunk:
+                return truncated()
+            consumed(len(chunk))
+            log.debug('  ... chunk ... ({})'.format(len(chunk)))
+            self.stream.write(chunk, send)
+
+        def truncated():
+            # the announced length can no longer be delivered, the only way to
+            # keep the client from misinterpreting the stream is to close it
+            log.error('File truncated during download: {}'.format(file.name))
+            self.stream.close()
+
+        send()
+
+    def send_compressed(self, file, length, codec, callback):
+        """
+        Writes the first *length* bytes of given :term:`file object` as blocks
+        compressed with given *codec*, followed by the terminating empty block,
+        and calls *callback* when done.
+
+        The blocks are compressed in the *io* executor. The next block is
+        already being compressed while the previous one is still being sent.
+        """
+        offset = 0
+
+        def compress(offset):
+            chunk = os.pread(file.fileno(),
+                             min(compression.BLOCK_SIZE, length - offset),
+                             offset)
+            if not chunk:
+                return b'', 0
+            return compression.compress(codec, chunk), len(chunk)
+
+        def write_block(future):
+            nonlocal offset
+            try:
+                block, size = future.result()
+            except OSError as e:
+                log.error(e)
+                return self.stream.close()
+            if not size:
+                # see send_file() for the reason behind closing the stream
+                log.error('File truncated during download: {}'.format(
+                    file.name))
+                return self.stream.close()
+            offset += size
+            log.debug('  ... block ... ({})'.format(len(block)))
+            data = struct.pack('!I', len(block)) + block
+            self.metrics.increment('sent_bytes_total', len(block))
+            if offset >= length:
+                self.throttle('download', len(data), lambda: self.stream.write(
+                    data + struct.pack('!I', 0), callback))
+                return
+            pending = self.io.submit(compress, offset)
+            self.throttle('download', len(data), lambda: self.stream.write(
+                data, lambda: self.loop.add_future(pending, write_block)))
+
+        if not length:
+            self.stream.write(struct.pack('!I', 0), callback)
+        else:
+            self.run(write_block, compress, 0)
+
+    def _sendfile_fd(self):
+        """
+        Returns the socket file descriptor to pass to :func:`os.sendfile`, or
+        `None` if the stream must be written to directly.
+        """
+        if not hasattr(os, 'sendfile') or \
+                isinstance(self.stream, (SSLIOStream, VirtualStream)):
+            return None
+        return self.stream.socket.fileno()
+
     def get_path(self, name):
         """
         Gets the real, absolute path to the file designated by *name*.
@@ -398,13 +1881,331 @@ class StorageServer(TCPServer):
     A :class:`tornado.tcpserver.TCPServer` that handles netfs clients.
 
     The first parameter must be the path to the folder where files should be
-    managed. All other arguments are passed to the parent constructor.
+    managed. Blocking disk operations and hash calculations are performed in a
+    thread pool with *io_threads* threads. All other arguments are passed to
+    the parent constructor.
+
+    The server keeps its own data in a folder called ``.netfs`` inside the
+    root folder, which is why clients may not access any files therein.
+
+    The paths, sizes and modification times of all files are kept in a
+    :class:`NamespaceIndex <score.netfs.storage.NamespaceIndex>`, which is
+    populated in the background when the server starts and dropped, if it
+    exceeds *max_index_entries*. Files modified by other means than netfs
+    uploads are only picked up when the server restarts. If several processes
+    share the same root folder, they must pass a truthy *index_journal* to
+    learn about each other's changes. Each process applies the
+    :class:`ChangeJournal <score.netfs.storage.ChangeJournal>` every
+    `JOURNAL_INTERVAL` seconds. The journal is replaced by an empty file once
+    it grows beyond a few megabytes, so it does not grow without bound. A
+    process, that missed changes nonetheless, rebuilds its index.
+
+    The files are arranged on disk according to the layout recorded in the
+    ``.netfs`` folder, which is either the :class:`FlatLayout
+    <score.netfs.storage.FlatLayout>`, or the :class:`ShardedLayout
+    <score.netfs.storage.ShardedLayout>`. The layout of a storage can be
+    changed with :func:`migrate <score.netfs.storage.migrate>`.
+
+    Committed files survive a crash of the machine only if the server is
+    *durable*: The temporary files of a transaction are then flushed to disk
+    before they are renamed, and the folders containing them are flushed
+    afterwards. The folders are flushed by a :class:`FolderSync
+    <score.netfs.storage.FolderSync>`, which combines the folders of all
+    transactions being committed at the same time.
+
+    Uploads are rejected, if the announced size of the file exceeds the free
+    disk space. Files of at least *preallocate_size* bytes are allocated in
+    one piece before the upload starts, which prevents fragmentation.
+
+    The bandwidth available to transfers of file content may be limited in
+    bytes per second: The total *bandwidth*, the *connection_bandwidth* of
+    each connection, as well as the *upload_bandwidth* and the
+    *download_bandwidth* of all transfers of the kind. The total bandwidth is
+    shared fairly among the connections by a :class:`Scheduler
+    <score.netfs.qos.Scheduler>`, where downloads weigh *download_priority*
+    times as much as uploads.
+
+    The existence of up to *metadata_folders* folders and the metadata of up
+    to *metadata_entries* files are kept in a :class:`MetadataCache
+    <score.netfs.storage.MetadataCache>`, which watches the folders for
+    changes made by other means than netfs uploads.
+
+    If *cache_size* is given, up to that many bytes of responses to downloads
+    of files no larger than *cache_file_size* are kept in a
+    :class:`ResponseCache <score.netfs.storage.ResponseCache>`. Files modified
+    by other means than netfs uploads might be served from the cache with
+    their previous content, unless there is an *index_journal*, in which case
+    each cached response is verified against the file on disk.
+
+    The server counts requests and transferred bytes and records the duration
+    of each request in its :class:`Metrics <score.netfs.metrics.Metrics>`,
+    which are available via the :ref:`stats request <netfs_protocol_stats>`.
     """
 
-    def __init__(self, root, **kwargs):
+    META_FOLDER = '.netfs'
+
+    #: Seconds between two applications of the journal.
+    JOURNAL_INTERVAL = 1
+
+    def __init__(self, root, *, io_threads=4, partial_ttl=86400,
+                 max_index_entries=None, index_journal=False, durable=False,
+                 cache_size=0, cache_file_size=65536,
+                 preallocate_size=1048576, bandwidth=None,
+                 connection_bandwidth=None, upload_bandwidth=None,
+                 download_bandwidth=None, download_priority=1,
+                 metadata_entries=65536, metadata_folders=1024, **kwargs):
         self.root = os.path.realpath(root)
+        self.layout = read_layout(os.path.join(self.root, self.META_FOLDER))
+        self.durable = durable
+        self.preallocate_size = preallocate_size
+        self.folder_sync = FolderSync()
+        self.digests = DigestIndex(
+            self.root, os.path.join(self.root, self.META_FOLDER, 'digest'))
+        self.blobs = BlobIndex(
+            self.root, os.path.join(self.root, self.META_FOLDER, 'blobs'))
+        self.partial_folder = os.path.join(
+            self.root, self.META_FOLDER, 'partial')
+        self.partial_ttl = partial_ttl
+        self.executor = ThreadPoolExecutor(io_threads)
+        self.max_index_entries = max_index_entries
+        self.build_namespace()
+        self.journal = None
+        self._journal_reader = None
+        if index_journal:
+            self.journal = ChangeJournal(self.journal_path(self.root))
+            # keeps up with the journal, even if there are no list requests
+            self._journal_reader = PeriodicCallback(
+                lambda: self.executor.submit(self.apply_journal),
+                self.JOURNAL_INTERVAL * 1000)
+            self._journal_reader.start()
+        self._partial_sweeper = PeriodicCallback(
+            lambda: self.executor.submit(self.remove_stale_partials),
+            min(partial_ttl, 3600) * 1000)
+        self._partial_sweeper.start()
+        self.uploads = InFlightUploads()
+        self.metadata = MetadataCache(metadata_entries, metadata_folders)
+        self.cache = None
+        if cache_size:
+            self.cache = ResponseCache(cache_size, cache_file_size)
+        self.communications = set()
+        self.scheduler = None
+        if bandwidth or connection_bandwidth or upload_bandwidth or \
+                download_bandwidth:
+            self.scheduler = Scheduler(
+                bandwidth, connection_rate=connection_bandwidth,
+                limits={'upload': upload_bandwidth,
+                        'download': download_bandwidth},
+                weights={'download': download_priority})
+        self.metrics = Metrics()
+        self.metrics.gauge('connections', lambda: len(self.communications))
+        self.metrics.gauge('transactions', lambda: sum(
+            1 for c in self.communications if c.transaction))
+        self.metrics.gauge('index_entries', lambda: len(self.namespace)
+                           if self.namespace.ready else None)
+        if self.scheduler is not None:
+            self.metrics.gauge('throttled', lambda: len(self.scheduler))
         TCPServer.__init__(self, **kwargs)
 
+    def stop(self):
+        TCPServer.stop(self)
+        self._partial_sweeper.stop()
+        if self._journal_reader:
+            self._journal_reader.stop()
+        self.executor.shutdown(wait=False)
+        if self.journal:
+            self.journal.close()
+        self.metadata.close()
+
+    def make_folder(self, folder):
+        """
+        Creates the *folder*, unless it is known to exist. Blocks on disk
+        access.
+        """
+        if not self.metadata.has_folder(folder):
+            os.makedirs(folder, exist_ok=True)
+            self.metadata.add_folder(folder)
+
+    def sync_folders(self, paths):
+        """
+        Flushes the folders containing the files at given *paths* to disk,
+        including all folders above them, that might have been created for
+        the files. Blocks on disk access.
+        """
+        folders = set()
+        for path in paths:
+            folder = os.path.dirname(path)
+            while folder not in folders:
+                folders.add(folder)
+                if folder == self.root:
+                    break
+                folder = os.path.dirname(folder)
+        self.folder_sync.sync(folders)
+
+    def is_uploading(self, path):
+        """
+        Tests whether the file at *path* is currently being uploaded. The
+        uploads of other processes sharing the same folder are detected by
+        their temporary files, which is only done if there is a *journal*.
+        """
+        if path in self.uploads:
+            return True
+        return self.journal is not None and os.path.exists(path + '.tmp')
+
+    @classmethod
+    def journal_path(cls, root):
+        """
+        Returns the path to the :class:`ChangeJournal
+        <score.netfs.storage.ChangeJournal>` of the storage at *root*, that is
+        used by processes sharing that storage.
+        """
+        return os.path.join(root, cls.META_FOLDER, 'changes')
+
+    def file_changed(self, path):
+        """
+        Updates the namespace index and drops the cached metadata and
+        responses after the file at *path* was committed, restored, or
+        removed.
+        """
+        self.metadata.invalidate(path)
+        if self.cache is not None:
+            self.cache.invalidate(path)
+        relpath = self.layout.name_of(
+            os.fsencode(os.path.relpath(path, self.root)))
+        try:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, int(stat.st_mtime)
+        except FileNotFoundError:
+            size, mtime = -1, 0
+        if self.journal:
+            # the change is applied to the index when the journal is read,
+            # keeping the order of all processes' changes intact
+            self.journal.append(relpath, size, mtime)
+        elif size < 0:
+            self.namespace.remove(relpath)
+        else:
+            self.namespace.set(relpath, size, mtime)
+
+    def list_files(self, prefix, after, limit):
+        """
+        Lists committed files from the namespace index. See
+        :meth:`NamespaceIndex.list <score.netfs.storage.NamespaceIndex.list>`
+        for the parameters and the return value.
+        """
+        if self.journal:
+            self.apply_journal()
+        return self.namespace.list(prefix, after, limit)
+
+    def build_namespace(self):
+        """
+        Replaces the namespace index with a new one, which is populated in
+        the background.
+        """
+        namespace = NamespaceIndex(max_entries=self.max_index_entries)
+        self.namespace = namespace
+        self.executor.submit(
+            lambda: namespace.build(
+                self.layout.scan(self.root, (self.META_FOLDER,))))
+
+    def apply_journal(self):
+        """
+        Applies the changes of all processes recorded in the journal to the
+        namespace index, rebuilding the index if some of them were lost.
+        Blocks on disk access.
+        """
+        if not self.journal.apply(self.namespace):
+            log.warn('missed changes of other processes, rebuilding the '
+                     'namespace index')
+            self.build_namespace()
+
+    def get_digest(self, path, file, stat, algorithm):
+        """
+        Returns the hash of the opened :term:`file object` *file* located at
+        *path* using given hash *algorithm*. The hash is read from the
+        :class:`DigestIndex <score.netfs.storage.DigestIndex>` and only
+        calculated if the index has no valid entry for given :func:`os.stat`
+        result *stat*. The hash is kept in the :class:`MetadataCache
+        <score.netfs.storage.MetadataCache>` as well, sparing the index lookup
+        next time. Blocks on disk access.
+        """
+        metadata = self.metadata
+        entry = metadata.get(path)
+        if entry is not None and entry.matches(stat) and \
+                algorithm in entry.digests:
+            return entry.digests[algorithm]
+        generation = metadata.generation
+        digest = self.digests.get(path, algorithm, stat)
+        if digest is None:
+            log.debug('  calculating hash')
+            digest = _file_digest(file, 0, stat.st_size,
+                                  Communication.CHUNK_SIZE, algorithm)
+            try:
+                self.store_digest(path, algorithm, digest, stat)
+            except OSError as e:
+                log.error(e)
+        metadata.put(path, stat, generation, algorithm, digest)
+        return digest
+
+    def open_file(self, path):
+        """
+        Opens the file at *path* for reading, raising a
+        :class:`FileNotFoundError` right away, if the :class:`MetadataCache
+        <score.netfs.storage.MetadataCache>` knows that there is no such file.
+        Blocks on disk access.
+        """
+        metadata = self.metadata
+        entry = metadata.get(path)
+        if entry is not None and entry.stat is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    path)
+        generation = metadata.generation
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            metadata.put(path, None, generation)
+            raise
+
+    def store_digest(self, path, algorithm, digest, stat=None):
+        """
+        Stores the *digest* of the file at *path* in the server's
+        :class:`DigestIndex <score.netfs.storage.DigestIndex>` and makes the
+        file available for :ref:`links <netfs_protocol_link>`.
+        """
+        self.digests.store(path, algorithm, digest, stat)
+        self.blobs.add(path, algorithm, digest)
+
+    def remove_stale_partials(self):
+        """
+        Removes the data of :class:`resumable uploads <.ResumableUpload>`, that
+        were not resumed within *partial_ttl* seconds.
+        """
+        try:
+            names = os.listdir(self.partial_folder)
+        except FileNotFoundError:
+            return
+        deadline = time.time() - self.partial_ttl
+        for name in names:
+            if name.endswith('.info'):
+                continue
+            path = os.path.join(self.partial_folder, name)
+            try:
+                if os.stat(path).st_mtime > deadline:
+                    continue
+                fd = _open_locked(path, os.O_RDONLY)
+            except OSError as e:
+                log.error(e)
+                continue
+            if fd is None:
+                # currently being resumed
+                continue
+            try:
+                log.debug('removing stale partial upload {}'.format(name))
+                os.unlink(path + '.info')
+                os.unlink(path)
+            except OSError as e:
+                log.error(e)
+            finally:
+                os.close(fd)
+
     def handle_stream(self, stream, address):
         # TODO: the current approach using callbacks to stream functions (i.e.
         # stream.read_bytes(amount, callback)) makes it extremely hard to
@@ -415,9 +2216,13 @@ class StorageServer(TCPServer):
 
     def get_path(self, name):
         """
-        Gets the real, absolute path to the file designated by *name*.
+        Gets the real, absolute path to the file designated by *name*, which
+        depends on the *layout* of the storage.
         """
-        path = os.path.join(self.root, name)
+        path = os.path.normpath(os.path.join(self.root, name))
         if os.path.commonprefix([path, self.root]) != self.root:
             raise ValueError('Invalid path "%s"' % name)
-        return path
+        relpath = os.path.relpath(path, self.root)
+        if relpath.split(os.sep, 1)[0] == self.META_FOLDER:
+            raise ValueError('Invalid path "%s"' % name)
+        return self.layout.path(self.root, relpath)
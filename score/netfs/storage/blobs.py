@@ -0,0 +1,77 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+import os
+import tempfile
+
+
+class BlobIndex:
+    """
+    Maps hashes of file contents to files inside the storage root at *root*,
+    so that the server can find an existing copy of some content by its hash.
+    The index is persisted in *folder*, with one small file per hash containing
+    the path of the most recent file with that content.
+
+    The index is never updated when files change or disappear, so every path it
+    returns must be verified against the :class:`.DigestIndex` before use.
+    """
+
+    def __init__(self, root, folder):
+        self.root = root
+        self.folder = folder
+
+    def get(self, algorithm, digest):
+        """
+        Returns the path of a file, whose content had given *digest* when it
+        was added, or `None` if there is no such file.
+        """
+        try:
+            with open(self._entry(algorithm, digest), 'rb') as file:
+                relpath = str(file.read(), 'UTF-8')
+        except (OSError, UnicodeDecodeError):
+            return None
+        return os.path.join(self.root, relpath)
+
+    def add(self, path, algorithm, digest):
+        """
+        Registers the file at *path* as a copy of the content with given
+        *digest*, that was calculated with given *algorithm*.
+        """
+        entry = self._entry(algorithm, digest)
+        dirname = os.path.dirname(entry)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(os.path.relpath(path, self.root).encode('UTF-8'))
+            os.replace(tmp, entry)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def _entry(self, algorithm, digest):
+        hex = digest.hex()
+        return os.path.join(self.folder, algorithm, hex[:2], hex)
@@ -0,0 +1,162 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from collections import OrderedDict, namedtuple
+import threading
+from .. import hashing
+
+
+CachedResponse = namedtuple('CachedResponse', ('response', 'identity'))
+CachedResponse.__doc__ = """
+The complete *response* to a download request and the *identity* of the file,
+as returned by :meth:`ResponseCache.identity`, at the time the response was
+created.
+"""
+
+
+class Generations:
+    """
+    Tells whether a path was changed since a point in time, which is
+    represented by the :attr:`current` generation. Only the last *max_paths*
+    changed paths are remembered, a generation older than the oldest of them
+    is considered outdated for all paths. Not thread-safe.
+    """
+
+    def __init__(self, max_paths=65536):
+        self.max_paths = max_paths
+        self.current = 0
+        self._changed = OrderedDict()
+        self._horizon = 0
+
+    def change(self, path):
+        """
+        Records a change of the file at *path*.
+        """
+        self.current += 1
+        self._changed[path] = self.current
+        self._changed.move_to_end(path)
+        while len(self._changed) > self.max_paths:
+            _, self._horizon = self._changed.popitem(last=False)
+
+    def change_all(self):
+        """
+        Records a change of all files.
+        """
+        self.current += 1
+        self._changed.clear()
+        self._horizon = self.current
+
+    def outdated(self, path, generation):
+        """
+        Tests whether the file at *path* might have changed since given
+        *generation* was current.
+        """
+        return generation < self._horizon or \
+            generation < self._changed.get(path, 0)
+
+
+class ResponseCache:
+    """
+    Keeps the complete responses to download requests for small files in
+    memory, so that frequently requested files can be served without touching
+    the disk. Responses of files larger than *max_file_size* are not cached
+    and the least recently used responses are dropped, once the cached
+    responses exceed *max_size* bytes in total.
+
+    Responses are cached per file path and hash algorithm and must be dropped
+    via :meth:`.invalidate` whenever the file changes. A response created
+    before the last invalidation of its file is rejected by :meth:`.put`, as
+    it might contain outdated content. All methods are thread-safe.
+    """
+
+    def __init__(self, max_size, max_file_size):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generations = Generations()
+
+    @staticmethod
+    def identity(stat):
+        """
+        Returns a value, that changes whenever the file with given
+        :func:`os.stat` result is replaced or modified.
+        """
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @property
+    def generation(self):
+        """
+        A number, that must be retrieved before reading a file, whose
+        response is to be passed to :meth:`.put`.
+        """
+        with self._lock:
+            return self._generations.current
+
+    def get(self, path, algorithm):
+        """
+        Returns the :class:`CachedResponse` for the file at *path* using the
+        hash *algorithm*, or `None`, if there is no such response.
+        """
+        key = (path, algorithm)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, path, algorithm, response, identity, generation):
+        """
+        Caches the *response* for the file at *path* using the hash
+        *algorithm*. The *generation* must have been retrieved before the
+        file was read.
+        """
+        if len(response) > self.max_size:
+            return
+        key = (path, algorithm)
+        with self._lock:
+            if self._generations.outdated(path, generation):
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.response)
+            self._entries[key] = CachedResponse(response, identity)
+            self._size += len(response)
+            while self._size > self.max_size:
+                _, entry = self._entries.popitem(last=False)
+                self._size -= len(entry.response)
+
+    def invalidate(self, path):
+        """
+        Drops all responses for the file at *path*.
+        """
+        with self._lock:
+            self._generations.change(path)
+            for algorithm in hashing.ALGORITHMS:
+                entry = self._entries.pop((path, algorithm), None)
+                if entry is not None:
+                    self._size -= len(entry.response)
@@ -0,0 +1,107 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+import logging
+import os
+import struct
+import tempfile
+from .. import hashing
+
+
+log = logging.getLogger('score.netfs.storage')
+
+
+class DigestIndex:
+    """
+    Persists the hashes of committed files in sidecar files beneath *folder*,
+    which must be located inside the storage root at *root*.
+
+    Each sidecar mirrors the path of its file relative to the storage root,
+    prefixed with the name of the hash algorithm, and contains the size and
+    modification time of the file at the time its hash was stored. A stored
+    hash is only considered valid as long as both values still match the file
+    on disk.
+    """
+
+    _header = struct.Struct('!qq')
+
+    def __init__(self, root, folder):
+        self.root = root
+        self.folder = folder
+
+    def get(self, path, algorithm, stat):
+        """
+        Returns the stored hash of the file at *path* calculated with given
+        *algorithm*, or `None` if there is no such entry, or if it does not
+        match given :func:`os.stat` result.
+        """
+        try:
+            with open(self._sidecar(path, algorithm), 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        size = self._header.size
+        if len(data) <= size:
+            return None
+        if self._header.unpack(data[:size]) != (stat.st_size,
+                                                stat.st_mtime_ns):
+            return None
+        return data[size:]
+
+    def store(self, path, algorithm, digest, stat=None):
+        """
+        Stores the *digest* of the file at *path*, that was calculated with
+        given *algorithm*. The *stat* will be retrieved from the file system if
+        it was not provided.
+        """
+        if stat is None:
+            stat = os.stat(path)
+        sidecar = self._sidecar(path, algorithm)
+        dirname = os.path.dirname(sidecar)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(self._header.pack(stat.st_size, stat.st_mtime_ns))
+                file.write(digest)
+            os.replace(tmp, sidecar)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def remove(self, path):
+        """
+        Removes all stored hashes of the file at *path*.
+        """
+        for algorithm in hashing.ALGORITHMS:
+            try:
+                os.unlink(self._sidecar(path, algorithm))
+            except FileNotFoundError:
+                pass
+
+    def _sidecar(self, path, algorithm):
+        return os.path.join(self.folder, algorithm,
+                            os.path.relpath(path, self.root))
@@ -0,0 +1,89 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from collections import deque
+from concurrent.futures import Future
+import threading
+
+
+class SerialExecutor:
+    """
+    Runs functions on a shared :class:`concurrent.futures.Executor`, but never
+    more than one at a time and always in the order they were submitted.
+
+    This allows every connection to move its blocking operations to a thread
+    pool, while still relying on the order of its own operations: the chunks
+    of an upload are guaranteed to be written in the order they arrived, for
+    example.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._jobs = deque()
+        self._running = False
+
+    @property
+    def pending(self):
+        """
+        The number of functions that have not finished yet.
+        """
+        with self._lock:
+            return len(self._jobs) + int(self._running)
+
+    def submit(self, fn, *args):
+        """
+        Schedules *fn* to be called with given *args* after all previously
+        submitted functions have finished. Returns a
+        :class:`concurrent.futures.Future` representing the result.
+        """
+        future = Future()
+        with self._lock:
+            self._jobs.append((future, fn, args))
+            if self._running:
+                return future
+            self._running = True
+        self.executor.submit(self._work)
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    self._running = False
+                    return
+                future, fn, args = self._jobs.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            # drop references to the arguments, callers might rely on their
+            # timely destruction
+            del future, fn, args
@@ -0,0 +1,96 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+import threading
+
+
+class InFlightUploads:
+    """
+    Keeps track of the files currently being uploaded, so that downloads of
+    these files can wait for the uploads to be committed or aborted.
+
+    The keys are usually the paths of the uploaded files. A key may be added
+    several times and is considered in flight until it was removed just as
+    often. All methods may be called from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._waiting = {}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._counts
+
+    def add(self, key):
+        """
+        Marks the upload designated by *key* as started.
+        """
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def remove(self, key):
+        """
+        Marks the upload designated by *key* as finished and calls the
+        callbacks waiting for it in the current thread, if no other upload
+        with the same *key* is in flight.
+        """
+        with self._lock:
+            count = self._counts.get(key, 0) - 1
+            if count > 0:
+                self._counts[key] = count
+                return
+            self._counts.pop(key, None)
+            callbacks = self._waiting.pop(key, ())
+        for callback in callbacks:
+            callback()
+
+    def wait(self, key, callback):
+        """
+        Registers *callback* to be called once the upload designated by *key*
+        is finished and returns `True`. Returns `False` without registering
+        the callback, if no such upload is in flight.
+        """
+        with self._lock:
+            if key not in self._counts:
+                return False
+            self._waiting.setdefault(key, []).append(callback)
+            return True
+
+    def cancel(self, key, callback):
+        """
+        Unregisters a *callback* passed to :meth:`.wait`, that is no longer
+        interested in the upload.
+        """
+        with self._lock:
+            callbacks = self._waiting.get(key, [])
+            try:
+                callbacks.remove(callback)
+            except ValueError:
+                return
+            if not callbacks:
+                del self._waiting[key]
@@ -0,0 +1,235 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+import hashlib
+import logging
+import os
+import tempfile
+from .. import hashing
+from .namespace import scan
+
+
+log = logging.getLogger('score.netfs.storage')
+
+
+class FlatLayout:
+    """
+    Stores every file at its name relative to the storage root.
+
+    A layout maps the names of files, which are normalized paths relative to
+    the storage root as seen by clients, to the paths of the files on disk and
+    back.
+    """
+
+    name = 'flat'
+
+    def path(self, root, name):
+        """
+        Returns the absolute path of the file with given *name*.
+        """
+        return os.path.join(root, name)
+
+    def name_of(self, relpath):
+        """
+        Returns the name of the file at *relpath*, the :class:`bytes` of its
+        path relative to the storage root, or `None` if the path does not
+        belong to a file of this layout.
+        """
+        return relpath
+
+    def scan(self, root, exclude=()):
+        """
+        Yields `(name, size, mtime)` tuples of all files in this layout in the
+        order expected by :meth:`NamespaceIndex.build
+        <score.netfs.storage.NamespaceIndex.build>`. See :func:`scan
+        <score.netfs.storage.scan>` for the parameters.
+        """
+        return scan(root, exclude)
+
+
+class ShardedLayout(FlatLayout):
+    """
+    Spreads the files over 65536 folders two levels deep, which are named
+    after the first two bytes of the BLAKE2b hash of the file name. The file
+    ``images/logo.png`` is stored as ``7f/0c/images/logo.png``, for example.
+
+    This keeps the number of entries per folder low, even if all files share
+    the same folder from the clients' point of view.
+    """
+
+    name = 'sharded'
+
+    def path(self, root, name):
+        shard = os.fsdecode(self._shard(os.fsencode(name)))
+        return os.path.join(root, shard, name)
+
+    def name_of(self, relpath):
+        parts = relpath.split(b'/', 2)
+        if len(parts) != 3 or self._shard(parts[2]) != b'/'.join(parts[:2]):
+            return None
+        return parts[2]
+
+    def scan(self, root, exclude=()):
+        # the order of the names differs from the order of the paths
+        entries = []
+        for relpath, size, mtime in scan(root, exclude):
+            name = self.name_of(relpath)
+            if name is not None:
+                entries.append((name, size, mtime))
+        entries.sort(key=lambda entry: entry[0])
+        return iter(entries)
+
+    def _shard(self, name):
+        digest = hashlib.blake2b(name, digest_size=2).hexdigest()
+        return (digest[:2] + '/' + digest[2:]).encode('ASCII')
+
+
+LAYOUTS = {layout.name: layout for layout in (FlatLayout, ShardedLayout)}
+
+#: Recorded while a migration is in progress, so that no server is started on
+#: a half-migrated storage.
+MIGRATING = 'migrating'
+
+
+class LayoutError(Exception):
+    """
+    Raised if the layout of a storage cannot be determined, or if a storage
+    cannot be migrated to another layout.
+    """
+
+
+def read_layout(folder):
+    """
+    Returns the layout recorded in the file ``layout`` inside the given meta
+    *folder* of a storage. Storages without such a file use the
+    :class:`.FlatLayout`.
+    """
+    try:
+        with open(os.path.join(folder, 'layout'), 'rb') as file:
+            name = str(file.read(), 'ASCII').strip()
+    except FileNotFoundError:
+        return FlatLayout()
+    if name == MIGRATING:
+        raise LayoutError('Storage is being migrated, or the migration '
+                          'was interrupted')
+    try:
+        return LAYOUTS[name]()
+    except KeyError:
+        raise LayoutError('Unknown layout "%s"' % name)
+
+
+def write_layout(folder, name):
+    """
+    Records the layout with given *name* in the meta *folder* of a storage.
+    """
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(name.encode('ASCII') + b'\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, os.path.join(folder, 'layout'))
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def migrate(root, folder, name):
+    """
+    Moves all files of the storage at *root*, whose meta data is kept in the
+    meta *folder*, into the layout with given *name*. The hashes stored for
+    the files are moved along and the entries of the :class:`BlobIndex
+    <score.netfs.storage.BlobIndex>` are updated.
+
+    No server may use the storage during the migration. An interrupted
+    migration leaves the storage in an unusable state, which is why the
+    layout is recorded as `MIGRATING` until the migration is complete.
+    """
+    old = read_layout(folder)
+    new = LAYOUTS[name]()
+    if old.name == new.name:
+        return
+    exclude = (os.path.basename(folder),)
+    moves = []
+    for filename, _, _ in old.scan(root, exclude):
+        filename = os.fsdecode(filename)
+        moves.append((old.path(root, filename), new.path(root, filename)))
+    sources = set(source for source, _ in moves)
+    for _, target in moves:
+        if target in sources or os.path.lexists(target):
+            raise LayoutError('Cannot move a file to %s' % target)
+    write_layout(folder, MIGRATING)
+    digests = os.path.join(folder, 'digest')
+    renamed = {}
+    for source, target in moves:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(source, target)
+        source = os.path.relpath(source, root)
+        target = os.path.relpath(target, root)
+        renamed[source] = target
+        for algorithm in hashing.ALGORITHMS:
+            sidecar = os.path.join(digests, algorithm, target)
+            try:
+                os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+                os.rename(os.path.join(digests, algorithm, source), sidecar)
+            except FileNotFoundError:
+                pass
+    _update_blobs(os.path.join(folder, 'blobs'), renamed)
+    _remove_empty_folders(root, exclude)
+    _remove_empty_folders(digests)
+    write_layout(folder, new.name)
+    log.info('migrated {} files to the {} layout'.format(
+        len(moves), new.name))
+
+
+def _update_blobs(folder, renamed):
+    for parent, _, names in os.walk(folder):
+        for name in names:
+            entry = os.path.join(parent, name)
+            with open(entry, 'rb') as file:
+                try:
+                    relpath = str(file.read(), 'UTF-8')
+                except UnicodeDecodeError:
+                    continue
+            if relpath not in renamed:
+                continue
+            with open(entry, 'wb') as file:
+                file.write(renamed[relpath].encode('UTF-8'))
+
+
+def _remove_empty_folders(root, exclude=()):
+    for parent, folders, names in os.walk(root, topdown=False):
+        if parent == root:
+            continue
+        relpath = os.path.relpath(parent, root)
+        if relpath.split(os.sep, 1)[0] in exclude:
+            continue
+        try:
+            os.rmdir(parent)
+        except OSError:
+            # not empty
+            pass
@@ -0,0 +1,366 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+from .cache import Generations
+
+
+log = logging.getLogger('score.netfs.storage')
+
+
+class Inotify:
+    """
+    A minimal binding of the Linux inotify API. Raises an :class:`OSError`,
+    if the API is not available.
+
+    The file descriptor is non-blocking, so :meth:`read` returns right away,
+    if there are no events.
+    """
+
+    ATTRIB = 0x4
+    CLOSE_WRITE = 0x8
+    MODIFY = 0x2
+    MOVED_FROM = 0x40
+    MOVED_TO = 0x80
+    CREATE = 0x100
+    DELETE = 0x200
+    DELETE_SELF = 0x400
+    MOVE_SELF = 0x800
+    Q_OVERFLOW = 0x4000
+    IGNORED = 0x8000
+    ONLYDIR = 0x1000000
+    ISDIR = 0x40000000
+
+    _header = struct.Struct('iIII')
+
+    def __init__(self):
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                     use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise self._error()
+
+    def add_watch(self, path, mask):
+        """
+        Watches the file at *path* for the events in *mask* and returns the
+        watch descriptor.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise self._error(path)
+        return wd
+
+    def remove_watch(self, wd):
+        """
+        Stops watching for the events of given watch descriptor *wd*.
+        """
+        if self._libc.inotify_rm_watch(self.fd, wd) < 0:
+            raise self._error()
+
+    def read(self):
+        """
+        Returns a list of all pending events as tuples of the watch
+        descriptor, the event mask and the file name.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._header.unpack_from(data, offset)
+                offset += self._header.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+    def _error(self, path=None):
+        code = ctypes.get_errno()
+        return OSError(code, os.strerror(code), path)
+
+
+class MetadataEntry:
+    """
+    The cached metadata of a file: Its :func:`os.stat` result *stat*, which
+    is `None` for files known not to exist, and the *digests* of its content,
+    keyed by hash algorithm.
+    """
+
+    __slots__ = ('stat', 'digests')
+
+    def __init__(self, stat):
+        self.stat = stat
+        self.digests = {}
+
+    def matches(self, stat):
+        """
+        Tests whether this entry describes the file with given :func:`os.stat`
+        result.
+        """
+        if self.stat is None or stat is None:
+            return self.stat is stat
+        return (self.stat.st_ino, self.stat.st_size, self.stat.st_mtime_ns) \
+            == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class MetadataCache:
+    """
+    Remembers the existence of up to *max_folders* folders, as well as the
+    metadata of up to *max_entries* files, so that frequent requests for the
+    same paths need not ask the file system. The least recently used entries
+    are dropped first.
+
+    Folders are cached as soon as they were created, or found to exist. The
+    folder of a cached file is watched with :class:`Inotify`, which reports
+    all changes to its files, including those made by other processes. The
+    pending events are applied before each lookup, so the cache is coherent
+    with the file system as far as the kernel reported changes. Files are not
+    cached at all where inotify is unavailable. Cached folders are not
+    watched, as an upload into a folder removed behind the server's back
+    simply creates it again.
+
+    Metadata read from the file system must be passed to :meth:`.put`
+    together with the :attr:`generation` retrieved beforehand, and is
+    rejected, if its file has changed in the meantime. Changes to the
+    temporary files of uploads, whose names end in ``.tmp``, are not
+    considered, as they are written continuously. Renaming or removing such
+    files still counts as a change. All methods are thread-safe.
+    """
+
+    #: The events, that do not count as a change of temporary files.
+    TMP_EVENTS = (Inotify.ATTRIB | Inotify.CLOSE_WRITE | Inotify.MODIFY |
+                  Inotify.CREATE)
+
+    EVENTS = (Inotify.ATTRIB | Inotify.CLOSE_WRITE | Inotify.MODIFY |
+              Inotify.MOVED_FROM | Inotify.MOVED_TO | Inotify.CREATE |
+              Inotify.DELETE | Inotify.DELETE_SELF | Inotify.MOVE_SELF |
+              Inotify.ONLYDIR)
+
+    def __init__(self, max_entries=65536, max_folders=1024):
+        self.max_entries = max_entries
+        self.max_folders = max_folders
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._folders = OrderedDict()
+        self._contents = {}
+        self._watches = {}
+        self._generations = Generations(max_entries)
+        self._inotify = None
+        if max_entries and max_folders:
+            try:
+                self._inotify = Inotify()
+            except OSError as e:
+                log.warn('not caching file metadata: {}'.format(e))
+
+    @property
+    def generation(self):
+        """
+        A number, that must be retrieved before reading the metadata, that is
+        to be passed to :meth:`.put`.
+        """
+        with self._lock:
+            return self._generations.current
+
+    def has_folder(self, folder):
+        """
+        Tests whether the *folder* is known to exist.
+        """
+        with self._lock:
+            if folder not in self._folders:
+                return False
+            self._folders.move_to_end(folder)
+            return True
+
+    def add_folder(self, folder):
+        """
+        Remembers that the *folder* exists.
+        """
+        if not self.max_folders:
+            return
+        with self._lock:
+            if folder in self._folders:
+                self._folders.move_to_end(folder)
+            else:
+                self._folders[folder] = None
+                self._evict_folders()
+
+    def discard_folder(self, folder):
+        """
+        Forgets about a *folder*, that no longer exists.
+        """
+        with self._lock:
+            self._drop_folder(folder)
+
+    def get(self, path):
+        """
+        Returns the :class:`MetadataEntry` of the file at *path*, or `None`,
+        if there is no such entry.
+        """
+        if self._inotify is None:
+            return None
+        with self._lock:
+            self._apply_events()
+            entry = self._files.get(path)
+            if entry is not None:
+                self._files.move_to_end(path)
+            return entry
+
+    def put(self, path, stat, generation, algorithm=None, digest=None):
+        """
+        Caches the :func:`os.stat` result *stat* of the file at *path*, or
+        the fact that there is no such file, if *stat* is `None`. A *digest*
+        of its content calculated with given hash *algorithm* may be cached
+        as well. Nothing is cached, if anything has changed since the
+        *generation* was retrieved.
+        """
+        if self._inotify is None:
+            return
+        folder = os.path.dirname(path)
+        with self._lock:
+            self._apply_events()
+            if self._generations.outdated(path, generation) or \
+                    not self._watch(folder):
+                return
+            entry = self._files.get(path)
+            if entry is None or not entry.matches(stat):
+                self._drop_file(path)
+                entry = self._files[path] = MetadataEntry(stat)
+                self._contents.setdefault(folder, set()).add(path)
+            if digest is not None:
+                entry.digests[algorithm] = digest
+            self._files.move_to_end(path)
+            while len(self._files) > self.max_entries:
+                self._drop_file(next(iter(self._files)))
+
+    def invalidate(self, path):
+        """
+        Drops the entry of the file at *path*, which was changed.
+        """
+        with self._lock:
+            self._generations.change(path)
+            self._drop_file(path)
+
+    def close(self):
+        """
+        Drops all entries and stops watching for changes.
+        """
+        with self._lock:
+            self._files.clear()
+            self._folders.clear()
+            self._contents.clear()
+            self._watches.clear()
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+
+    def _watch(self, folder):
+        wd = self._folders.get(folder)
+        if wd is None:
+            try:
+                wd = self._inotify.add_watch(folder, self.EVENTS)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    log.warn('not caching metadata in {}: {}'.format(
+                        folder, e))
+                return False
+            self._folders[folder] = wd
+            self._watches[wd] = folder
+            self._evict_folders()
+        self._folders.move_to_end(folder)
+        return True
+
+    def _evict_folders(self):
+        while len(self._folders) > self.max_folders:
+            self._drop_folder(next(iter(self._folders)))
+
+    def _drop_file(self, path):
+        if self._files.pop(path, None) is not None:
+            folder = os.path.dirname(path)
+            paths = self._contents[folder]
+            paths.discard(path)
+            if not paths:
+                del self._contents[folder]
+
+    def _drop_folder(self, folder):
+        if folder not in self._folders:
+            return
+        wd = self._folders.pop(folder)
+        if wd is not None and self._watches.pop(wd, None) is not None:
+            try:
+                self._inotify.remove_watch(wd)
+            except OSError:
+                # the folder is gone already
+                pass
+        for path in self._contents.pop(folder, ()):
+            del self._files[path]
+
+    def _drop_tree(self, folder):
+        prefix = folder + os.sep
+        for other in [other for other in self._folders
+                      if other == folder or other.startswith(prefix)]:
+            self._drop_folder(other)
+
+    def _apply_events(self):
+        events = self._inotify.read()
+        for wd, mask, name in events:
+            if mask & Inotify.Q_OVERFLOW:
+                log.warn('lost inotify events, dropping cached metadata')
+                self._generations.change_all()
+                for folder in list(self._folders):
+                    self._drop_folder(folder)
+                continue
+            folder = self._watches.get(wd)
+            if folder is None:
+                continue
+            if mask & (Inotify.DELETE_SELF | Inotify.MOVE_SELF |
+                       Inotify.IGNORED):
+                self._generations.change_all()
+                self._drop_tree(folder)
+            elif mask & Inotify.ISDIR and \
+                    mask & (Inotify.DELETE | Inotify.MOVED_FROM):
+                self._generations.change_all()
+                self._drop_tree(os.path.join(folder, name))
+            elif name and not (name.endswith('.tmp') and
+                               (mask & self.TMP_EVENTS) == mask):
+                path = os.path.join(folder, name)
+                self._generations.change(path)
+                self._drop_file(path)
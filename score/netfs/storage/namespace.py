@@ -0,0 +1,478 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from array import array
+import bisect
+import fcntl
+import logging
+import os
+import struct
+import threading
+
+
+log = logging.getLogger('score.netfs.storage')
+
+
+class IndexUnavailable(Exception):
+    """
+    Raised by :meth:`NamespaceIndex.list` if the index is still being built,
+    or was dropped because it grew beyond its configured size.
+    """
+
+
+class NamespaceIndex:
+    """
+    Keeps the paths, sizes and modification times of all committed files in
+    memory, so that they can be listed without touching the disk.
+
+    Paths are the UTF-8 encoded :class:`bytes` of the file names relative to
+    the storage root, using slashes as separators. Most entries are kept in
+    sorted, compact arrays, costing the length of the path plus 20 bytes each.
+    Recent changes are collected in a dictionary and merged into the arrays
+    once there are *merge_threshold* of them, or a sixty-fourth of the number
+    of entries, whichever is larger.
+
+    If *max_entries* is given and the number of entries exceeds it, all
+    entries are dropped and :meth:`list` raises :class:`IndexUnavailable` from
+    then on.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self, *, max_entries=None, merge_threshold=65536):
+        self.max_entries = max_entries
+        self.merge_threshold = merge_threshold
+        self.ready = False
+        self.overflow = False
+        self._lock = threading.Lock()
+        self._paths = bytearray()
+        self._offsets = array('Q', [0])
+        self._sizes = array('q')
+        self._mtimes = array('i')
+        self._pending = {}
+        self._pending_keys = []
+        self._count = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def build(self, entries):
+        """
+        Populates the index with *entries*, an iterable of `(path, size,
+        mtime)` tuples sorted by path. Changes registered while this function
+        is running take precedence over the *entries*.
+        """
+        paths = bytearray()
+        offsets = array('Q', [0])
+        sizes = array('q')
+        mtimes = array('i')
+        for path, size, mtime in entries:
+            if self.max_entries is not None and \
+                    len(sizes) >= self.max_entries:
+                log.error('namespace index exceeds {} entries, dropping it'.
+                          format(self.max_entries))
+                with self._lock:
+                    self._drop()
+                return
+            paths += path
+            offsets.append(len(paths))
+            sizes.append(size)
+            mtimes.append(mtime)
+        with self._lock:
+            if self.overflow:
+                return
+            self._paths = paths
+            self._offsets = offsets
+            self._sizes = sizes
+            self._mtimes = mtimes
+            self._count = len(sizes) + sum(
+                self._delta(key, self._pending[key])
+                for key in self._pending_keys)
+            self.ready = True
+            self._merge()
+        log.debug('namespace index ready with {} entries'.format(len(sizes)))
+
+    def set(self, path, size, mtime):
+        """
+        Registers a file at *path* with given *size* and *mtime*.
+        """
+        self._update(path, (size, mtime))
+
+    def remove(self, path):
+        """
+        Removes the file at *path* from the index.
+        """
+        self._update(path, None)
+
+    def list(self, prefix=b'', after=None, limit=1000):
+        """
+        Returns a list of at most *limit* `(path, size, mtime)` tuples of all
+        files, whose path starts with *prefix*, in sorted order. If *after* is
+        given, only paths sorting after it are included. The second return
+        value tells whether there are more matching files.
+        """
+        start = prefix
+        if after is not None and after >= prefix:
+            start = after + b'\0'
+        result = []
+        with self._lock:
+            if not self.ready:
+                raise IndexUnavailable()
+            i = self._bisect(start)
+            j = bisect.bisect_left(self._pending_keys, start)
+            while len(result) <= limit:
+                path = self._path(i) if i < len(self._sizes) else None
+                key = self._pending_keys[j] \
+                    if j < len(self._pending_keys) else None
+                if key is not None and (path is None or key <= path):
+                    if key == path:
+                        i += 1
+                    j += 1
+                    entry = self._pending[key]
+                    if entry is None:
+                        if key.startswith(prefix):
+                            continue
+                        break
+                    path, (size, mtime) = key, entry
+                elif path is not None:
+                    size, mtime = self._sizes[i], self._mtimes[i]
+                    i += 1
+                else:
+                    break
+                if not path.startswith(prefix):
+                    break
+                result.append((path, size, mtime))
+        more = len(result) > limit
+        return result[:limit], more
+
+    def _update(self, path, entry):
+        with self._lock:
+            if self.overflow:
+                return
+            if path in self._pending:
+                # undo the effect of the previous change on the count
+                self._count -= self._delta(path, self._pending[path])
+            else:
+                bisect.insort(self._pending_keys, path)
+            self._pending[path] = entry
+            self._count += self._delta(path, entry)
+            # the threshold grows with the index to keep the cost of merging
+            # constant per change
+            threshold = max(self.merge_threshold, len(self._sizes) // 64)
+            if self.ready and len(self._pending) >= threshold:
+                self._merge()
+
+    def _merge(self):
+        """
+        Merges pending changes into the sorted arrays. Must be called with the
+        lock held.
+        """
+        if not self._pending:
+            return
+        paths = bytearray()
+        offsets = array('Q', [0])
+        sizes = array('q')
+        mtimes = array('i')
+
+        def append(path, size, mtime):
+            paths.extend(path)
+            offsets.append(len(paths))
+            sizes.append(size)
+            mtimes.append(mtime)
+
+        i = 0
+        count = len(self._sizes)
+        for key in self._pending_keys:
+            # copy all unchanged entries preceding this key in bulk
+            end = self._bisect(key, i)
+            if end > i:
+                paths.extend(self._paths[self._offsets[i]:self._offsets[end]])
+                base = len(paths) - self._offsets[end]
+                offsets.extend(map(base.__add__,
+                                   self._offsets[i + 1:end + 1]))
+                sizes.extend(self._sizes[i:end])
+                mtimes.extend(self._mtimes[i:end])
+            i = end
+            if i < count and self._path(i) == key:
+                i += 1
+            entry = self._pending[key]
+            if entry is not None:
+                append(key, *entry)
+        if i < count:
+            paths.extend(self._paths[self._offsets[i]:])
+            base = len(paths) - len(self._paths)
+            offsets.extend(map(base.__add__, self._offsets[i + 1:]))
+            sizes.extend(self._sizes[i:])
+            mtimes.extend(self._mtimes[i:])
+        self._paths = paths
+        self._offsets = offsets
+        self._sizes = sizes
+        self._mtimes = mtimes
+        self._pending = {}
+        self._pending_keys = []
+        self._count = len(sizes)
+        if self.max_entries is not None and len(sizes) > self.max_entries:
+            log.error('namespace index exceeds {} entries, dropping it'.
+                      format(self.max_entries))
+            self._drop()
+
+    def _drop(self):
+        self.overflow = True
+        self.ready = False
+        self._paths = bytearray()
+        self._offsets = array('Q', [0])
+        self._sizes = array('q')
+        self._mtimes = array('i')
+        self._pending = {}
+        self._pending_keys = []
+        self._count = 0
+
+    def _delta(self, path, entry):
+        """
+        Returns by how much the pending change *entry* at *path* alters the
+        number of entries in the sorted arrays: an addition counts as one, a
+        removal of an existing entry as minus one and anything else as zero.
+        Must be called with the lock held.
+        """
+        i = self._bisect(path)
+        exists = i < len(self._sizes) and self._path(i) == path
+        if entry is None:
+            return -1 if exists else 0
+        return 0 if exists else 1
+
+    def _path(self, i):
+        return bytes(self._paths[self._offsets[i]:self._offsets[i + 1]])
+
+    def _bisect(self, path, lo=0):
+        hi = len(self._sizes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def scan(root, exclude=()):
+    """
+    Yields `(path, size, mtime)` tuples of all files below *root* in the
+    sorted order expected by :meth:`NamespaceIndex.build`. Temporary files of
+    ongoing uploads and the top-level folders named in *exclude* are skipped.
+    """
+    def entries(folder, prefix):
+        try:
+            with os.scandir(folder) as it:
+                children = []
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    name = os.fsencode(entry.name)
+                    if is_dir:
+                        if not prefix and entry.name in exclude:
+                            continue
+                        # a folder's entries are prefixed with a slash, which
+                        # must be considered when sorting
+                        children.append((name + b'/', entry))
+                    elif not entry.name.endswith('.tmp'):
+                        children.append((name, entry))
+        except OSError as e:
+            log.error(e)
+            return
+        children.sort(key=lambda child: child[0])
+        for name, entry in children:
+            if name.endswith(b'/'):
+                yield from entries(entry.path, prefix + name)
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            yield prefix + name, stat.st_size, int(stat.st_mtime)
+    yield from entries(root, b'')
+
+
+class ChangeJournal:
+    """
+    An append-only file at *path*, through which multiple server processes
+    sharing the same storage root learn about each other's changes to the
+    :class:`NamespaceIndex`.
+
+    Processes only need the changes made after they opened the journal, so
+    the file is replaced by an empty one, once it exceeds *max_size* bytes.
+    Each process reads the remaining changes of the replaced file before
+    moving on to the new one. The files are numbered in a header, so that a
+    process can tell, whether it missed a whole file, because the journal
+    was replaced several times since it was last read.
+    """
+
+    _header = struct.Struct('!q')
+    _record = struct.Struct('!qiH')
+
+    def __init__(self, path, max_size=4 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fd = self._open()
+        self._reader = os.dup(self._fd)
+        self._sequence = self._read_sequence(self._reader)
+        self._offset = os.fstat(self._reader).st_size
+        self._buffer = b''
+        self._lock = threading.Lock()
+
+    def append(self, path, size, mtime):
+        """
+        Records that the file at *path* now has given *size* and *mtime*. A
+        *size* of -1 denotes a removed file.
+        """
+        record = self._record.pack(size, mtime, len(path)) + path
+        with self._lock:
+            # the file must not be replaced while writing to it
+            while True:
+                fcntl.flock(self._fd, fcntl.LOCK_SH)
+                if not self._replaced(self._fd):
+                    break
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = self._open()
+            try:
+                # a single write to a file opened with O_APPEND is never
+                # interleaved with writes of other processes
+                os.write(self._fd, record)
+                full = os.fstat(self._fd).st_size >= self.max_size
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            if full:
+                self._rotate()
+
+    def read(self):
+        """
+        Returns a list of all `(path, size, mtime)` tuples appended since the
+        previous call, including those appended by this process. Returns
+        `None` instead, if some of the changes were lost.
+        """
+        with self._lock:
+            data = self._buffer + self._drain()
+            lost = False
+            while self._replaced(self._reader):
+                # nothing is appended to a file once it was replaced
+                data += self._drain()
+                fd = os.open(self.path, os.O_RDONLY)
+                sequence = self._read_sequence(fd)
+                lost = lost or sequence != self._sequence + 1
+                os.close(self._reader)
+                self._reader = fd
+                self._sequence = sequence
+                self._offset = self._header.size
+                data += self._drain()
+            changes = []
+            offset = 0
+            while offset + self._record.size <= len(data):
+                size, mtime, length = self._record.unpack_from(data, offset)
+                end = offset + self._record.size + length
+                if end > len(data):
+                    break
+                changes.append(
+                    (data[offset + self._record.size:end], size, mtime))
+                offset = end
+            self._buffer = data[offset:]
+            return None if lost else changes
+
+    def apply(self, index):
+        """
+        Applies all changes since the previous call to given *index*. Returns
+        `False`, if some of the changes were lost, in which case the *index*
+        must be rebuilt.
+        """
+        changes = self.read()
+        if changes is None:
+            return False
+        for path, size, mtime in changes:
+            if size < 0:
+                index.remove(path)
+            else:
+                index.set(path, size, mtime)
+        return True
+
+    def close(self):
+        os.close(self._fd)
+        os.close(self._reader)
+
+    def _open(self):
+        # opens the current file, writing the header of a new one
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT,
+                         0o666)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if not self._replaced(fd):
+                break
+            os.close(fd)
+        try:
+            if not os.fstat(fd).st_size:
+                os.write(fd, self._header.pack(0))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return fd
+
+    def _rotate(self):
+        fd = self._fd
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if self._replaced(fd):
+                # another process was faster
+                return
+            tmp = '{}.{}'.format(self.path, os.getpid())
+            new = os.open(tmp, os.O_RDWR | os.O_APPEND | os.O_CREAT |
+                          os.O_TRUNC, 0o666)
+            os.write(new, self._header.pack(self._read_sequence(fd) + 1))
+            os.rename(tmp, self.path)
+            self._fd = new
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _replaced(self, fd):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        own = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) != (own.st_dev, own.st_ino)
+
+    def _read_sequence(self, fd):
+        return self._header.unpack(os.pread(fd, self._header.size, 0))[0]
+
+    def _drain(self):
+        data = b''
+        while True:
+            chunk = os.pread(self._reader, 1024 * 1024, self._offset)
+            if not chunk:
+                return data
+            data += chunk
+            self._offset += len(chunk)
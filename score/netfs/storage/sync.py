@@ -0,0 +1,88 @@
+# Copyright © 2015-2018 STRG.AT GmbH, Vienna, Austria
+#
+# This file is part of the The SCORE Framework.
+#
+# The SCORE Framework and all its parts are free software: you can redistribute
+# them and/or modify them under the terms of the GNU Lesser General Public
+# License version 3 as published by the Free Software Foundation which is in the
+# file named COPYING.LESSER.txt.
+#
+# The SCORE Framework and all its parts are distributed without any WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. For more details see the GNU Lesser General Public
+# License.
+#
+# If you have not received a copy of the GNU Lesser General Public License see
+# http://www.gnu.org/licenses/.
+#
+# The License-Agreement realised between you as Licensee and STRG.AT GmbH as
+# Licenser including the issue of its valid conclusion and its pre- and
+# post-contractual effects is governed by the laws of Austria. Any disputes
+# concerning this License-Agreement including the issue of its valid conclusion
+# and its pre- and post-contractual effects are exclusively decided by the
+# competent court, in whose district STRG.AT GmbH has its registered seat, at
+# the discretion of STRG.AT GmbH also the competent court, in whose district the
+# Licensee has his registered seat, an establishment or assets.
+
+from concurrent.futures import Future
+import os
+import threading
+
+
+class FolderSync:
+    """
+    Flushes folders to disk via :func:`os.fsync` on behalf of several threads
+    at once.
+
+    Threads calling :meth:`.sync` while another thread is flushing folders
+    queue their folders for the next batch, which is flushed by one of them as
+    soon as the current batch is done. Each folder is flushed only once per
+    batch, no matter how many threads requested it. This keeps the number of
+    flushes low when many transactions are committed at the same time.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._running = False
+
+    def sync(self, folders):
+        """
+        Flushes all given *folders* and returns once they are on disk. Raises
+        the :class:`OSError` of the first folder, that could not be flushed.
+        """
+        future = Future()
+        with self._cond:
+            self._queue.append((frozenset(folders), future))
+            while not future.done():
+                if self._running:
+                    self._cond.wait()
+                    continue
+                self._running = True
+                batch, self._queue = self._queue, []
+                self._cond.release()
+                try:
+                    self._flush(batch)
+                finally:
+                    self._cond.acquire()
+                    self._running = False
+                    self._cond.notify_all()
+        future.result()
+
+    def _flush(self, batch):
+        errors = {}
+        for folder in frozenset().union(*(folders for folders, _ in batch)):
+            try:
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                errors[folder] = e
+        for folders, future in batch:
+            failed = [errors[folder] for folder in folders if folder in errors]
+            if failed:
+                future.set_exception(failed[0])
+            else:
+                future.set_result(None)
@@ -17,7 +17,8 @@ setup(
     packages=['score',
               'score.netfs',
               'score.netfs.proxy',
-              'score.netfs.proxy.operation'],
+              'score.netfs.proxy.operation',
+              'score.netfs.storage'],
     namespace_packages=['score'],
     zip_safe=False,
     license='LGPL',